@@ -0,0 +1,136 @@
+# adobo.
+#
+# Description: An analysis framework for scRNA-seq data.
+#  How to use: https://oscar-franzen.github.io/adobo/
+#     Contact: Oscar Franzen <p.oscar.franzen@gmail.com>
+"""
+Summary
+-------
+Cached lookups of the bundled gene annotation and of gene length files.
+"""
+
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+_ANNOTATION = {'human': 'human.gencode_v32.genes.txt',
+               'mouse': 'mouse.gencode_v23.genes.txt'}
+
+
+@lru_cache(maxsize=None)
+def gene_table(species):
+    """Loads Ensembl gene identifiers and gene symbols of the bundled
+    annotation
+
+    Notes
+    -----
+    The file is only read once per session.
+
+    Parameters
+    ----------
+    species : `{'human', 'mouse'}`
+        Species.
+
+    Returns
+    -------
+    :class:`pandas.Series`
+        Gene symbols with Ensembl gene identifiers as index.
+    """
+    if not species in _ANNOTATION:
+        raise Exception('"species" can be "human" or "mouse".')
+    fn = os.path.join(os.path.dirname(__file__), 'data', _ANNOTATION[species])
+    gs = pd.read_csv(fn, sep='\t', header=None, index_col=0)
+    return gs[1]
+
+
+@lru_cache(maxsize=16)
+def _read_gene_lengths(filename, mtime):
+    gl = pd.read_csv(filename, header=None, sep=' ')
+    if gl.shape[1] == 1:
+        return gl[0], True
+    return pd.Series(gl[1].values, index=gl[0].values), False
+
+
+def read_gene_lengths(filename):
+    """Reads a gene length file
+
+    Notes
+    -----
+    The parsed file is cached until the file is modified.
+
+    Parameters
+    ----------
+    filename : `str`
+        Path to a file where the first column is gene names and the
+        second column is the length, field separator is one space; or
+        a single column of lengths in the same order as the genes of
+        the data.
+
+    Returns
+    -------
+    :class:`pandas.Series`
+        Gene lengths.
+    `bool`
+        True if the file only contains lengths (matched by position).
+    """
+    lengths, positional = _read_gene_lengths(filename,
+                                             os.path.getmtime(filename))
+    return lengths.copy(), positional
+
+
+def _ensembl_id(names):
+    """ Ensembl gene identifier contained in every name (or NaN). """
+    names = pd.Index(names).astype(str)
+    return names.str.extract('(ENS[A-Z]*G[0-9]+)', expand=False)
+
+
+def match_gene_lengths(gene_lengths, genes, species=None):
+    """Aligns gene lengths with a list of gene names
+
+    Notes
+    -----
+    Names are first matched as they are. Remaining genes are matched
+    on their Ensembl gene identifiers, which can be plain identifiers,
+    versioned identifiers or in the format symbol_identifier (see
+    :func:`adobo.preproc.symbol_switch`). If `species` is set, gene
+    symbols are translated to identifiers with the bundled
+    annotation.
+
+    Parameters
+    ----------
+    gene_lengths : :class:`pandas.Series`
+        Gene lengths with gene names as index.
+    genes : :class:`pandas.Index`
+        Gene names to align to.
+    species : `{'human', 'mouse'}`
+        Species of the bundled annotation to use for translating
+        symbols. Default: None
+
+    Returns
+    -------
+    :class:`pandas.Series`
+        Gene lengths indexed by `genes`, NaN for genes without length.
+    """
+    gene_lengths = gene_lengths[np.logical_not(
+        gene_lengths.index.duplicated())]
+    ret = gene_lengths.reindex(genes)
+    missing = ret.isna().values
+    if not np.any(missing):
+        return ret
+
+    def _to_id(names):
+        ids = pd.Series(np.asarray(_ensembl_id(names), dtype=object))
+        if species is not None:
+            symbols = gene_table(species)
+            symbols = symbols[np.logical_not(symbols.duplicated())]
+            sym2id = pd.Series(symbols.index, index=symbols.values)
+            ids = ids.where(ids.notna(), sym2id.reindex(names).values)
+        return ids.values
+
+    by_id = pd.Series(gene_lengths.values, index=_to_id(gene_lengths.index))
+    by_id = by_id[np.logical_and(by_id.index.notna(),
+                                 np.logical_not(by_id.index.duplicated()))]
+    ret[missing] = by_id.reindex(_to_id(genes[missing])).values
+    return ret
@@ -0,0 +1,169 @@
+# adobo.
+#
+# Description: An analysis framework for scRNA-seq data.
+#  How to use: https://oscar-franzen.github.io/adobo/
+#     Contact: Oscar Franzen <p.oscar.franzen@gmail.com>
+"""
+Summary
+-------
+Helper functions for moving between pandas data frames and scipy
+sparse matrices.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, issparse
+
+
+def is_sparse_frame(data):
+    """Checks if every column of a data frame has a sparse dtype
+
+    Parameters
+    ----------
+    data : :class:`pandas.DataFrame`
+        A pandas data frame.
+
+    Returns
+    -------
+    `bool`
+        True if the data frame is sparse.
+    """
+    if not isinstance(data, pd.DataFrame) or data.shape[1] == 0:
+        return False
+    return all(isinstance(d, pd.SparseDtype) for d in data.dtypes)
+
+
+def to_csr(data, dtype=None):
+    """Converts a data frame or array to a CSR matrix without
+    densifying sparse input
+
+    Parameters
+    ----------
+    data : :class:`pandas.DataFrame`, :class:`numpy.ndarray` or scipy sparse matrix
+        Input data.
+    dtype : `numpy.dtype`
+        Data type of the returned matrix. Default: None (keep)
+
+    Returns
+    -------
+    :class:`scipy.sparse.csr_matrix`
+        The data as a CSR matrix.
+    """
+    if issparse(data):
+        mat = data.tocsr()
+    elif is_sparse_frame(data):
+        mat = data.sparse.to_coo().tocsr()
+    else:
+        mat = csr_matrix(np.asarray(data))
+    if dtype is not None:
+        mat = mat.astype(dtype)
+    return mat
+
+
+def to_frame(mat, index, columns, sparse=True):
+    """Wraps a scipy sparse matrix into a data frame
+
+    Parameters
+    ----------
+    mat : scipy sparse matrix
+        Input matrix.
+    index : `list`
+        Row names.
+    columns : `list`
+        Column names.
+    sparse : `bool`
+        Return a sparse data frame, otherwise a dense one. Default: True
+
+    Returns
+    -------
+    :class:`pandas.DataFrame`
+        A data frame with the same content as `mat`.
+    """
+    if sparse:
+        return pd.DataFrame.sparse.from_spmatrix(mat, index=index,
+                                                 columns=columns)
+    return pd.DataFrame(mat.toarray(), index=index, columns=columns)
+
+
+def dense_blocks(data, block_size=1000):
+    """Iterates over the rows of a matrix in dense blocks
+
+    Parameters
+    ----------
+    data : :class:`pandas.DataFrame` or :class:`adobo.data.lazy_norm`
+        Input data, sparse or dense.
+    block_size : `int`
+        Number of rows per block. Default: 1000
+
+    Yields
+    ------
+    `int`
+        Index of the first row of the block.
+    `int`
+        Index after the last row of the block.
+    :class:`numpy.ndarray`
+        The rows of the block as a dense float64 array.
+    """
+    if hasattr(data, 'iter_rows'):
+        start = 0
+        for block in data.iter_rows(block_size, sparse=False):
+            end = start+block.shape[0]
+            yield start, end, block.to_numpy(dtype=np.float64)
+            start = end
+        return
+    if is_sparse_frame(data):
+        mat = to_csr(data, dtype=np.float64)
+    for start in range(0, data.shape[0], block_size):
+        end = min(start+block_size, data.shape[0])
+        if is_sparse_frame(data):
+            yield start, end, mat[start:end].toarray()
+        else:
+            yield start, end, data.iloc[start:end, :].to_numpy(dtype=np.float64)
+
+
+def dense_col_blocks(data, block_size=1000, rows=None):
+    """Iterates over the columns of a matrix in dense blocks
+
+    Notes
+    -----
+    Only one block is held in memory at a time, so the matrix can be a
+    :class:`numpy.memmap` (or a data frame backed by one) or a
+    :class:`adobo.data.lazy_norm` larger than the available memory.
+
+    Parameters
+    ----------
+    data : :class:`pandas.DataFrame`, :class:`numpy.ndarray` or :class:`adobo.data.lazy_norm`
+        Input data, sparse or dense.
+    block_size : `int`
+        Number of columns per block. Default: 1000
+    rows : :class:`numpy.ndarray`
+        Boolean mask or integer positions of the rows to include.
+        Default: None (all rows)
+
+    Yields
+    ------
+    `int`
+        Index of the first column of the block.
+    `int`
+        Index after the last column of the block.
+    :class:`numpy.ndarray`
+        The columns of the block as a dense float64 array.
+    """
+    sel = slice(None) if rows is None else np.asarray(rows)
+    ncols = data.shape[1]
+    if hasattr(data, 'subset'):
+        if rows is not None:
+            data = data.subset(sel)
+        get_block = lambda a, b: data.block(cols=slice(a, b), sparse=False) \
+            .to_numpy(dtype=np.float64)
+    elif is_sparse_frame(data):
+        mat = to_csr(data, dtype=np.float64)[sel].tocsc()
+        get_block = lambda a, b: mat[:, a:b].toarray()
+    elif isinstance(data, pd.DataFrame):
+        get_block = lambda a, b: data.iloc[sel, a:b].to_numpy(dtype=np.float64)
+    else:
+        get_block = lambda a, b: np.asarray(data[:, a:b][sel],
+                                            dtype=np.float64)
+    for start in range(0, ncols, block_size):
+        end = min(start+block_size, ncols)
+        yield start, end, get_block(start, end)
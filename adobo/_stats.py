@@ -12,7 +12,13 @@ Statistical helper functions.
 import pandas as pd
 import numpy as np
 import scipy.special
-from statsmodels import robust
+import scipy.stats
+from scipy.sparse import issparse
+
+from ._sparse import is_sparse_frame, to_csr
+
+# scales the median absolute deviation to the standard deviation
+_MAD_CONST = scipy.stats.norm.ppf(3/4.)
 
 def bw_nrd(x):
     """Selects bandwidth for gaussian kernels
@@ -41,9 +47,14 @@ def bw_nrd(x):
 def row_geometric_mean(mat, eps=1):
     """Calculates the geometric mean for every row in a data frame
 
+    Notes
+    -----
+    Sparse input is never densified; every zero contributes log(eps)
+    to the row sum of logarithms.
+
     Parameters
     ----------
-    mat : :class:`pandas.DataFrame`
+    mat : :class:`pandas.DataFrame`, :class:`numpy.ndarray` or scipy sparse matrix
         A pandas data frame object containing raw read counts (rows=genes,
         columns=cells).
     eps : float
@@ -56,72 +67,281 @@ def row_geometric_mean(mat, eps=1):
     Returns
     -------
     :class:`pandas.Series`
-        Computed values.
+        Computed values (a :class:`numpy.ndarray` if `mat` is not a
+        data frame).
+    """
+    if issparse(mat) or is_sparse_frame(mat):
+        m = to_csr(mat, dtype=np.float64)
+        nnz = np.diff(m.indptr)
+        rows = np.repeat(np.arange(m.shape[0]), nnz)
+        log_sum = np.bincount(rows, np.log(m.data+eps), m.shape[0]) + \
+            (m.shape[1]-nnz)*np.log(eps)
+    else:
+        log_sum = np.log(np.asarray(mat, dtype=np.float64)+eps).sum(axis=1)
+    gm = np.exp(log_sum/mat.shape[1])-eps
+    if isinstance(mat, pd.DataFrame):
+        return pd.Series(gm, index=mat.index)
+    return gm
+
+def ksmooth(x, y, x_points, bw, ngrid=1024):
+    """Binned Nadaraya-Watson kernel regression with a normal kernel
+
+    Notes
+    -----
+    Approximates `ksmooth(kernel='normal')` in R, where the kernel is
+    scaled so that its quartiles are at +/- 0.25*`bw`. Data points are
+    linearly binned onto a regular grid of `ngrid` points and the
+    kernel is applied to the grid by convolution, so the run time is
+    linear in the number of data points.
+
+    Parameters
+    ----------
+    x : :class:`numpy.ndarray`
+        Input x values.
+    y : :class:`numpy.ndarray`
+        Input y values, either a vector or a matrix with one column per
+        variable to smooth.
+    x_points : :class:`numpy.ndarray`
+        Points at which to evaluate the smoothed fit.
+    bw : `float`
+        The bandwidth.
+    ngrid : `int`
+        Number of grid points. Default: 1024
+
+    References
+    ----------
+    .. [1] Wand, M. P. (1994) Fast Computation of Multivariate Kernel
+           Estimators. Journal of Computational and Graphical
+           Statistics 3, 433-445.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        Smoothed values at `x_points`, one column per column of `y`.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_points = np.asarray(x_points, dtype=float)
+    single = y.ndim == 1
+    y = y.reshape(len(x), -1)
+    sd = 0.3706506*bw
+    lo, hi = x.min(), x.max()
+    if hi == lo:
+        ret = np.tile(y.mean(axis=0), (len(x_points), 1))
+        return ret[:, 0] if single else ret
+    grid = np.linspace(lo, hi, ngrid)
+    delta = grid[1]-grid[0]
+    # linear binning, each point is split between its two grid neighbours
+    pos = (x-lo)/delta
+    i = np.minimum(np.floor(pos).astype(int), ngrid-2)
+    f = pos-i
+    wts = np.bincount(i, 1-f, ngrid)+np.bincount(i+1, f, ngrid)
+    k = int(np.ceil(4*sd/delta))
+    kern = np.exp(-0.5*(np.arange(-k, k+1)*delta/sd)**2)
+    den = np.convolve(wts, kern)[k:k+ngrid]
+    ret = np.empty((len(x_points), y.shape[1]))
+    for j in range(y.shape[1]):
+        wy = np.bincount(i, (1-f)*y[:, j], ngrid) + \
+            np.bincount(i+1, f*y[:, j], ngrid)
+        num = np.convolve(wy, kern)[k:k+ngrid]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ret[:, j] = np.interp(x_points, grid, num/den)
+    return ret[:, 0] if single else ret
+
+def binned_kde(x, x_points, bw=None, ngrid=4096):
+    """Binned Gaussian kernel density estimate
+
+    Notes
+    -----
+    Data points are linearly binned onto a regular grid and the kernel
+    is applied by convolution (see :func:`ksmooth`), so evaluating the
+    density at many points is linear in the number of points instead
+    of quadratic as in :class:`scipy.stats.gaussian_kde`.
+
+    Parameters
+    ----------
+    x : :class:`numpy.ndarray`
+        Input values.
+    x_points : :class:`numpy.ndarray`
+        Points at which to evaluate the density.
+    bw : `float`
+        Standard deviation of the kernel. If None, Scott's rule as in
+        :class:`scipy.stats.gaussian_kde`. Default: None
+    ngrid : `int`
+        Number of grid points. Default: 4096
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        Estimated density at `x_points`.
+    """
+    x = np.asarray(x, dtype=float)
+    x_points = np.asarray(x_points, dtype=float)
+    if bw is None:
+        bw = np.std(x, ddof=1)*len(x)**(-1/5.)
+    lo = min(x.min(), x_points.min())
+    hi = max(x.max(), x_points.max())
+    if hi == lo or bw == 0:
+        return np.full(len(x_points), np.inf)
+    grid = np.linspace(lo, hi, ngrid)
+    delta = grid[1]-grid[0]
+    pos = (x-lo)/delta
+    i = np.minimum(np.floor(pos).astype(int), ngrid-2)
+    f = pos-i
+    wts = np.bincount(i, 1-f, ngrid)+np.bincount(i+1, f, ngrid)
+    k = int(np.ceil(4*bw/delta))
+    kern = np.exp(-0.5*(np.arange(-k, k+1)*delta/bw)**2)/(bw*np.sqrt(2*np.pi))
+    den = np.convolve(wts, kern)[k:k+ngrid]/len(x)
+    return np.interp(x_points, grid, den)
+
+def poisson_irls(Y, X, maxit=25, tol=1e-8):
+    """Fits a Poisson generalized linear model with log link to every
+    row of a matrix using a shared design matrix
+
+    Notes
+    -----
+    Iteratively reweighted least squares (IRLS) where every iteration
+    solves the weighted normal equations of all rows at once as
+    matrix operations. Starting values and the deviance based
+    convergence criterion follow `statsmodels`.
+
+    Parameters
+    ----------
+    Y : :class:`numpy.ndarray`
+        Responses (rows=genes, columns=cells).
+    X : :class:`numpy.ndarray`
+        Design matrix shared by all rows (rows=cells, columns=predictors).
+    maxit : `int`
+        Maximum number of iterations. Default: 25
+    tol : `float`
+        Convergence tolerance on the relative change in
+        deviance. Default: 1e-8
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        Coefficients (rows=genes, columns=predictors).
+    :class:`numpy.ndarray`
+        Fitted values, same shape as `Y`.
     """
-    return mat.apply(lambda x: np.exp(np.mean(np.log(x+eps)))-eps, axis=1)
+    Y = np.asarray(Y, dtype=float)
+    X = np.asarray(X, dtype=float)
+    p = X.shape[1]
+    # outer products of the design rows, flattened so that X'WX for all
+    # genes is a single matrix product
+    XX = (X[:, :, None]*X[:, None, :]).reshape(X.shape[0], p*p)
+    mu = (Y + Y.mean(axis=1)[:, None])/2
+    eta = np.log(mu)
+    ylogy = scipy.special.xlogy(Y, Y)
+    dev_old = np.full(Y.shape[0], np.inf)
+    for _ in range(maxit):
+        # the weights equal mu for the Poisson family with log link
+        z = eta + (Y-mu)/mu
+        XtWX = np.dot(mu, XX).reshape(-1, p, p)
+        XtWz = np.dot(mu*z, X)
+        coef = np.linalg.solve(XtWX, XtWz[:, :, None])[:, :, 0]
+        eta = np.dot(coef, X.T)
+        mu = np.exp(eta)
+        dev = 2*np.sum(ylogy - Y*eta - (Y-mu), axis=1)
+        if np.all(np.abs(dev-dev_old) <= tol*(np.abs(dev)+0.1)):
+            break
+        dev_old = dev
+    return coef, mu
 
 def theta_ml(y, mu, limit=10, eps=np.finfo(float).eps, verbose=False):
     """Estimates theta of the Negative Binomial Distribution using maximum likelihood
 
     Notes
     -----
-    Adapted from the theta.ml function of the R package MASS.
+    Adapted from the theta.ml function of the R package MASS. If `y`
+    and `mu` are matrices, theta is estimated for every row at once.
 
     Parameters
     ----------
-    y : `list`
-        List of observed values from the negative binomial.
-    mu : `list`
-        Estimated mean vector.
+    y : `list` or :class:`numpy.ndarray`
+        List of observed values from the negative binomial, or a
+        matrix with one set of observations per row.
+    mu : `list` or :class:`numpy.ndarray`
+        Estimated mean vector (or matrix), same shape as `y`.
     limit : `int`
         Maximum number of iterations (default: 10).
 
     Returns
     -------
-    float
-        Estimated theta.
+    float or :class:`numpy.ndarray`
+        Estimated theta (one per row if the input was a matrix).
     """
     digamma = scipy.special.digamma
     trigamma = lambda x: scipy.special.polygamma(1, x)
     log = np.log
 
-    def score(n, th, mu, y, w):
-        return sum(w*(digamma(th+y)-digamma(th)+log(th)+1-log(th+mu)-(y+th)/(mu+th)))
+    def score(th, mu, y):
+        th = th[:, None]
+        return np.sum(digamma(th+y)-digamma(th)+log(th)+1-log(th+mu)-(y+th)/(mu+th),
+                      axis=1)
 
-    def info(n, th, mu, y, w):
-        return sum(w*(-trigamma(th+y)+trigamma(th)-1/th+2/(mu+th)-(y+th)/(mu+th)**2))
+    def info(th, mu, y):
+        th = th[:, None]
+        return np.sum(-trigamma(th+y)+trigamma(th)-1/th+2/(mu+th)-(y+th)/(mu+th)**2,
+                      axis=1)
 
-    weights = [1]*len(y)
-    n = sum(weights)
-    t0 = n/sum(weights*(y/mu-1)**2)
-    it = 0
-    del_ = 1
+    y = np.asarray(y, dtype=float)
+    mu = np.asarray(mu, dtype=float)
+    single = y.ndim == 1
+    y = np.atleast_2d(y)
+    mu = np.atleast_2d(mu)
+    n = y.shape[1]
+    t0 = n/np.sum((y/mu-1)**2, axis=1)
+    it = np.zeros(len(t0), dtype=int)
+    active = np.arange(len(t0))
 
-    while it < limit and np.abs(del_) > eps:
-        it = it+1
-        t0 = abs(t0)
-        i = info(n, t0, mu, y, weights)
-        del_ = score(n, t0, mu, y, weights)/i
-        t0 = t0 + del_
+    while len(active) > 0:
+        it[active] += 1
+        th = np.abs(t0[active])
+        del_ = score(th, mu[active], y[active])/info(th, mu[active], y[active])
+        t0[active] = th + del_
+        active = active[np.logical_and(it[active] < limit, np.abs(del_) > eps)]
 
-    if t0 < 0 and verbose:
+    if np.any(t0 < 0) and verbose:
         print('theta_ml(): estimate truncated at zero')
-    if it == limit and verbose:
+    if np.any(it == limit) and verbose:
         print('theta_ml(): iteration limit reached')
+    if single:
+        return t0[0]
     return t0
 
-def _robust_scale(x):
-    return (x-np.median(x))/(robust.mad(x)+np.finfo(float).eps)
-
 def _robust_scale_binned(y, x, breaks):
-    bins = pd.cut(x, breaks)
-    l = []
-    for item in pd.DataFrame({'y' : y.values, 'x' : x.values}).groupby(bins.values):
-        l.append(_robust_scale(item[1]['y']))
-    z = pd.concat(l)
-    return z.sort_index()
+    """ Robust z-scores of the columns of `y` within bins of `x`. """
+    bins = pd.cut(np.asarray(x), breaks)
+    dev = y-y.groupby(bins, observed=True).transform('median')
+    mad = dev.abs().groupby(bins, observed=True).transform('median')/_MAD_CONST
+    return dev/(mad+np.finfo(float).eps)
 
 def is_outlier(y, x, thres=10):
+    """Finds outliers in the relationship between parameters and a
+    covariate
+
+    Notes
+    -----
+    Values are scaled robustly (median and MAD) within bins of `x`,
+    using two overlapping sets of bins. A value is an outlier if its
+    absolute score is above `thres` in both.
+
+    Parameters
+    ----------
+    y : :class:`pandas.Series` or :class:`pandas.DataFrame`
+        Parameter(s), one column per parameter.
+    x : :class:`pandas.Series`
+        Covariate with one value per row of `y`.
+    thres : `float`
+        Threshold. Default: 10
+
+    Returns
+    -------
+    :class:`pandas.Series` or :class:`pandas.DataFrame`
+        True for outliers, same shape as `y`.
+    """
+    x = np.asarray(x)
     bin_width = (max(x)-min(x))*bw_nrd(x)/2
     eps_ = np.finfo(float).eps*10
     breaks1 = np.linspace(min(x)-eps_, max(x)+bin_width, 50, endpoint=False)
@@ -269,7 +269,7 @@ def louvain(snn_graph, res=0.8, seed=42):
 
 def generate(obj, k=10, name=None, distance='euclidean', graph='snn',
              clust_alg='leiden', prune_snn=0.067, res=0.8,
-             save_graph=True, seed=42, verbose=False):
+             save_graph=True, seed=42, reduction='pca', verbose=False):
     """A wrapper function for generating single cell clusters from a
     shared nearest neighbor graph with the Leiden algorithm
 
@@ -286,8 +286,6 @@ def generate(obj, k=10, name=None, distance='euclidean', graph='snn',
     distance : `str`
         Distance metric to use. See here for valid choices:
         https://tinyurl.com/y4bckf7w Default: 'euclidean'
-    target : `{'irlb', 'svd'}`
-        The dimensionality reduction result to run on. Default: irlb
     graph : `{'snn'}`
         Type of graph to generate. Only shared nearest neighbor (snn)
         supported at the moment.
@@ -306,6 +304,10 @@ def generate(obj, k=10, name=None, distance='euclidean', graph='snn',
         To save the graph or not. Default: True
     seed : `int`
         For reproducibility.
+    reduction : `{'pca', 'harmony'}`
+        The components to build the graph from. Use 'harmony' for
+        components corrected with :func:`adobo.dr.harmony`. Default:
+        'pca'
     verbose : `bool`
         Be verbose or not.
 
@@ -339,10 +341,10 @@ https://oscar-franzen.github.io/adobo/adobo.html#adobo.normalize.norm')
         if verbose:
             print('Running clustering on the %s normalization' % l)
         try:
-            comp = item['dr']['pca']['comp']
+            comp = item['dr'][reduction]['comp']
         except KeyError:
             raise Exception(
-                'Compute principal components first using adobo.dr.pca(...)')
+                'Compute the components first using adobo.dr.%s(...)' % reduction)
         nn_idx = knn(comp, k, distance)
         snn_graph = snn(nn_idx, k, prune_snn, verbose)
         if clust_alg == 'leiden':
@@ -361,3 +363,84 @@ https://oscar-franzen.github.io/adobo/adobo.html#adobo.normalize.norm')
             print('cluster cells')
             for i in sorted(cd):
                 print(i, cd[i])
+
+
+def transfer_labels(obj, comp, labels=None, normalization=None, k=10,
+                    distance='euclidean', clust_alg='leiden'):
+    """Transfers labels to new cells from their nearest neighbors in
+    a dataset
+
+    Notes
+    -----
+    Every new cell gets the most frequent label of its `k` nearest
+    cells of `obj` in the PCA space. The components of the new cells
+    must be in the same space, i.e. computed with
+    :py:func:`adobo.dr.project`:
+
+    >>> comp = ad.dr.project(exp, new_norm)
+    >>> ad.clustering.transfer_labels(exp, comp)
+
+    Parameters
+    ----------
+    obj : :class:`adobo.data.dataset`
+        A dataset class object with a PCA, see
+        :py:func:`adobo.dr.pca`.
+    comp : :class:`pandas.DataFrame`
+        Components of the new cells (rows=cells).
+    labels : `str` or :class:`pandas.Series`
+        Labels of the cells of `obj`. A string is a column of
+        `obj.meta_cells`. If None, the clusters of `clust_alg` are
+        used. Default: None
+    normalization : `str`
+        The name of the normalization with the PCA. Can be None if
+        there is only one normalization. Default: None
+    k : `int`
+        Number of nearest neighbors. Default: 10
+    distance : `str`
+        Distance metric to use. See here for valid choices:
+        https://tinyurl.com/y4bckf7w Default: 'euclidean'
+    clust_alg : `str`
+        Clustering whose clusters are transferred if `labels` is
+        None. Default: 'leiden'
+
+    Returns
+    -------
+    :class:`pandas.DataFrame`
+        The transferred label of every new cell ('label') and the
+        fraction of the neighbors with this label ('fraction').
+    """
+    if normalization is None or normalization == '':
+        if len(obj.norm_data) != 1:
+            raise Exception('Specify the normalization with the PCA.')
+        normalization = list(obj.norm_data)[0]
+    item = obj.norm_data[normalization]
+    try:
+        ref = item['dr']['pca']['comp']
+    except KeyError:
+        raise Exception('Run adobo.dr.pca() first.')
+    if labels is None:
+        try:
+            labels = item['clusters'][clust_alg]['membership']
+        except KeyError:
+            raise Exception('Run adobo.clustering.generate() first or \
+specify "labels".')
+    elif isinstance(labels, str):
+        labels = obj.meta_cells[labels]
+    labels = pd.Categorical(pd.Series(labels).reindex(ref.index))
+    known = labels.codes >= 0
+    if not np.any(known):
+        raise Exception('None of the cells with components have a label.')
+    nbrs = NearestNeighbors(n_neighbors=min(k, np.sum(known)),
+                            metric=distance)
+    nbrs.fit(ref.values[known])
+    indices = nbrs.kneighbors(comp.values)[1]
+    # votes of the neighbors for every label
+    codes = labels.codes[known][indices]
+    ncat = len(labels.categories)
+    rows = np.repeat(np.arange(codes.shape[0]), codes.shape[1])
+    votes = np.bincount(rows*ncat+codes.ravel(),
+                        minlength=codes.shape[0]*ncat).reshape(-1, ncat)
+    best = votes.argmax(axis=1)
+    return pd.DataFrame({'label': labels.categories[best],
+                         'fraction': votes.max(axis=1)/codes.shape[1]},
+                        index=comp.index)
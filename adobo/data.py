@@ -12,10 +12,12 @@ This module contains a data storage class.
 import joblib
 import pandas as pd
 import numpy as np
+from scipy.sparse import coo_matrix, issparse
 
 import adobo
 
 from ._constants import ASSAY_NOT_DONE
+from ._sparse import to_csr, to_frame, is_sparse_frame, dense_blocks
 
 
 class dataset:
@@ -28,8 +30,9 @@ class dataset:
         Holding information about what functions have been applied.
     count_data : :class:`pandas.DataFrame`
         Raw read count matrix.
-    imp_count_data : :class:`pandas.DataFrame`
-        Raw data after imputing dropouts.
+    imp_count_data : :class:`adobo.data.imputed_counts`
+        Raw data after imputing dropouts, stored as the imputed values
+        on top of `count_data`.
     _low_quality_cells : `list`
         Low quality cells identified with
         :py:meth:`adobo.preproc.find_low_quality_cells`.
@@ -350,3 +353,584 @@ Commands executed:
                             self.norm_data[n][k] = {}
         except:
             pass
+
+
+class imputed_counts:
+    """Imputed read counts stored as a sparse delta on top of the raw
+    read counts
+
+    Notes
+    -----
+    Imputation only changes the dropout entries of valid genes, so
+    only these entries are stored. The full imputed matrix is a view
+    that is generated on demand with :py:meth:`merge`; memory use is
+    proportional to the number of imputed entries.
+
+    Attributes
+    ----------
+    index : :class:`pandas.Index`
+        Gene names of the raw read count matrix.
+    columns : :class:`pandas.Index`
+        Cell names of the raw read count matrix.
+    rows : :class:`numpy.ndarray`
+        Row (gene) positions of the imputed entries.
+    cols : :class:`numpy.ndarray`
+        Column (cell) positions of the imputed entries.
+    values : :class:`numpy.ndarray`
+        Imputed read counts.
+    """
+
+    def __init__(self, index, columns, rows, cols, values):
+        self.index = index
+        self.columns = columns
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.values = np.asarray(values, dtype=float)
+
+    @property
+    def shape(self):
+        return (len(self.index), len(self.columns))
+
+    @property
+    def nimputed(self):
+        """ Number of imputed entries. """
+        return len(self.values)
+
+    def memory_usage(self):
+        """ Bytes used by the stored entries (mimics pandas). """
+        return pd.Series([self.rows.nbytes, self.cols.nbytes,
+                          self.values.nbytes],
+                         index=['rows', 'cols', 'values'])
+
+    def delta(self):
+        """Imputed values as a sparse matrix
+
+        Returns
+        -------
+        :class:`scipy.sparse.csr_matrix`
+            A genes by cells matrix holding the imputed values at the
+            imputed positions.
+        """
+        return coo_matrix((self.values, (self.rows, self.cols)),
+                          shape=self.shape).tocsr()
+
+    def merge_csr(self, count_data):
+        """Merges the imputed values into raw read counts as a CSR matrix
+
+        Notes
+        -----
+        Only the non-zero read counts and the imputed entries are
+        stored, so memory is proportional to their number also when
+        `count_data` is dense. :func:`adobo.normalize.norm` passes this
+        matrix directly to the normalization methods.
+
+        Parameters
+        ----------
+        count_data : :class:`pandas.DataFrame`
+            The raw read count matrix the imputation was run on
+            (normally `count_data` of the dataset).
+
+        Returns
+        -------
+        :class:`scipy.sparse.csr_matrix`
+            Raw read counts (rows=genes, columns=cells) where imputed
+            entries have been replaced with their imputed values.
+        """
+        if not (count_data.index.equals(self.index) and
+                count_data.columns.equals(self.columns)):
+            raise Exception('The read count matrix does not match the \
+imputed data.')
+        raw = to_csr(count_data, dtype=float)
+        pattern = coo_matrix((np.ones(len(self.rows)),
+                              (self.rows, self.cols)),
+                             shape=self.shape).tocsr()
+        merged = raw - raw.multiply(pattern) + self.delta()
+        merged.eliminate_zeros()
+        return merged
+
+    def merge(self, count_data, sparse=True):
+        """Merges the imputed values into raw read counts
+
+        Parameters
+        ----------
+        count_data : :class:`pandas.DataFrame`
+            The raw read count matrix the imputation was run on
+            (normally `count_data` of the dataset).
+        sparse : `bool`
+            Return a sparse data frame. Default: True
+
+        Returns
+        -------
+        :class:`pandas.DataFrame`
+            Raw read counts where imputed entries have been replaced
+            with their imputed values.
+        """
+        return to_frame(self.merge_csr(count_data), self.index, self.columns,
+                        sparse)
+
+
+class lazy_norm:
+    """A normalized expression matrix computed on the fly from read
+    counts and per-cell size factors
+
+    Notes
+    -----
+    The normalized value of gene `g` in cell `c` is
+    `log_func(counts[g, c]*size_factors[c] + small_const)`, or the
+    scaled count if `log` is False. Only the read counts and the size
+    factors are stored; row and column blocks are computed when
+    requested, so the full normalized matrix is never materialized
+    unless :py:meth:`to_frame` is called.
+
+    Attributes
+    ----------
+    counts : :class:`scipy.sparse.csr_matrix`
+        Read counts (rows=genes, columns=cells).
+    size_factors : :class:`numpy.ndarray`
+        Multiplicative factor for every cell.
+    index : :class:`pandas.Index`
+        Gene names.
+    columns : :class:`pandas.Index`
+        Cell names.
+    log : `bool`
+        Apply the log transformation.
+    log_func : `numpy.func`
+        Logarithmic function to use.
+    small_const : `float`
+        Constant added before the log transformation.
+    sparse : `bool`
+        Return sparse data frames by default, if zero counts map to
+        zero.
+    """
+
+    def __init__(self, counts, size_factors, index, columns, log=True,
+                 log_func=np.log2, small_const=1, sparse=True):
+        self.counts = to_csr(counts, dtype=np.float64)
+        self.counts.eliminate_zeros()
+        self.size_factors = np.asarray(size_factors, dtype=np.float64)
+        self.index = pd.Index(index)
+        self.columns = pd.Index(columns)
+        self.log = log
+        self.log_func = log_func
+        self.small_const = small_const
+        self.sparse = sparse
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    @property
+    def fill(self):
+        """ Normalized value of a zero count. """
+        return float(self._transform(np.zeros(1))[0])
+
+    def memory_usage(self):
+        """ Bytes used by the stored data (mimics pandas). """
+        return pd.Series([self.counts.data.nbytes+self.counts.indices.nbytes+
+                          self.counts.indptr.nbytes,
+                          self.size_factors.nbytes],
+                         index=['counts', 'size_factors'])
+
+    def _transform(self, x):
+        if self.log:
+            return self.log_func(x+self.small_const)
+        return x
+
+    @staticmethod
+    def _positions(key, names):
+        """ Converts a row or column selector to integer positions. """
+        pos = np.arange(len(names))
+        if key is None:
+            return pos
+        if isinstance(key, slice):
+            return pos[key]
+        key = np.asarray(key)
+        if key.dtype == bool:
+            return pos[key]
+        if np.issubdtype(key.dtype, np.integer):
+            return key
+        pos = names.get_indexer(key)
+        if np.any(pos < 0):
+            raise Exception('Not found: %s' % ', '.join(key[pos < 0][:5]))
+        return pos
+
+    def block(self, rows=None, cols=None, sparse=None):
+        """Computes a block of the normalized matrix
+
+        Parameters
+        ----------
+        rows : `list`, :class:`numpy.ndarray` or `slice`
+            Genes to include, as names, integer positions, a boolean
+            mask or a slice. Default: None (all genes)
+        cols : `list`, :class:`numpy.ndarray` or `slice`
+            Cells to include, same options as `rows`. Default: None
+            (all cells)
+        sparse : `bool`
+            Return a sparse data frame. If None, the `sparse`
+            attribute decides. A dense data frame is always returned
+            if zero counts do not map to zero (:py:attr:`fill` is not
+            0), since no entry could be left out. Default: None
+
+        Returns
+        -------
+        :class:`pandas.DataFrame`
+            Normalized values (rows=genes, columns=cells).
+        """
+        if sparse is None:
+            sparse = self.sparse
+        r = self._positions(rows, self.index)
+        c = self._positions(cols, self.columns)
+        mat = self.counts[r][:, c]
+        mat.data = self._transform(mat.data*self.size_factors[c][mat.indices])
+        index, columns = self.index[r], self.columns[c]
+        fill = self.fill
+        if fill == 0:
+            return to_frame(mat, index, columns, sparse)
+        # zero counts do not map to zero, fill in all positions
+        dense = np.full(mat.shape, fill)
+        coo = mat.tocoo()
+        dense[coo.row, coo.col] = coo.data
+        return pd.DataFrame(dense, index=index, columns=columns)
+
+    def rows(self, genes, sparse=None):
+        """ Normalized values of a set of genes across all cells. """
+        return self.block(rows=genes, sparse=sparse)
+
+    def cols(self, cells, sparse=None):
+        """ Normalized values of all genes in a set of cells. """
+        return self.block(cols=cells, sparse=sparse)
+
+    def iter_rows(self, block_size=1000, cols=None, sparse=None):
+        """Iterates over the normalized matrix in blocks of genes
+
+        Parameters
+        ----------
+        block_size : `int`
+            Number of genes per block. Default: 1000
+        cols : `list`, :class:`numpy.ndarray` or `slice`
+            Cells to include, see :py:meth:`block`. Default: None
+        sparse : `bool`
+            Return sparse data frames. Default: None
+
+        Yields
+        ------
+        :class:`pandas.DataFrame`
+            A block of normalized values (rows=genes, columns=cells).
+        """
+        for start in range(0, self.shape[0], block_size):
+            yield self.block(rows=slice(start, start+block_size),
+                             cols=cols, sparse=sparse)
+
+    def subset(self, rows):
+        """Restricts the matrix to a set of genes
+
+        Parameters
+        ----------
+        rows : `list`, :class:`numpy.ndarray` or `slice`
+            Genes to keep, see :py:meth:`block`.
+
+        Returns
+        -------
+        :class:`adobo.data.lazy_norm`
+            A new lazy matrix sharing the size factors.
+        """
+        r = self._positions(rows, self.index)
+        return lazy_norm(self.counts[r], self.size_factors, self.index[r],
+                         self.columns, self.log, self.log_func,
+                         self.small_const, self.sparse)
+
+    def _csr_blocks(self, block_size=1000):
+        """Normalized values in CSR blocks of genes. Only valid if
+        zero counts map to zero (:py:attr:`fill` is 0)."""
+        for start in range(0, self.shape[0], block_size):
+            end = min(start+block_size, self.shape[0])
+            mat = self.counts[start:end]
+            mat.data = self._transform(mat.data*self.size_factors[mat.indices])
+            yield start, end, mat
+
+    def to_frame(self, sparse=None):
+        """ Materializes the full normalized matrix. """
+        return self.block(sparse=sparse)
+
+    def _moments(self, axis):
+        mat = self.counts
+        values = self._transform(mat.data*self.size_factors[mat.indices])
+        if axis == 1:
+            idx = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
+        else:
+            idx = mat.indices
+        n = mat.shape[axis]
+        m = mat.shape[1-axis]
+        fill = self.fill
+        nzero = n-np.bincount(idx, minlength=m)
+        mean = (np.bincount(idx, values, m)+nzero*fill)/n
+        ss = np.bincount(idx, (values-mean[idx])**2, m)+nzero*(fill-mean)**2
+        return mean, ss
+
+    def mean(self, axis=1):
+        """Mean of the normalized values
+
+        Parameters
+        ----------
+        axis : `{0, 1}`
+            1 for the mean of every gene, 0 for every cell. Default: 1
+
+        Returns
+        -------
+        :class:`pandas.Series`
+            Means.
+        """
+        mean, _ = self._moments(axis)
+        return pd.Series(mean, index=self.index if axis == 1 else self.columns)
+
+    def var(self, axis=1, ddof=1):
+        """Variance of the normalized values
+
+        Parameters
+        ----------
+        axis : `{0, 1}`
+            1 for the variance of every gene, 0 for every
+            cell. Default: 1
+        ddof : `int`
+            Delta degrees of freedom. Default: 1
+
+        Returns
+        -------
+        :class:`pandas.Series`
+            Variances.
+        """
+        _, ss = self._moments(axis)
+        return pd.Series(ss/(self.shape[axis]-ddof),
+                         index=self.index if axis == 1 else self.columns)
+
+
+class gene_moments:
+    """Per gene moments of a normalized expression matrix, on the
+    stored and on the linear scale
+
+    Notes
+    -----
+    For every gene the mean and the sum of squared deviations from the
+    mean are kept on the stored scale and on the linear scale
+    (`2**x-1` if the data were log transformed), as well as the number
+    of cells with a value above zero. The matrix is read once, in
+    blocks of genes. Zeros map to zero on both scales, so only the
+    stored (non-zero) values of sparse data are visited. The result is
+    small and is cached in `norm_data[...]['moments']` by
+    :func:`adobo.hvg.find_hvg`.
+
+    The moments can be updated with new cells (:py:meth:`update`) or
+    combined with the moments of other cells (:py:meth:`merge`),
+    using the pairwise update of Chan et al., so highly variable genes
+    of growing or sharded data can be found without revisiting old
+    cells:
+
+    >>> m = ad.data.gene_moments(day1_norm)
+    >>> m.update(day2_norm)
+    >>> hvg = ad.hvg.seurat(None, moments=m)
+
+    Attributes
+    ----------
+    index : :class:`pandas.Index`
+        Gene names.
+    ncells : `int`
+        Number of cells.
+    log : `bool`
+        If the data were log transformed.
+    stats : :class:`pandas.DataFrame`
+        Mean ('mean', 'mean_lin'), sum of squared deviations from the
+        mean ('m2', 'm2_lin') and number of cells with a value above
+        zero ('detected') of every gene.
+
+    References
+    ----------
+    .. [1] Chan, Golub & LeVeque (1979) Updating formulae and a pairwise
+           algorithm for computing sample variances. Technical Report
+           STAN-CS-79-773, Stanford University
+    """
+
+    _COLUMNS = ['mean', 'm2', 'mean_lin', 'm2_lin', 'detected']
+
+    def __init__(self, data, log=True, block_size=1000):
+        codes = np.zeros(data.shape[1], dtype=int)
+        stats = self._stats(data, log, block_size, codes, 1)[:, 0]
+        self._set(data.index, data.shape[1], log, stats)
+
+    def _set(self, index, ncells, log, stats):
+        self.index = pd.Index(index)
+        self.ncells = int(ncells)
+        self.log = log
+        self.stats = pd.DataFrame(stats, index=self.index,
+                                  columns=self._COLUMNS)
+
+    @classmethod
+    def split(cls, data, groups, log=True, block_size=1000):
+        """Gene moments within groups of cells, such as batches
+
+        Notes
+        -----
+        The moments of all groups are collected in one pass over the
+        data.
+
+        Parameters
+        ----------
+        data : :class:`pandas.DataFrame` or :class:`adobo.data.lazy_norm`
+            Normalized data (rows=genes, columns=cells).
+        groups : `list` or :class:`numpy.ndarray`
+            Group of every cell.
+        log : `bool`
+            If the data were log transformed. Default: True
+        block_size : `int`
+            Number of genes to process at a time. Default: 1000
+
+        Returns
+        -------
+        `dict`
+            A :class:`gene_moments` object for every group.
+        """
+        groups = pd.Categorical(groups)
+        ngroups = len(groups.categories)
+        stats = cls._stats(data, log, block_size, groups.codes, ngroups)
+        ncells = np.bincount(groups.codes, minlength=ngroups)
+        ret = {}
+        for j, group in enumerate(groups.categories):
+            m = cls.__new__(cls)
+            m._set(data.index, ncells[j], log, stats[:, j])
+            ret[group] = m
+        return ret
+
+    @staticmethod
+    def _blocks(data, block_size):
+        if isinstance(data, lazy_norm) and data.fill == 0:
+            yield from data._csr_blocks(block_size)
+        elif is_sparse_frame(data):
+            mat = to_csr(data, dtype=np.float64)
+            for start in range(0, mat.shape[0], block_size):
+                end = min(start+block_size, mat.shape[0])
+                yield start, end, mat[start:end]
+        else:
+            yield from dense_blocks(data, block_size)
+
+    @classmethod
+    def _stats(cls, data, log, block_size, codes, ngroups):
+        """ Moments of every gene (rows) and group of cells (columns). """
+        stats = np.zeros((data.shape[0], ngroups, 5))
+        ncells = np.maximum(np.bincount(codes, minlength=ngroups), 1)
+        ind = np.eye(ngroups)[codes]
+        for start, end, block in cls._blocks(data, block_size):
+            n = end-start
+            if issparse(block):
+                x = block.data
+                key = np.repeat(np.arange(n), np.diff(block.indptr))*ngroups + \
+                    codes[block.indices]
+                nzero = ncells-np.bincount(key, None, n*ngroups).reshape(
+                    n, ngroups)
+                for j, v in ((0, x), (2, 2**x-1 if log else x)):
+                    mean = np.bincount(key, v, n*ngroups).reshape(
+                        n, ngroups)/ncells
+                    dev = (v-mean.ravel()[key])**2
+                    stats[start:end, :, j] = mean
+                    stats[start:end, :, j+1] = np.bincount(
+                        key, dev, n*ngroups).reshape(n, ngroups) + \
+                        nzero*mean**2
+                stats[start:end, :, 4] = np.bincount(
+                    key, x > 0, n*ngroups).reshape(n, ngroups)
+            else:
+                for j, v in ((0, block), (2, 2**block-1 if log else block)):
+                    mean = np.dot(v, ind)/ncells
+                    stats[start:end, :, j] = mean
+                    stats[start:end, :, j+1] = np.dot((v-mean[:, codes])**2,
+                                                      ind)
+                stats[start:end, :, 4] = np.dot(block > 0, ind)
+        return stats
+
+    def update(self, data, block_size=1000):
+        """Adds new cells
+
+        Parameters
+        ----------
+        data : :class:`pandas.DataFrame` or :class:`adobo.data.lazy_norm`
+            Normalized data of the new cells (rows=genes,
+            columns=cells), with the same genes in the same order.
+        block_size : `int`
+            Number of genes to process at a time. Default: 1000
+
+        Returns
+        -------
+        :class:`gene_moments`
+            The updated object (updated in place).
+        """
+        return self.merge(gene_moments(data, self.log, block_size))
+
+    def merge(self, other):
+        """Adds the moments of other cells, such as another shard of
+        the data
+
+        Parameters
+        ----------
+        other : :class:`gene_moments`
+            Moments of other cells, with the same genes in the same
+            order.
+
+        Returns
+        -------
+        :class:`gene_moments`
+            The updated object (updated in place).
+        """
+        if not self.index.equals(other.index):
+            raise Exception('The genes of the moments to merge differ.')
+        if self.log != other.log:
+            raise Exception('Cannot merge moments of log transformed and \
+not log transformed data.')
+        na, nb = self.ncells, other.ncells
+        n = na+nb
+        a, b = self.stats, other.stats
+        ret = a.copy()
+        for scale in ('', '_lin'):
+            delta = b['mean'+scale]-a['mean'+scale]
+            ret['mean'+scale] = a['mean'+scale]+delta*nb/n
+            ret['m2'+scale] = a['m2'+scale]+b['m2'+scale]+delta**2*na*nb/n
+        ret['detected'] = a['detected']+b['detected']
+        self.stats = ret
+        self.ncells = n
+        return self
+
+    def mean(self, linear=False):
+        """Mean of every gene
+
+        Parameters
+        ----------
+        linear : `bool`
+            On the linear scale. Default: False
+
+        Returns
+        -------
+        :class:`pandas.Series`
+            Means.
+        """
+        return self.stats['mean_lin' if linear else 'mean']
+
+    def var(self, linear=False, ddof=1):
+        """Variance of every gene
+
+        Parameters
+        ----------
+        linear : `bool`
+            On the linear scale. Default: False
+        ddof : `int`
+            Delta degrees of freedom. Default: 1
+
+        Returns
+        -------
+        :class:`pandas.Series`
+            Variances.
+        """
+        return self.stats['m2_lin' if linear else 'm2']/(self.ncells-ddof)
+
+    def std(self, linear=False, ddof=1):
+        """ Standard deviation of every gene, see :py:meth:`var`. """
+        return np.sqrt(self.var(linear, ddof))
+
+    def detected(self):
+        """ Fraction of cells with a value above zero for every gene. """
+        return self.stats['detected']/self.ncells
@@ -21,6 +21,7 @@ import pandas as pd
 import numpy as np
 
 from ._stats import p_adjust_bh
+from .data import lazy_norm
 
 
 def filter(obj, normalization=None, clust_alg=None, thres=0.01, frac=0.8,
@@ -87,8 +88,12 @@ def filter(obj, normalization=None, clust_alg=None, thres=0.01, frac=0.8,
     res = []
 
     for c in np.unique(ct.cluster):
-        X_ss = X.loc[:, cl == c]
-        X_ss = X_ss.loc[ct[ct.cluster == c].gene, :]
+        if isinstance(X, lazy_norm):
+            X_ss = X.block(rows=ct[ct.cluster == c].gene.values,
+                           cols=(cl == c).values)
+        else:
+            X_ss = X.loc[:, cl == c]
+            X_ss = X_ss.loc[ct[ct.cluster == c].gene, :]
         r = (X_ss > 0).sum(axis=1)
         g = r[r > X_ss.shape[1]*frac]
         z = ct[np.logical_and(ct.cluster == c, ct.gene.isin(g.index))]
@@ -231,7 +236,8 @@ def _choose_leftright_pvalues(left, right, direction):
 
 
 def linear_model(obj, normalization=(), clustering=(), direction='up',
-                 target_clusters=None, min_cluster_size=10, verbose=False):
+                 target_clusters=None, min_cluster_size=10, block_size=2000,
+                 verbose=False):
     """Performs differential expression analysis between clusters
     using a linear model and t-statistics
 
@@ -268,6 +274,9 @@ def linear_model(obj, normalization=(), clustering=(), direction='up',
     min_cluster_size : `int`
         Minimum number of cells per cluster (clusters smaller than
         this are ignored).  Default: 10
+    block_size : `int`
+        Number of genes to fit at a time when the normalization is
+        lazy (see :func:`adobo.normalize.norm`). Default: 2000
     verbose : `bool`
         Be verbose or not. Default: False
 
@@ -301,7 +310,10 @@ def linear_model(obj, normalization=(), clustering=(), direction='up',
             print('Running differential expression analysis on prediction on \
 the %s normalization' % k)
         item = targets[k]
-        X = item['data'].transpose()
+        X = item['data']
+        lazy = isinstance(X, lazy_norm)
+        if not lazy:
+            X = X.transpose()
         clusters = item['clusters']
         for algo in clusters:
             if len(clustering) == 0 or algo in clustering:
@@ -310,41 +322,57 @@ the %s normalization' % k)
                 # remove clusters with too few cells
                 q = pd.Series(cl).value_counts()
                 cl_remove = q[q < min_cluster_size].index
-                X_f = X.loc[np.logical_not(cl.isin(cl_remove)).values, :]
+                keep = np.logical_not(cl.isin(cl_remove)).values
                 cl = cl[np.logical_not(cl.isin(cl_remove))]
 
                 if target_clusters:
-                    X_f = X_f.loc[cl.isin(target_clusters), :]
+                    keep[keep] = cl.isin(target_clusters).values
                     cl = cl[cl.isin(target_clusters)]
 
                 # full design matrix
                 dm_full = patsy.dmatrix('~ 0 + C(cl)',
                                         pd.DataFrame({'cl': cl}))
                 resid_df = dm_full.shape[0] - dm_full.shape[1]
-
-                # gene expression should be the response
-                lm = sm.regression.linear_model.OLS(endog=X_f,  # response
-                                                    exog=dm_full)
-                res = lm.fit()
-                coef = res.params  # coefficients
-
-                # computing standard errors
-                # https://stats.stackexchange.com/questions/44838/how-are-the-standard-errors-of-coefficients-calculated-in-a-regression
-                # http://web.mit.edu/~r/current/arch/i386_linux26/lib/R/library/limma/html/lm.series.html
-                # residual variance for each gene
                 dm_nrow, dm_ncol = dm_full.shape
-                sigma2 = ((X_f-dm_full.dot(coef))**2).sum(axis=0) / \
-                    (dm_nrow-dm_ncol)
+                clusts = np.unique(cl)
+
+                if lazy:
+                    # genes are independent responses, so the model is
+                    # fitted on blocks of genes computed on demand
+                    blocks = (b.transpose() for b in X.iter_rows(
+                        block_size, cols=keep, sparse=False))
+                else:
+                    blocks = [X.loc[keep, :]]
+                coef = []
+                sigma2 = []
+                mge = []
+                for X_f in blocks:
+                    # gene expression should be the response
+                    lm = sm.regression.linear_model.OLS(endog=X_f,  # response
+                                                        exog=dm_full)
+                    res = lm.fit()
+                    coef.append(res.params)  # coefficients
+
+                    # computing standard errors
+                    # https://stats.stackexchange.com/questions/44838/how-are-the-standard-errors-of-coefficients-calculated-in-a-regression
+                    # http://web.mit.edu/~r/current/arch/i386_linux26/lib/R/library/limma/html/lm.series.html
+                    # residual variance for each gene
+                    sigma2.append(((X_f-dm_full.dot(res.params))**2).sum(axis=0) /
+                                  (dm_nrow-dm_ncol))
+
+                    # mean gene expression for every gene in every cluster
+                    mge.append([X_f.loc[(cl == o).values, :].mean()
+                                for o in clusts])
+                coef = pd.concat(coef, axis=1)
+                sigma2 = pd.concat(sigma2)
+                mge = [pd.concat(m) for m in zip(*mge)]
+                genes = coef.columns
 
                 q = dm_full.transpose().dot(dm_full)
                 chol = np.linalg.cholesky(q)
                 v = (chol, False)
                 chol2inv = scipy.linalg.cho_solve(v, np.eye(chol.shape[0]))
                 std_dev = np.sqrt(np.diag(chol2inv))
-                clusts = np.unique(cl)
-
-                # mean gene expression for every gene in every cluster
-                mge = [X_f.loc[(cl == o).values, :].mean() for o in clusts]
 
                 # perform all pairwise comparisons of clusters (t-tests)
                 comparisons = []
@@ -399,14 +427,14 @@ the %s normalization' % k)
 
                 out_merged = pd.concat(out_pv, axis=1)
                 out_merged.columns = comparisons
-                out_merged.index = X_f.columns
+                out_merged.index = genes
                 pval = pd.concat(out_pv, ignore_index=True)
                 lab1 = []
                 lab2 = []
 
                 for q in comparisons:
-                    lab1.append(pd.Series([q]*X_f.columns.shape[0]))
-                    lab2.append(pd.Series(X_f.columns))
+                    lab1.append(pd.Series([q]*genes.shape[0]))
+                    lab2.append(pd.Series(genes))
 
                 ll = pd.DataFrame({'comparison_A_vs_B': pd.concat(lab1,
                                                                   ignore_index=True),
@@ -426,8 +454,12 @@ def _wilcox_worker(cc1, cc2, cl, X, verbose):
     wilcox() for apply_async to work."""
     if verbose:
         print('Working on cluster %s vs %s' % (cc1, cc2))
-    X_ss1 = X.iloc[:, (cl == cc1).values]
-    X_ss2 = X.iloc[:, (cl == cc2).values]
+    if isinstance(X, lazy_norm):
+        X_ss1 = X.cols((cl == cc1).values)
+        X_ss2 = X.cols((cl == cc2).values)
+    else:
+        X_ss1 = X.iloc[:, (cl == cc1).values]
+        X_ss2 = X.iloc[:, (cl == cc2).values]
     z = zip(X_ss1.iterrows(), X_ss2.iterrows())
     pvs = []
     for d in z:
@@ -10,22 +10,27 @@ Functions for dimensional reduction.
 """
 import sys
 import time
-from random import sample
+from multiprocessing import Pool, shared_memory
 import pandas as pd
 import numpy as np
 import scipy.linalg
+from scipy.sparse import issparse
+from scipy.sparse.linalg import LinearOperator
 from scipy.stats import chi2_contingency
 from sklearn.preprocessing import scale as sklearn_scale
+from sklearn.cluster import KMeans
 import sklearn.manifold
 import umap as um
 import igraph as ig
 from fa2 import ForceAtlas2
-from tqdm import tqdm
 import patsy
+import psutil
 
 from . import irlbpy
 from ._log import warning
 from ._stats import p_adjust_bh
+from ._sparse import dense_blocks, dense_col_blocks, is_sparse_frame, to_csr
+from .data import lazy_norm
 
 
 def force_graph(obj, name=(), iterations=1000,
@@ -107,7 +112,57 @@ def force_graph(obj, name=(), iterations=1000,
     obj.set_assay(sys._getframe().f_code.co_name)
 
 
-def irlb(data_norm, scale=True, ncomp=75, var_weigh=True, seed=None):
+def _center_scale(data_norm, genes=None, block_size=10000):
+    """Means and standard deviations of the genes (rows) of
+    `data_norm`, restricted to the boolean mask `genes`. Dense data are
+    read in blocks of cells. Zero variance genes are not scaled."""
+    if is_sparse_frame(data_norm):
+        mat = to_csr(data_norm, dtype=np.float64)
+        if genes is not None:
+            mat = mat[np.asarray(genes)]
+        center = np.asarray(mat.mean(axis=1)).ravel()
+        sq = np.asarray(mat.multiply(mat).mean(axis=1)).ravel()
+    else:
+        s1 = 0
+        s2 = 0
+        for _, _, block in dense_col_blocks(data_norm, block_size, genes):
+            s1 = s1+block.sum(axis=1)
+            s2 = s2+np.square(block).sum(axis=1)
+        center = s1/data_norm.shape[1]
+        sq = s2/data_norm.shape[1]
+    sd = np.sqrt(np.maximum(sq-center**2, 0))
+    sd[sd == 0] = 1
+    return center, sd
+
+
+def _pca_input(data_norm, scale, dtype=np.float64, center=None, sd=None):
+    """Cells x genes matrix (CSR if the input is sparse) with the
+    column means and standard deviations for implicit scaling, computed
+    unless given."""
+    # cells as rows and genes as columns
+    if is_sparse_frame(data_norm):
+        inp = to_csr(data_norm, dtype=dtype).T.tocsr()
+    else:
+        inp = np.asarray(data_norm, dtype=dtype).T
+    if not scale:
+        return inp, None, None
+    if center is None:
+        # column (gene) means and standard deviations, zero variance
+        # genes are not scaled (as in sklearn.preprocessing.scale)
+        if issparse(inp):
+            center = np.asarray(inp.mean(axis=0, dtype=np.float64)).ravel()
+            sq = np.asarray(inp.multiply(inp).mean(axis=0,
+                                                   dtype=np.float64)).ravel()
+            sd = np.sqrt(np.maximum(sq-center**2, 0))
+        else:
+            center = inp.mean(axis=0, dtype=np.float64)
+            sd = inp.std(axis=0, dtype=np.float64)
+        sd[sd == 0] = 1
+    return inp, np.asarray(center, dtype=dtype), np.asarray(sd, dtype=dtype)
+
+
+def irlb(data_norm, scale=True, ncomp=75, var_weigh=True, seed=None,
+         center=None, sd=None):
     """Truncated SVD by implicitly restarted Lanczos bidiagonalization
 
     Notes
@@ -117,12 +172,15 @@ def irlb(data_norm, scale=True, ncomp=75, var_weigh=True, seed=None):
     and corresponding singular vectors using a method of Baglama and
     Reichel.
 
-    Cells should be rows and genes as columns.
+    Centering and scaling are applied implicitly in the matrix-vector
+    products, so sparse input stays sparse and memory use is
+    proportional to the number of non-zero values.
 
     Parameters
     ----------
     data_norm : :py:class:`pandas.DataFrame`
-        A pandas data frame containing normalized gene expression data.
+        A pandas data frame containing normalized gene expression data
+        (rows=genes, columns=cells).
     scale : `bool`
         Scales input data prior to PCA. Default: True
     ncomp : `int`
@@ -131,6 +189,12 @@ def irlb(data_norm, scale=True, ncomp=75, var_weigh=True, seed=None):
         Weigh by the variance of each component. Default: True
     seed : `int`
         For reproducibility. Default: None
+    center : :class:`numpy.ndarray`
+        Gene means used for centering if `scale` is True. Computed from
+        `data_norm` together with `sd` if None. Default: None
+    sd : :class:`numpy.ndarray`
+        Gene standard deviations used for scaling if `scale` is
+        True. Default: None
 
     References
     ----------
@@ -148,27 +212,197 @@ def irlb(data_norm, scale=True, ncomp=75, var_weigh=True, seed=None):
         A py:class:`pandas.DataFrame` containing the contributions of
         every gene (rows).
     """
-    inp = data_norm
-    idx = inp.index
-    cols = inp.columns
-    inp = inp.transpose()
-    if scale:
-        inp = sklearn_scale(inp.sparse.to_dense(),  # cells as rows and genes as columns
-                            # over genes, i.e. features (columns)
-                            axis=0,
-                            with_mean=True,   # subtracting the column means
-                            with_std=True)    # scale the data to unit variance
-        inp = pd.DataFrame(inp, columns=idx, index=cols)
-    # cells should be rows and genes as columns
-    lanc = irlbpy.lanczos(inp, nval=ncomp, maxit=1000, seed=seed)
+    genes = data_norm.index
+    cells = data_norm.columns
+    inp, center, sd = _pca_input(data_norm, scale, np.float64, center, sd)
+    lanc = irlbpy.lanczos(inp, nval=ncomp, maxit=1000, center=center,
+                          scale=sd, seed=seed)
     if var_weigh:
         # weighing by variance
         comp = np.dot(lanc.U, np.diag(lanc.s))
     else:
         comp = lanc.U
-    comp = pd.DataFrame(comp, index=inp.index)
+    comp = pd.DataFrame(comp, index=cells)
+    # gene loadings
+    contr = pd.DataFrame(lanc.V, index=genes)
+    return comp, contr
+
+
+def randomized(data_norm, scale=True, ncomp=75, var_weigh=True, seed=None,
+               oversamples=10, n_iter=7, dtype=np.float32, center=None,
+               sd=None):
+    """Truncated SVD by randomized range finding
+
+    Notes
+    -----
+    A random projection of the data, refined by `n_iter` power
+    iterations, gives an orthonormal basis approximating the range of
+    the data. The SVD of the data projected on this small basis gives
+    the leading singular values and vectors.
+
+    Centering and scaling are applied implicitly in the matrix
+    products, so sparse input stays sparse. Computations are done in
+    single precision by default, which halves memory use and is
+    accurate enough for the leading components.
+
+    Parameters
+    ----------
+    data_norm : :py:class:`pandas.DataFrame`
+        A pandas data frame containing normalized gene expression data
+        (rows=genes, columns=cells).
+    scale : `bool`
+        Scales input data prior to PCA. Default: True
+    ncomp : `int`
+        Number of components to return. Default: 75
+    var_weigh : `bool`
+        Weigh by the variance of each component. Default: True
+    seed : `int`
+        For reproducibility. Default: None
+    oversamples : `int`
+        Number of random vectors in addition to `ncomp`, more improves
+        the accuracy of the last components. Default: 10
+    n_iter : `int`
+        Number of power iterations. Default: 7
+    dtype : `numpy.dtype`
+        Floating point type used in the computations. Default:
+        numpy.float32
+    center : :class:`numpy.ndarray`
+        Gene means used for centering if `scale` is True. Computed from
+        `data_norm` together with `sd` if None. Default: None
+    sd : :class:`numpy.ndarray`
+        Gene standard deviations used for scaling if `scale` is
+        True. Default: None
+
+    References
+    ----------
+    .. [1] Halko et al (2011) Finding structure with randomness:
+           Probabilistic algorithms for constructing approximate
+           matrix decompositions. SIAM Review
+
+    Returns
+    -------
+    `pd.DataFrame`
+        A py:class:`pandas.DataFrame` containing the components
+        (columns).
+    `pd.DataFrame`
+        A py:class:`pandas.DataFrame` containing the contributions of
+        every gene (rows).
+    """
+    genes = data_norm.index
+    cells = data_norm.columns
+    inp, center, sd = _pca_input(data_norm, scale, dtype, center, sd)
+    res = irlbpy.randomized_svd(inp, nval=ncomp, oversamples=oversamples,
+                                n_iter=n_iter, center=center, scale=sd,
+                                seed=seed)
+    if var_weigh:
+        comp = np.dot(res.U, np.diag(res.s))
+    else:
+        comp = res.U
+    comp = pd.DataFrame(comp, index=cells)
+    # gene loadings
+    contr = pd.DataFrame(res.V, index=genes)
+    return comp, contr
+
+
+def incremental(data_norm, scale=True, ncomp=75, var_weigh=True, genes=None,
+                block_size=10000, oversamples=10, center=None, sd=None,
+                verbose=False):
+    """Out-of-core PCA by incremental SVD over blocks of cells
+
+    Notes
+    -----
+    The data are read in blocks of `block_size` cells, so only one
+    block has to fit in memory. The data can be a
+    :class:`numpy.memmap` (for example the `out` array of
+    :py:func:`adobo.normalize.ComBat`), a data frame backed by one or a
+    :class:`adobo.data.lazy_norm`. The data are passed over three
+    times: the first pass computes gene means and standard deviations
+    (only if `scale` is True and `center` is not given), the second
+    pass updates a truncated SVD
+    with every block [1] and the third pass projects the cells on the
+    gene loadings.
+
+    Parameters
+    ----------
+    data_norm : :py:class:`pandas.DataFrame`, :class:`numpy.ndarray` or :class:`adobo.data.lazy_norm`
+        Normalized gene expression data (rows=genes, columns=cells).
+    scale : `bool`
+        Scales input data prior to PCA. Default: True
+    ncomp : `int`
+        Number of components to return. Default: 75
+    var_weigh : `bool`
+        Weigh by the variance of each component. Default: True
+    genes : :class:`numpy.ndarray`
+        Boolean mask of the genes (rows) to use. The genes are
+        selected block by block, so the subset is never copied in
+        full. Default: None (all genes)
+    block_size : `int`
+        Number of cells per block. Default: 10000
+    oversamples : `int`
+        Number of components kept in addition to `ncomp` between
+        updates, more improves the accuracy of the last
+        components. Default: 10
+    center : :class:`numpy.ndarray`
+        Means of the selected genes used for centering if `scale` is
+        True, instead of the first pass. Default: None
+    sd : :class:`numpy.ndarray`
+        Standard deviations of the selected genes used for scaling if
+        `scale` is True. Default: None
+    verbose : `bool`
+        Be noisy or not. Default: False
+
+    References
+    ----------
+    .. [1] Ross et al (2008) Incremental Learning for Robust Visual
+           Tracking. International Journal of Computer Vision
+
+    Returns
+    -------
+    `pd.DataFrame`
+        A py:class:`pandas.DataFrame` containing the components
+        (columns).
+    `pd.DataFrame`
+        A py:class:`pandas.DataFrame` containing the contributions of
+        every gene (rows).
+    """
+    ngenes, ncells = data_norm.shape
+    index = getattr(data_norm, 'index', pd.RangeIndex(ngenes))
+    cells = getattr(data_norm, 'columns', pd.RangeIndex(ncells))
+    if genes is not None:
+        genes = np.asarray(genes)
+        index = index[genes]
+        ngenes = len(index)
+    ncomp = min(ncomp, ngenes, ncells)
+    nkeep = min(ncomp+oversamples, ngenes, ncells)
+    if not scale:
+        center = np.zeros(ngenes)
+        sd = np.ones(ngenes)
+    elif center is None:
+        center, sd = _center_scale(data_norm, genes, block_size)
+
+    # truncated SVD of the cells seen so far, S * Vh
+    S = np.zeros(0)
+    Vh = np.zeros((0, ngenes))
+    for start, end, block in dense_col_blocks(data_norm, block_size, genes):
+        if verbose:
+            print('updating SVD with cells %s-%s' % (start, end))
+        X = (block.T-center)/sd
+        _, S, Vh = scipy.linalg.svd(np.vstack((S[:, None]*Vh, X)),
+                                    full_matrices=False, check_finite=False)
+        S = S[0:nkeep]
+        Vh = Vh[0:nkeep]
+    S = S[0:ncomp]
+    V = Vh[0:ncomp].T
+
+    comp = np.empty((ncells, ncomp))
+    for start, end, block in dense_col_blocks(data_norm, block_size, genes):
+        comp[start:end] = np.dot((block.T-center)/sd, V)
+    if not var_weigh:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            comp = np.nan_to_num(comp/S)
+    comp = pd.DataFrame(comp, index=cells)
     # gene loadings
-    contr = pd.DataFrame(lanc.V, index=inp.columns)
+    contr = pd.DataFrame(V, index=index)
     return comp, contr
 
 
@@ -247,8 +481,12 @@ def pca(obj, method='irlb', normalization=None, ncomp=75, genes='hvg',
     ----------
     obj : :class:`adobo.data.dataset`
           A dataset class object.
-    method : `{'irlb', 'svd'}`
-        Method to use for PCA. This does not matter much. Default: irlb
+    method : `{'irlb', 'svd', 'randomized', 'incremental'}`
+        Method to use for PCA. This does not matter much, but
+        'randomized' is the fastest on large data sets and
+        'incremental' reads the data in blocks of cells, for data sets
+        that do not fit in memory (see
+        :py:func:`adobo.dr.incremental`). Default: irlb
     normalization : `str`
         The name of the normalization to operate on. If this is empty
         or None then the function will be applied on all
@@ -269,7 +507,7 @@ def pca(obj, method='irlb', normalization=None, ncomp=75, genes='hvg',
     verbose : `bool`
         Be noisy or not. Default: False
     seed : `int`
-        For reproducibility (only irlb). Default: 42
+        For reproducibility (irlb and randomized). Default: 42
 
     References
     ----------
@@ -279,13 +517,21 @@ def pca(obj, method='irlb', normalization=None, ncomp=75, genes='hvg',
            Computing
     .. [3] https://github.com/bwlewis/irlbpy
     .. [4] https://tinyurl.com/yyt6df5x
+    .. [5] Halko et al (2011) Finding structure with randomness:
+           Probabilistic algorithms for constructing approximate
+           matrix decompositions. SIAM Review
+    .. [6] Ross et al (2008) Incremental Learning for Robust Visual
+           Tracking. International Journal of Computer Vision
 
     Returns
     -------
     None
         Modifies the passed object. Results are stored in two
         dictonaries in the passed object: `dr` (containing the components)
-       and `dr_gene_contr` (containing gene loadings).
+       and `dr_gene_contr` (containing gene loadings). The gene means
+       and standard deviations used for scaling ('center', 'scale')
+       and the singular values ('s') are stored with the components,
+       so new cells can be projected with :py:func:`adobo.dr.project`.
     """
     if not obj.norm_data:
         raise Exception('Run normalization first before running pca. See here: \
@@ -311,37 +557,359 @@ https://oscar-franzen.github.io/adobo/adobo.html#adobo.normalize.norm')
                 print('Using data from ComBat.')
             data = item['combat']
         
+        keep = None
         if isinstance(genes, str) and genes == 'hvg':
             try:
                 hvg = item['hvg']['genes']
             except KeyError:
                 raise Exception('Run adobo.dr.find_hvg() first.')
-            data = data[data.index.isin(hvg)]
+            keep = data.index.isin(hvg)
         elif isinstance(genes, list):
-            data = data[data.index.isin(genes)]
+            keep = data.index.isin(genes)
+        ngenes = data.shape[0] if keep is None else np.sum(keep)
+        if method == 'incremental':
+            # genes are selected in every block of cells
+            pass
+        elif isinstance(data, lazy_norm):
+            # only the selected genes are computed
+            data = data.rows(keep)
+        elif keep is not None:
+            data = data[keep]
+        center = None
+        sd = None
+        if scale:
+            # centering and scaling parameters of the selected genes,
+            # shared with the PCA method and kept for dr.project
+            center, sd = _center_scale(
+                data, keep if method == 'incremental' else None)
         if verbose:
             v = (method, k, '{:,}'.format(
-                data.shape[0]), '{:,}'.format(data.shape[1]))
+                ngenes), '{:,}'.format(data.shape[1]))
             print('Running PCA (method=%s) on the %s normalization (dimensions \
 %s genes x %s cells)' % v)
+        # components are weighed below, so the singular values are
+        # known for every method
         if method == 'irlb':
-            comp, contr = irlb(data, scale, ncomp, var_weigh, seed)
+            comp, contr = irlb(data, scale, ncomp, True, seed, center, sd)
         elif method == 'svd':
             comp, contr = svd(data, scale, ncomp)
+        elif method == 'randomized':
+            comp, contr = randomized(data, scale, ncomp, True, seed,
+                                     center=center, sd=sd)
+        elif method == 'incremental':
+            comp, contr = incremental(data, scale, ncomp, True, keep,
+                                      center=center, sd=sd)
         else:
-            raise Exception(
-                'Unkown PCA method spefified. Valid choices are: irlb and svd')
+            raise Exception('Unkown PCA method spefified. Valid choices are: \
+irlb, svd, randomized and incremental')
+        sv = np.linalg.norm(comp.values, axis=0)
+        # svd always returns weighed components
+        weigh = var_weigh or method == 'svd'
+        if not weigh:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                comp = pd.DataFrame(np.nan_to_num(comp.values/sv),
+                                    index=comp.index)
+        if scale:
+            center = pd.Series(center, index=contr.index)
+            sd = pd.Series(sd, index=contr.index)
         comp.index = data.columns
         obj.norm_data[k]['dr']['pca'] = {'comp': comp,
                                          'contr': contr,
-                                         'method': method}
+                                         'method': method,
+                                         'center': center,
+                                         'scale': sd,
+                                         's': sv,
+                                         'var_weigh': weigh}
         if verbose:
             print('saving %s components' % ncomp)
         obj.set_assay(sys._getframe().f_code.co_name, method)
 
 
+
+def project(obj, data_norm, normalization=None, verbose=False):
+    """Projects new cells into the principal components of a dataset
+
+    Notes
+    -----
+    The new cells are centered and scaled with the gene means and
+    standard deviations of the cells the PCA was computed on and
+    multiplied with the gene loadings, in one (sparse) matrix
+    product. The PCA is not recomputed, so the coordinates of the new
+    cells are directly comparable with the stored components, for
+    example for transferring labels with
+    :py:func:`adobo.clustering.transfer_labels`.
+
+    The new cells must be normalized in the same way as the cells of
+    `obj`. Genes are matched by name; genes of the PCA which are
+    missing in the new data are taken as zero.
+
+    Parameters
+    ----------
+    obj : :class:`adobo.data.dataset`
+        A dataset class object with a PCA, see
+        :py:func:`adobo.dr.pca`.
+    data_norm : :class:`pandas.DataFrame` or :class:`adobo.data.lazy_norm`
+        Normalized gene expression data of the new cells (rows=genes,
+        columns=cells).
+    normalization : `str`
+        The name of the normalization with the PCA. Can be None if
+        there is only one normalization. Default: None
+    verbose : `bool`
+        Be noisy or not. Default: False
+
+    Returns
+    -------
+    :class:`pandas.DataFrame`
+        Components of the new cells (rows=cells, columns=components).
+    """
+    if normalization is None or normalization == '':
+        if len(obj.norm_data) != 1:
+            raise Exception('Specify the normalization with the PCA.')
+        normalization = list(obj.norm_data)[0]
+    try:
+        res = obj.norm_data[normalization]['dr']['pca']
+    except KeyError:
+        raise Exception('Run adobo.dr.pca() first.')
+    if not 'center' in res:
+        raise Exception('The PCA was computed with an older version of \
+adobo, run adobo.dr.pca() again.')
+    contr = res['contr']
+    pos = pd.Index(data_norm.index).get_indexer(contr.index)
+    present = pos >= 0
+    if not np.all(present):
+        warning('%s of %s genes of the PCA are missing in the new data, \
+these are taken as zero.' % (np.sum(~present), len(present)))
+    if isinstance(data_norm, lazy_norm):
+        data = data_norm.rows(pos[present])
+    else:
+        data = data_norm.iloc[pos[present]]
+    if verbose:
+        print('Projecting %s cells on %s components' % (
+            '{:,}'.format(data.shape[1]), contr.shape[1]))
+    inp = _pca_input(data, False)[0]
+    # fold centering, scaling and weighing into the loadings
+    W = contr.values
+    offset = np.zeros(W.shape[1])
+    if res['scale'] is not None:
+        W = W/res['scale'].values[:, None]
+        offset = np.dot(res['center'].values, W)
+    if not res['var_weigh']:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            W = np.nan_to_num(W/res['s'])
+            offset = np.nan_to_num(offset/res['s'])
+    comp = inp.dot(W[present])-offset
+    return pd.DataFrame(comp, index=data.columns)
+
+def _harmony_objective(R, dist, O, E, Phi, sigma, theta):
+    """Objective function of the Harmony clustering."""
+    kmeans_error = np.sum(R*dist)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = np.nansum(R*np.log(R))*sigma
+    cross_entropy = sigma*np.sum(R*np.dot(theta*np.log((O+1)/(E+1)), Phi))
+    return kmeans_error+entropy+cross_entropy
+
+
+def _harmony_cluster(Z_cos, Y, R, Phi, Pr_b, sigma, theta, block_size,
+                     max_iter, epsilon, rng):
+    """Soft k-means clustering with a diversity penalty, updating
+    cluster assignments in random blocks of cells."""
+    N = Z_cos.shape[1]
+    nblocks = max(1, int(np.ceil(1/block_size)))
+    E = np.outer(R.sum(axis=1), Pr_b)
+    O = np.dot(R, Phi.T)
+    objective = []
+    for i in range(max_iter):
+        # update the centroids
+        Y = np.dot(Z_cos, R.T)
+        Y /= np.linalg.norm(Y, axis=0)
+        dist = 2*(1-np.dot(Y.T, Z_cos))
+        scale_dist = -dist/sigma
+        scale_dist -= scale_dist.max(axis=0)
+        scale_dist = np.exp(scale_dist)
+        # update the assignments, one block of cells at a time
+        for b in np.array_split(rng.permutation(N), nblocks):
+            E -= np.outer(R[:, b].sum(axis=1), Pr_b)
+            O -= np.dot(R[:, b], Phi[:, b].T)
+            R[:, b] = scale_dist[:, b]*np.dot(((E+1)/(O+1))**theta, Phi[:, b])
+            R[:, b] /= R[:, b].sum(axis=0)
+            E += np.outer(R[:, b].sum(axis=1), Pr_b)
+            O += np.dot(R[:, b], Phi[:, b].T)
+        objective.append(_harmony_objective(R, dist, O, E, Phi, sigma,
+                                            theta))
+        if i > 3:
+            old = sum(objective[-4:-1])
+            new = sum(objective[-3:])
+            if abs(old-new)/abs(old) < epsilon:
+                break
+    return Y, R, objective[-1]
+
+
+def harmony(obj, meta_cells_var, normalization=None, theta=2, sigma=0.1,
+            nclust=None, lamb=1, max_iter_harmony=10, max_iter_cluster=20,
+            block_size=0.05, epsilon_cluster=1e-5, epsilon_harmony=1e-4,
+            seed=42, verbose=False):
+    """Integrates batches by correcting the PCA embedding with the
+    Harmony algorithm
+
+    Notes
+    -----
+    Cells are softly clustered in PCA space while favouring clusters
+    with cells from every batch. Within every cluster, batch specific
+    offsets are estimated with a ridge regression and removed from the
+    embedding. Clustering and correction are repeated until
+    convergence. Only the components are used, so the cost scales
+    with the number of cells and components rather than with the
+    number of genes.
+
+    The corrected components are stored as the reduction 'harmony',
+    which can be used by :func:`adobo.clustering.generate`,
+    :func:`adobo.dr.tsne` and :func:`adobo.dr.umap` by setting
+    `reduction='harmony'`.
+
+    Commands should run in this order:
+    >>> exp.add_meta_data(axis='cells', key='batch', data=batch_vector)
+    >>> ad.dr.pca(exp)
+    >>> ad.dr.harmony(exp, meta_cells_var='batch')
+    >>> ad.clustering.generate(exp, reduction='harmony')
+    >>> ad.dr.umap(exp, reduction='harmony')
+
+    Parameters
+    ----------
+    obj : :class:`adobo.data.dataset`
+          A dataset class object.
+    meta_cells_var : `str` or `list`
+        Meta data variable(s) containing the batches. Should be column
+        name(s) in :py:attr:`data.dataset.meta_cells`.
+    normalization : `str`
+        The name of the normalization to operate on. If this is empty
+        or None then the function will be applied on all
+        normalizations available.
+    theta : `float` or `list`
+        Diversity penalty, one value per variable in
+        `meta_cells_var`. Higher values give more mixing of
+        batches. Default: 2
+    sigma : `float`
+        Width of the soft clustering. Default: 0.1
+    nclust : `int`
+        Number of clusters. If None, the number of cells divided by 30
+        but at most 100. Default: None
+    lamb : `float`
+        Ridge regression penalty. Default: 1
+    max_iter_harmony : `int`
+        Maximum number of rounds of clustering and correction.
+        Default: 10
+    max_iter_cluster : `int`
+        Maximum number of iterations of the clustering. Default: 20
+    block_size : `float`
+        Fraction of cells to update at a time during clustering.
+        Default: 0.05
+    epsilon_cluster : `float`
+        Convergence tolerance of the clustering. Default: 1e-5
+    epsilon_harmony : `float`
+        Convergence tolerance of the correction. Default: 1e-4
+    seed : `int`
+        For reproducibility. Default: 42
+    verbose : `bool`
+        Be verbose or not. Default: False
+
+    References
+    ----------
+    .. [1] Korsunsky et al. (2019) Nat Met. Fast, sensitive and
+           accurate integration of single-cell data with Harmony
+    .. [2] https://github.com/slowkow/harmonypy
+
+    Returns
+    -------
+    Nothing. Modifies the passed object.
+    """
+    if not obj.norm_data:
+        raise Exception('Run normalization first before running harmony. See \
+here: https://oscar-franzen.github.io/adobo/adobo.html#adobo.normalize.norm')
+    if isinstance(meta_cells_var, str):
+        meta_cells_var = [meta_cells_var]
+    if np.isscalar(theta):
+        theta = [theta]*len(meta_cells_var)
+    if len(theta) != len(meta_cells_var):
+        raise Exception('"theta" should have one value per variable in \
+"meta_cells_var".')
+    targets = {}
+    if normalization is None or normalization == '':
+        targets = obj.norm_data
+    else:
+        targets[normalization] = obj.norm_data[normalization]
+    for k in targets:
+        item = targets[k]
+        try:
+            comp = item['dr']['pca']['comp']
+        except KeyError:
+            raise Exception('Run `adobo.dr.pca(...)` first.')
+        N = comp.shape[0]
+        # one-hot design of all batch variables (batches x cells)
+        Phi = []
+        theta_b = []
+        for var, th in zip(meta_cells_var, theta):
+            batch = obj.meta_cells.loc[:, var].reindex(comp.index)
+            if np.any(batch.isna()):
+                raise Exception('Batch is missing for some cells.')
+            batch = pd.Categorical(batch.values)
+            nb = len(batch.categories)
+            Phi.append(np.eye(nb)[:, batch.codes])
+            theta_b += [th]*nb
+        Phi = np.vstack(Phi)
+        theta_b = np.asarray(theta_b, dtype=float)
+        Pr_b = Phi.sum(axis=1)/N
+        K = nclust
+        if K is None:
+            K = int(min(np.round(N/30), 100))
+        if verbose:
+            print('Running harmony on the %s normalization (%s batches, %s \
+clusters)' % (k, Phi.shape[0], K))
+        Z_orig = comp.to_numpy(dtype=float).T
+        Z_cos = Z_orig/np.linalg.norm(Z_orig, axis=0)
+        # initial clusters
+        km = KMeans(n_clusters=K, init='k-means++', n_init=10, max_iter=25,
+                    random_state=seed).fit(Z_cos.T)
+        Y = km.cluster_centers_.T
+        Y /= np.linalg.norm(Y, axis=0)
+        R = -2*(1-np.dot(Y.T, Z_cos))/sigma
+        R = np.exp(R-R.max(axis=0))
+        R /= R.sum(axis=0)
+        rng = np.random.RandomState(seed)
+        # design with intercept; the intercept is not penalized
+        Phi_moe = np.vstack((np.ones(N), Phi))
+        lamb_mat = np.diag(np.concatenate(([0], [lamb]*Phi.shape[0])))
+        Z_corr = Z_orig
+        objective = []
+        for i in range(max_iter_harmony):
+            Y, R, o = _harmony_cluster(Z_cos, Y, R, Phi, Pr_b, sigma,
+                                       theta_b, block_size, max_iter_cluster,
+                                       epsilon_cluster, rng)
+            objective.append(o)
+            # mixture of experts correction
+            Z_corr = Z_orig.copy()
+            for j in range(K):
+                Phi_Rk = Phi_moe*R[j]
+                W = np.linalg.solve(np.dot(Phi_Rk, Phi_moe.T)+lamb_mat,
+                                    np.dot(Phi_Rk, Z_orig.T))
+                W[0] = 0
+                Z_corr -= np.dot(W.T, Phi_Rk)
+            Z_cos = Z_corr/np.linalg.norm(Z_corr, axis=0)
+            if verbose:
+                print('Iteration %s of %s' % (i+1, max_iter_harmony))
+            if i > 0 and (objective[-2]-objective[-1]) < \
+                    epsilon_harmony*abs(objective[-2]):
+                if verbose:
+                    print('Converged after %s iterations' % (i+1))
+                break
+        comp = pd.DataFrame(Z_corr.T, index=comp.index, columns=comp.columns)
+        obj.norm_data[k]['dr']['harmony'] = {'comp': comp,
+                                             'meta_cells_var': meta_cells_var,
+                                             'theta': theta}
+    obj.set_assay(sys._getframe().f_code.co_name)
+
+
 def tsne(obj, run_on_PCA=True, name=None, perplexity=30, n_iter=2000,
-         seed=None, verbose=False, **args):
+         seed=None, reduction='pca', verbose=False, **args):
     """Projects data to a two dimensional space using the tSNE
     algorithm.
 
@@ -373,6 +941,10 @@ def tsne(obj, run_on_PCA=True, name=None, perplexity=30, n_iter=2000,
         Number of iterations. Default: 2000
     seed : `int`
         For reproducibility. Default: None
+    reduction : `{'pca', 'harmony'}`
+        The components to run on when run_on_PCA is True. Use
+        'harmony' for components corrected with
+        :func:`adobo.dr.harmony`. Default: 'pca'
     verbose : `bool`
         Be verbose. Default: False
 
@@ -403,10 +975,10 @@ recommended.')
         if not run_on_PCA:
             X = item['data']
         else:
-            if len(item['dr']) == 0:
-                raise Exception('Run dimensionality reduction first, for exampe \
-adobo.dr.pca()')
-            X = item['dr']['pca']['comp']
+            try:
+                X = item['dr'][reduction]['comp']
+            except KeyError:
+                raise Exception('Run `adobo.dr.%s(...)` first.' % reduction)
         if verbose:
             print('Running tSNE (perplexity %s) on the %s normalization' %
                   (perplexity, k))
@@ -426,7 +998,8 @@ adobo.dr.pca()')
 
 def umap(obj, run_on_PCA=True, name=None, n_neighbors=15,
          distance='euclidean', n_epochs=None, learning_rate=1.0,
-         min_dist=0.1, spread=1.0, seed=None, verbose=False, **args):
+         min_dist=0.1, spread=1.0, seed=None, reduction='pca', verbose=False,
+         **args):
     """Projects data to a low-dimensional space using the Uniform
     Manifold Approximation and Projection (UMAP) algorithm
 
@@ -471,6 +1044,10 @@ def umap(obj, run_on_PCA=True, name=None, n_neighbors=15,
         The effective scale of embedded points. Default: 1.0
     seed : `int`
         For reproducibility. Default: None
+    reduction : `{'pca', 'harmony'}`
+        The components to run on when run_on_PCA is True. Use
+        'harmony' for components corrected with
+        :func:`adobo.dr.harmony`. Default: 'pca'
     verbose : `bool`
         Be verbose. Default: False
 
@@ -503,9 +1080,9 @@ not recommended.')
             X = item['data']
         else:
             try:
-                X = item['dr']['pca']['comp']
+                X = item['dr'][reduction]['comp']
             except KeyError:
-                raise Exception('Run `adobo.dr.pca(...)` first.')
+                raise Exception('Run `adobo.dr.%s(...)` first.' % reduction)
         if verbose:
             print('Running UMAP on the %s normalization' % k)
         reducer = um.UMAP(random_state=seed, verbose=verbose,
@@ -519,9 +1096,47 @@ not recommended.')
     obj.set_assay(sys._getframe().f_code.co_name)
 
 
+_jackstraw_data = None
+
+
+def _jackstraw_init(name, shape):
+    """Attaches a worker process to the scaled data in shared
+    memory."""
+    global _jackstraw_data
+    shm = shared_memory.SharedMemory(name=name)
+    X = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    # the reference keeps the shared memory mapped
+    _jackstraw_data = (X, shm)
+
+
+def _jackstraw_perm(seed, nperm, ncomp):
+    """Loadings of a random set of genes after permuting them across
+    cells."""
+    X = _jackstraw_data[0]
+    rng = np.random.RandomState(seed)
+    ncells, ngenes = X.shape
+    genes = rng.choice(ngenes, nperm, replace=False)
+    # every permuted gene (column) is shuffled independently
+    order = np.argsort(rng.rand(ncells, nperm), axis=0)
+    delta = X[:, genes][order, np.arange(nperm)]-X[:, genes]
+
+    def matmat(V):
+        return X.dot(V)+delta.dot(V[genes])
+
+    def rmatmat(U):
+        Z = X.T.dot(U)
+        Z[genes] += delta.T.dot(U)
+        return Z
+    # the permuted matrix is never formed
+    op = LinearOperator(X.shape, matvec=matmat, rmatvec=rmatmat,
+                        matmat=matmat, rmatmat=rmatmat, dtype=X.dtype)
+    res = irlbpy.lanczos(op, nval=ncomp, maxit=1000, seed=seed)
+    return np.abs(res.V[genes, 0:ncomp])
+
+
 def jackstraw(obj, normalization=None, permutations=500, ncomp=None,
               subset_frac_genes=0.05, score_thr=1e-03, fdr=0.01,
-              retx=True, verbose=False):
+              nworkers=1, seed=42, retx=True, verbose=False):
     """Determine the number of relevant PCA components.
 
     Notes
@@ -530,6 +1145,12 @@ def jackstraw(obj, normalization=None, permutations=500, ncomp=None,
     the original. The final output is a p-value for each component
     generated using a Chi-sq test.
 
+    The permuted data are never copied: the truncated SVD of every
+    permutation works on the scaled data plus the difference of the
+    permuted genes. Permutations can run in parallel with `nworkers`;
+    the scaled data are then placed in shared memory and are not
+    copied to the worker processes.
+
     Parameters
     ----------
     obj : :class:`adobo.data.dataset`
@@ -550,6 +1171,13 @@ def jackstraw(obj, normalization=None, permutations=500, ncomp=None,
         Threshold for significance. Default: 1e-05
     fdr : `float`
         Acceptable false discovery rate. Default: 0.01
+    nworkers : `int` or `{'auto'}`
+        If a string, then the only accepted value is 'auto', and the
+        number of worker processes will be the total number of
+        detected physical cores. If an integer then it specifies the
+        number of worker processes. Default: 1
+    seed : `int`
+        For reproducibility. Default: 42
     retx : `bool`
         In addition to also modifying the object, also return
         results. Default: True
@@ -573,7 +1201,13 @@ def jackstraw(obj, normalization=None, permutations=500, ncomp=None,
         generated from a Chi^2 test.  Can be used to select the number
         of components to include by examinng p-values.
     """
+    global _jackstraw_data
     start_time = time.time()
+    if type(nworkers) == str:
+        if nworkers == 'auto':
+            nworkers = psutil.cpu_count(logical=False)
+        else:
+            raise Exception('Invalid value for parameter "nworkers".')
     if normalization == None or normalization == '':
         norm = list(obj.norm_data.keys())[-1]
     else:
@@ -595,39 +1229,53 @@ components computed by adobo.dr.pca(...)')
         hvg = item['hvg']['genes']
     except KeyError:
         raise Exception('Run adobo.dr.find_hvg() first.')
-    X = X[X.index.isin(hvg)]
-    X_scaled = sklearn_scale(X.transpose(), axis=0, with_mean=True,
-                             with_std=True).transpose()
-    X_scaled = pd.DataFrame(X_scaled, index=X.index, columns=X.columns)
-
-    perm_loadings = []
-    for perm in np.arange(0, permutations):
+    keep = X.index.isin(hvg)
+    if isinstance(X, lazy_norm):
+        X = X.rows(keep)
+    else:
+        X = X[keep]
+    # cells as rows, scaled genes as columns
+    inp, center, sd = _pca_input(X, True)
+    if issparse(inp):
+        inp = inp.toarray()
+    X_scaled = (inp-center)/sd
+    del inp
+    nperm = int(round(X.shape[0]*subset_frac_genes))
+    seeds = np.random.RandomState(seed).randint(np.iinfo(np.int32).max,
+                                                size=permutations)
+    jobs = [(sd_, nperm, ncomp) for sd_ in seeds]
+    if nworkers > 1:
         if verbose:
-            print('random set %s ' % perm)
-        rand_genes = sample(list(X.index), round(X.shape[0]*subset_frac_genes))
-        X_cp = X_scaled.copy()
-        data_perm = X_cp.loc[rand_genes, :]
-        # permutate every row
-        data_perm = [np.random.permutation(_col)
-                     for g, _col in data_perm.iterrows()]
-        data_perm = pd.DataFrame(np.array(data_perm), index=rand_genes,
-                                 columns=X_cp.columns)
-        # put permutated data back into the original data
-        X_cp.loc[rand_genes, :] = data_perm
-        comp, contr = irlb(X_cp, scale=False, ncomp=ncomp)
-        pl = contr[contr.index.isin(rand_genes)].iloc[:, 0:ncomp]
-        pl = np.abs(pl)
-        perm_loadings.append(pl)
-    perm_loadings = pd.concat(perm_loadings, axis=0, ignore_index=True)
-    res = []
-    for i, pc in perm_loadings.iloc[:, 0:ncomp].transpose().iterrows():
-        real = loadings[i]
-        emp_p = [np.sum(pc > val)/len(pc) for g, val in real.iteritems()]
-        res.append(pd.Series(emp_p, name=i))
-    res = pd.concat(res, axis=1, ignore_index=True)
-    n = [q1+q2 for q1, q2 in zip(['PC']*res.shape[1],
-                                 res.columns.values.astype(str))]
-    res.columns = n
+            print('%s worker processes will be used' % nworkers)
+        shm = shared_memory.SharedMemory(create=True, size=X_scaled.nbytes)
+        try:
+            np.ndarray(X_scaled.shape, dtype=np.float64,
+                       buffer=shm.buf)[:] = X_scaled
+            with Pool(nworkers, initializer=_jackstraw_init,
+                      initargs=(shm.name, X_scaled.shape)) as pool:
+                perm_loadings = pool.starmap(_jackstraw_perm, jobs)
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        _jackstraw_data = (X_scaled, None)
+        try:
+            perm_loadings = []
+            for perm, job in enumerate(jobs):
+                if verbose:
+                    print('random set %s ' % perm)
+                perm_loadings.append(_jackstraw_perm(*job))
+        finally:
+            _jackstraw_data = None
+    perm_loadings = np.vstack(perm_loadings)
+    # empirical p-values: fraction of null loadings above the real ones
+    null = np.sort(perm_loadings, axis=0)
+    res = np.empty((loadings.shape[0], ncomp))
+    for i in range(ncomp):
+        res[:, i] = null.shape[0]-np.searchsorted(
+            null[:, i], loadings.values[:, i], side='right')
+    res = pd.DataFrame(res/null.shape[0], index=loadings.index,
+                       columns=['PC%s' % i for i in range(ncomp)])
     # generate one p-value per component
     final = []
     for i, pc in res.transpose().iterrows():
@@ -717,17 +1365,22 @@ def genes2scores(obj, normalization=None, genes=[], bins=25, ctrl=100,
         obj.add_meta_data('cells', metadata, scores, 'cont')
 
 
-def regress(obj, target_vars=[], normalization=None):
+def regress(obj, target_vars=[], normalization=None, block_size=1000,
+            verbose=False):
     """Regress out the effects of certain meta data variables.
 
     Notes
     -----
     This function can be used to remove known confounding variables
     such as ambient gene expression modules, cell cycle genes or known
-    experimental batches. It fits a linear model using numpy's least
-    square method (numpy.linalg.lstsq), predicts expression values
-    from the model and then extracts the residuals, which become the
-    new expression values.
+    experimental batches. It fits a linear model with intercept,
+    predicts expression values from the model and then extracts the
+    residuals, which become the new expression values.
+
+    The design matrix is the same for every gene, so it is factorized
+    once (QR decomposition with column pivoting) and the residuals are
+    obtained by projecting blocks of genes onto its orthogonal
+    complement. The result is stored as float32.
 
     Parameters
     ----------
@@ -739,6 +1392,10 @@ def regress(obj, target_vars=[], normalization=None):
         The name of the normalization to operate on. If this is empty
         or None then the function will be applied on the last
         normalization used.
+    block_size : `int`
+        Number of genes to process at a time. Default: 1000
+    verbose : `bool`
+        Be verbose or not. Default: False
 
     Returns
     -------
@@ -753,27 +1410,25 @@ def regress(obj, target_vars=[], normalization=None):
     else:
         norm = normalization
     item = obj.norm_data[norm]
-    X = item['data'].sparse.to_dense()
-    md = obj.meta_cells[target_vars]
-    md = md[md.index.isin(X.columns)]
-    cor = []
-    pbar = tqdm(total=X.shape[0])  # progress bar
-    for g, x in X.iterrows():
-        dm = md.copy()
-        dm['exp'] = x
-        formula = 'exp ~ ' + '+'.join(md.columns.values) + '+1'
-        outcome, predictors = patsy.dmatrices(formula, dm)
-        # fit a linear regression model with intercept
-        # the fitted model is: expression~covariates
-        # lstsq solves ax=b where 'a' are coefficients and b the responses
-        solution = np.linalg.lstsq(a=predictors, b=outcome)[0].ravel()
-        contrasts = np.array(predictors)
-        # predict the value and get the residual
-        residual = x-contrasts.dot(solution)
-        cor.append(residual)
-        pbar.update()
-    q = pd.concat(cor, axis=1).transpose()
+    X = item['data']
+    md = obj.meta_cells[target_vars].reindex(X.columns)
+    formula = '+'.join(md.columns.values) + '+1'
+    dm = np.asarray(patsy.dmatrix(formula, md, NA_action='raise'))
+    # orthonormal basis of the column space of the design matrix
+    Q, R, _ = scipy.linalg.qr(dm, mode='economic', pivoting=True)
+    d = np.abs(np.diag(R))
+    rank = np.sum(d > d[0]*max(dm.shape)*np.finfo(float).eps)
+    Q = Q[:, 0:rank]
+    if verbose:
+        print('Regressing out %s (%s covariates) from the %s normalization' %
+              (', '.join(target_vars), rank, norm))
+    q = np.empty(X.shape, dtype=np.float32)
+    for start, end, block in dense_blocks(X, block_size):
+        q[start:end] = block-np.dot(np.dot(block, Q), Q.T)
+    q = pd.DataFrame(q, index=X.index, columns=X.columns, copy=False)
     if obj.sparse:
-        q = q.astype(pd.SparseDtype("float64", 0))
+        q = q.astype(pd.SparseDtype("float32", 0))
     obj.norm_data[norm]['data'] = q
+    # cached gene moments are stale
+    obj.norm_data[norm].get('moments', {}).pop('data', None)
     obj.set_assay(sys._getframe().f_code.co_name)
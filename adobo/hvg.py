@@ -9,11 +9,12 @@ Summary
 Functions for detection of highly variable genes.
 """
 import sys
+from multiprocessing import Pool
+import psutil
 import pandas as pd
 import numpy as np
 
 import scipy.stats
-from scipy.stats import gaussian_kde
 from scipy.stats import norm
 from scipy.optimize import minimize
 
@@ -22,13 +23,14 @@ from sklearn.linear_model import LinearRegression
 
 from .glm.glm import GLM
 from .glm.families import Gamma
-from ._stats import p_adjust_bh
+from ._stats import p_adjust_bh, binned_kde
+from .data import gene_moments
 from ._log import warning
 
 import warnings
 warnings.filterwarnings("ignore")
 
-def seurat(data, ngenes=1000, num_bins=20):
+def seurat(data, ngenes=1000, num_bins=20, moments=None):
     """Retrieves a list of highly variable genes using Seurat's strategy
 
     Notes
@@ -40,12 +42,16 @@ def seurat(data, ngenes=1000, num_bins=20):
 
     Parameters
     ----------
-    obj : :class:`pandas.DataFrame`
+    obj : :class:`pandas.DataFrame` or :class:`adobo.data.lazy_norm`
         A pandas data frame object containing raw read counts (rows=genes, columns=cells).
     ngenes : `int`
         Number of top highly variable genes to return.
     num_bins : `int`
         Number of bins to use.
+    moments : :class:`adobo.data.gene_moments`
+        Precomputed gene moments of `data`. If given, `data` is not
+        read. They can be accumulated over blocks of cells, see
+        :class:`adobo.data.gene_moments`. Default: None
 
     References
     ----------
@@ -56,14 +62,19 @@ def seurat(data, ngenes=1000, num_bins=20):
     `list`
         A list containing highly variable genes.
     """
-    # number of bins
-    gene_mean = data.mean(axis=1)
+    if moments is None:
+        moments = gene_moments(data)
+    return _seurat(moments.mean(), moments.var(), ngenes, num_bins)
+
+def _seurat(gene_mean, gene_var, ngenes=1000, num_bins=20):
+    """Seurat's strategy applied on precomputed gene means and
+    variances, used by :func:`seurat`."""
+    dispersion = gene_var/gene_mean
     # equal width (not size) of bins
     bins = pd.cut(gene_mean, num_bins)
     ret = []
-    for _, sliced in data.groupby(bins):
-        dispersion = sliced.var(axis=1)/sliced.mean(axis=1)
-        zscores = (dispersion-dispersion.mean())/dispersion.std()
+    for _, sliced in dispersion.groupby(bins):
+        zscores = (sliced-sliced.mean())/sliced.std()
         ret.append(zscores)
     ret = pd.concat(ret)
     ret = ret.sort_values(ascending=False)
@@ -72,7 +83,7 @@ def seurat(data, ngenes=1000, num_bins=20):
     return ret
 
 def brennecke(data_norm, log, ercc=None, fdr=0.1, ngenes=1000,
-              minBiolDisp=0.5, verbose=False):
+              minBiolDisp=0.5, verbose=False, moments=None):
     """Implements the method of Brennecke et al. (2013) to identify highly variable genes
 
     Notes
@@ -87,7 +98,8 @@ def brennecke(data_norm, log, ercc=None, fdr=0.1, ngenes=1000,
     log : `bool`
         If normalized data were log transformed or not.
     ercc : :class:`pandas.DataFrame`
-        A pandas data frame containing normalized ercc spikes.
+        A pandas data frame containing normalized ercc spikes. If
+        None, the technical noise is fitted on all genes. Default: None
     fdr : `float`
         False Discovery Rate considered significant.
     minBiolDisp : `float`
@@ -96,6 +108,9 @@ def brennecke(data_norm, log, ercc=None, fdr=0.1, ngenes=1000,
         Number of top highly variable genes to return.
     verbose : `bool`
         Be verbose or not.
+    moments : :class:`adobo.data.gene_moments`
+        Precomputed gene moments of `data_norm`. If given, `data_norm`
+        is not read. Default: None
 
     References
     ----------
@@ -106,25 +121,25 @@ def brennecke(data_norm, log, ercc=None, fdr=0.1, ngenes=1000,
     `list`
         A list containing highly variable genes.
     """
-    if type(ercc) != None:
-        ercc = data_norm
-    if log:
-        data_norm = 2**data_norm-1
-        ercc = 2**ercc-1
-    ercc = ercc.dropna(axis=1, how='all')
+    if moments is None:
+        moments = gene_moments(data_norm, log)
+    if ercc is None:
+        ercc_moments = moments
+    else:
+        ercc_moments = gene_moments(ercc.dropna(axis=1, how='all'), log)
     # technical gene (spikes)
-    meansSp = ercc.mean(axis=1)
-    varsSp = ercc.var(axis=1)
+    meansSp = ercc_moments.mean(linear=True)
+    varsSp = ercc_moments.var(linear=True)
     cv2Sp = varsSp/meansSp**2
     # biological genes
-    meansGenes = data_norm.mean(axis=1)
-    varsGenes = data_norm.var(axis=1)
+    meansGenes = moments.mean(linear=True)
+    varsGenes = moments.var(linear=True)
     cv2Genes = varsGenes/meansGenes**2
     minMeanForFit = np.quantile(meansSp[cv2Sp > 0.3], 0.8)
     useForFit = meansSp >= minMeanForFit
     if np.sum(useForFit) < 20:
-        meansAll = data_norm.mean(axis=1).append(meansSp)
-        cv2All = cv2Genes.append(cv2Sp)
+        meansAll = pd.concat((meansGenes, meansSp))
+        cv2All = pd.concat((cv2Genes, cv2Sp))
         minMeanForFit = np.quantile(meansAll[cv2All > 0.3], 0.8)
         useForFit = meansSp >= minMeanForFit
         if verbose:
@@ -141,7 +156,7 @@ def brennecke(data_norm, log, ercc=None, fdr=0.1, ngenes=1000,
     a1 = gamma_model.coef_[1]
     psia1theta = a1
     minBiolDisp = minBiolDisp**2
-    m = ercc.shape[1]
+    m = ercc_moments.ncells
     cv2th = a0+minBiolDisp+a0*minBiolDisp
     testDenom = (meansGenes*psia1theta+(meansGenes**2)*cv2th)/(1+cv2th/m)
     p = 1-scipy.stats.chi2.cdf(varsGenes*(m-1)/testDenom, m-1)
@@ -154,7 +169,7 @@ def brennecke(data_norm, log, ercc=None, fdr=0.1, ngenes=1000,
     res = res.sort_values('pvalue')
     return np.array(res.head(ngenes)['gene'])
 
-def scran(data_norm, log, ngenes=1000, ercc=None):
+def scran(data_norm, log, ngenes=1000, ercc=None, moments=None):
     """This function implements the approach from the scran R package
 
     Notes
@@ -178,6 +193,9 @@ def scran(data_norm, log, ngenes=1000, ercc=None):
         A pandas data frame containing normalized ercc spikes.
     ngenes : `int`
         Number of top highly variable genes to return.
+    moments : :class:`adobo.data.gene_moments`
+        Precomputed gene moments of `data_norm`. If given, `data_norm`
+        is not read. Default: None
 
     References
     ----------
@@ -190,14 +208,13 @@ def scran(data_norm, log, ngenes=1000, ercc=None):
     `list`
         A list containing highly variable genes.
     """
-    if type(ercc) == None:
+    if ercc is None:
         raise Exception('adobo.hvg.scran requires ERCC spikes.')
-    if log:
-        data_norm = 2**data_norm-1
-        ercc = 2**ercc-1
-    ercc = ercc.dropna(axis=1, how='all')
-    means_tech = ercc.mean(axis=1)
-    vars_tech = ercc.var(axis=1)
+    if moments is None:
+        moments = gene_moments(data_norm, log)
+    ercc_moments = gene_moments(ercc.dropna(axis=1, how='all'), log)
+    means_tech = ercc_moments.mean(linear=True)
+    vars_tech = ercc_moments.var(linear=True)
     to_fit = np.log(vars_tech+1)
     arr = [list(item) for item in zip(*sorted(zip(means_tech, to_fit)))]
     x = arr[0]
@@ -212,15 +229,39 @@ def scran(data_norm, log, ngenes=1000, ercc=None):
     #plt.ylabel('var')
     #plt.show()
     # predict and remove technical variance
-    bio_means = data_norm.mean(axis=1)
+    bio_means = moments.mean(linear=True)
     vars_pred = pol_reg.predict(poly_reg.fit_transform(np.array(bio_means).reshape(-1, 1)))
-    vars_bio_total = data_norm.var(axis=1)
+    vars_bio_total = moments.var(linear=True)
     # biological variance component
     vars_bio_bio = vars_bio_total - vars_pred
     vars_bio_bio = vars_bio_bio.sort_values(ascending=False)
     return vars_bio_bio.head(ngenes).index.values
 
-def chen2016(data_norm, log, fdr=0.1, ngenes=1000):
+def _curve_dist(x, y, curve_x, curve_y, window=0.2, block_size=2000):
+    """Signed distance from every point to the nearest point of a
+    curve, searching the curve within +/- `window` on the x-axis,
+    used by :func:`chen2016`. Points above the curve are
+    positive. `curve_x` must be sorted."""
+    lo = np.searchsorted(curve_x, x - window)
+    hi = np.searchsorted(curve_x, x + window)
+    width = np.arange(np.max(hi - lo))
+    dist = np.empty(len(x))
+    for start in range(0, len(x), block_size):
+        b = slice(start, start+block_size)
+        cx = lo[b, None] + width
+        valid = cx < hi[b, None]
+        cx = np.minimum(cx, len(curve_x)-1)
+        tmp = np.sqrt((curve_x[cx] - x[b, None])**2 + (curve_y[cx] - y[b, None])**2)
+        tmp[np.logical_not(valid)] = np.inf
+        tx = np.argmin(tmp, axis=1)
+        nearest = cx[np.arange(cx.shape[0]), tx]
+        d = tmp[np.arange(cx.shape[0]), tx]
+        above = np.where(curve_x[nearest] > x[b], curve_y[nearest] <= y[b],
+                         curve_y[nearest] < y[b])
+        dist[b] = np.where(above, d, -d)
+    return dist
+
+def chen2016(data_norm, log, fdr=0.1, ngenes=1000, moments=None):
     """
     This function implements the approach from Chen (2016) to identify highly variable
     genes.
@@ -239,6 +280,9 @@ def chen2016(data_norm, log, fdr=0.1, ngenes=1000):
         False Discovery Rate considered significant.
     ngenes : `int`
         Number of top highly variable genes to return.
+    moments : :class:`adobo.data.gene_moments`
+        Precomputed gene moments of `data_norm`. If given, `data_norm`
+        is not read. Default: None
 
     References
     ----------
@@ -250,13 +294,12 @@ def chen2016(data_norm, log, fdr=0.1, ngenes=1000):
     `list`
         A list containing highly variable genes.
     """
-    if log:
-        data_norm = 2**data_norm-1
-    avg = data_norm.mean(axis=1)
-    norm_data = data_norm[avg > 0]
-    rows = data_norm.shape[0]
-    avg = data_norm.mean(axis=1)
-    std = data_norm.std(axis=1)
+    if moments is None:
+        moments = gene_moments(data_norm, log)
+    avg = moments.mean(linear=True)
+    genes = avg.index[avg > 0]
+    rows = len(avg)
+    std = moments.std(linear=True)
     cv = std / avg
     xdata = avg
     ydata = np.log10(cv)
@@ -270,11 +313,9 @@ def chen2016(data_norm, log, fdr=0.1, ngenes=1000):
         y = k*x+m
         return y
     xSeq = np.arange(min(np.log10(xdata)), max(np.log10(xdata)), 0.005)
-    def h(i):
-        a = np.log10(xdata) >= (xSeq[i] - 0.05)
-        b = np.log10(xdata) < (xSeq[i] + 0.05)
-        return np.sum((a & b))
-    gapNum = [h(i) for i in range(0, len(xSeq))]
+    # number of genes within +/- 0.05 of every grid point
+    lx = np.sort(np.log10(xdata))
+    gapNum = np.searchsorted(lx, xSeq + 0.05) - np.searchsorted(lx, xSeq - 0.05)
     cdx = np.nonzero(np.array(gapNum) > rows*0.005)[0]
     xSeq = 10 ** xSeq
     ySeq = predict(*res, np.log10(xSeq))
@@ -291,24 +332,9 @@ def chen2016(data_norm, log, fdr=0.1, ngenes=1000):
     ydataFit = reg.predict(np.log10(xSeq_all).reshape(-1, 1))
     logX = np.log10(xdata)
     logXseq = np.log10(xSeq_all)
-    cvDist = []
-    for i in range(0, len(logX)):
-        cx = np.nonzero((logXseq >= (logX[i] - 0.2)) & (logXseq < (logX[i] + 0.2)))[0]
-        tmp = np.sqrt((logXseq[cx] - logX[i])**2 + (ydataFit[cx] - ydata[i])**2)
-        tx = np.argmin(tmp)
-        if logXseq[cx[tx]] > logX[i]:
-            if ydataFit[cx[tx]] > ydata[i]:
-                cvDist.append(-1*tmp[tx])
-            else:
-                cvDist.append(tmp[tx])
-        elif logXseq[cx[tx]] <= logX[i]:
-            if ydataFit[cx[tx]] < ydata[i]:
-                cvDist.append(tmp[tx])
-            else:
-                cvDist.append(-1*tmp[tx])
-    cvDist = np.log(10**np.array(cvDist))
-    dor = gaussian_kde(cvDist)
-    dor_y = dor(cvDist)
+    cvDist = _curve_dist(np.asarray(logX), np.asarray(ydata), logXseq, ydataFit)
+    cvDist = np.log(10**cvDist)
+    dor_y = binned_kde(cvDist, cvDist)
     distMid = cvDist[np.argmax(dor_y)]
     dist2 = cvDist - distMid
     a = dist2[dist2 <= 0]
@@ -320,12 +346,12 @@ def chen2016(data_norm, log, fdr=0.1, ngenes=1000):
     distFit = norm.fit(tmpDist)
     pRaw = 1-norm.cdf(cvDist, loc=distFit[0], scale=distFit[1])
     pAdj = p_adjust_bh(pRaw)
-    res = pd.DataFrame({'gene': norm_data.index, 'pvalue' : pRaw, 'padj' : pAdj})
+    res = pd.DataFrame({'gene': genes, 'pvalue' : pRaw, 'padj' : pAdj})
     res = res.sort_values(by='pvalue')
     filt = res[res['padj'] < fdr]['gene']
     return np.array(filt.head(ngenes))
 
-def mm(data_norm, log, fdr=0.1, ngenes=1000):
+def mm(data_norm, log, fdr=0.1, ngenes=1000, moments=None):
     """
     This function implements the approach from Andrews (2018).
 
@@ -341,6 +367,10 @@ def mm(data_norm, log, fdr=0.1, ngenes=1000):
         False Discovery Rate considered significant.
     ngenes : `int`
         Number of top highly variable genes to return.
+    moments : :class:`adobo.data.gene_moments`
+        Precomputed gene moments of `data_norm`. If given, `data_norm`
+        is not read. They can be accumulated over blocks of cells, see
+        :class:`adobo.data.gene_moments`. Default: None
 
     References
     ----------
@@ -352,13 +382,13 @@ def mm(data_norm, log, fdr=0.1, ngenes=1000):
     `list`
         A list containing highly variable genes.
     """
-    if log:
-        data_norm = 2**data_norm-1
-    ncells = data_norm.shape[1]
-    gene_info_p = 1-np.sum(data_norm > 0, axis=1)/ncells
+    if moments is None:
+        moments = gene_moments(data_norm, log)
+    ncells = moments.ncells
+    gene_info_p = 1-moments.detected()
     gene_info_p_stderr = np.sqrt(gene_info_p*(1-gene_info_p)/ncells)
-    gene_info_s = data_norm.mean(axis=1)
-    gene_info_s_stderr = np.sqrt((np.mean(data_norm**2, axis=1)-gene_info_s**2)/ncells)
+    gene_info_s = moments.mean(linear=True)
+    gene_info_s_stderr = np.sqrt(moments.var(linear=True, ddof=0)/ncells)
     # maximum likelihood estimate of model parameters
     s = gene_info_s
     p = gene_info_p
@@ -393,14 +423,70 @@ def mm(data_norm, log, fdr=0.1, ngenes=1000):
     Z = (K_equiv_log - K_obs_log)/np.sqrt(K_equiv_err_log**2+K_err_log**2)
     pval = 1 - norm.cdf(Z)
     pval[always_detected] = 1
-    res = pd.DataFrame({'gene': data_norm.index, 'pvalue' : pval})
+    res = pd.DataFrame({'gene': moments.index, 'pvalue' : pval})
     res = res[np.logical_not(res.pvalue.isna())]
     res['padj'] = p_adjust_bh(res.pvalue)
     res = res.sort_values('pvalue')
     return res.head(ngenes)['gene']
 
+def _hvg_job(method, moments, log, ngenes, fdr, ercc, verbose=False):
+    """Runs one HVG method on precomputed gene moments, used by
+    :func:`find_hvg`."""
+    if method == 'seurat':
+        return seurat(None, ngenes, moments=moments)
+    elif method == 'brennecke':
+        return brennecke(None, log=log, ercc=ercc, fdr=fdr, ngenes=ngenes,
+                         minBiolDisp=0.5, verbose=verbose, moments=moments)
+    elif method == 'scran':
+        return scran(None, log, ngenes, ercc, moments=moments)
+    elif method == 'chen2016':
+        return chen2016(None, log, fdr, ngenes, moments=moments)
+    return mm(None, log, fdr, ngenes, moments=moments)
+
+def _merge_hvg(ranked, genes, ngenes, merge):
+    """Merges the rankings of highly variable genes found within
+    batches, used by :func:`find_hvg`.
+
+    Parameters
+    ----------
+    ranked : `dict`
+        Genes ordered by decreasing variability for every batch.
+    genes : :class:`pandas.Index`
+        All genes.
+    ngenes : `int`
+        Number of genes to select.
+    merge : `{'rank', 'frequency'}`
+        Order by median rank or by the number of batches where the
+        gene is among the top `ngenes`.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The selected genes.
+    :class:`pandas.DataFrame`
+        Rank of every gene within every batch (NaN if not ranked).
+    :class:`pandas.DataFrame`
+        Frequency and median rank of every ranked gene.
+    """
+    ranks = pd.DataFrame(np.nan, index=genes, columns=list(ranked))
+    for batch, l in ranked.items():
+        ranks.loc[list(l), batch] = np.arange(1, len(l)+1)
+    stats = pd.DataFrame({'frequency': (ranks <= ngenes).sum(axis=1),
+                          # genes that are not ranked in a batch come last
+                          'median_rank': ranks.fillna(ranks.count()+1).median(
+                              axis=1)})
+    stats = stats[ranks.notna().any(axis=1)]
+    if merge == 'rank':
+        stats = stats.sort_values(['median_rank', 'frequency'],
+                                  ascending=[True, False])
+    else:
+        stats = stats.sort_values(['frequency', 'median_rank'],
+                                  ascending=[False, True])
+    return stats.index.values[0:ngenes], ranks, stats
+
 def find_hvg(obj, method='seurat', normalization=None, ngenes=1000, fdr=0.1,
-             use_combat=False, verbose=False):
+             use_combat=False, meta_cells_var=None, merge='rank', nworkers=1,
+             verbose=False):
     """Finding highly variable genes
 
     Notes
@@ -410,6 +496,18 @@ def find_hvg(obj, method='seurat', normalization=None, ngenes=1000, fdr=0.1,
     
     The method 'brennecke' should not be applied on 'fqn' normalized data.
 
+    Gene means and variances are computed in one pass over the data
+    and cached in `norm_data[...]['moments']`, so running another
+    method on the same normalization does not read the data again.
+
+    If `meta_cells_var` is set, genes are ranked within every batch
+    and the rankings are merged. Genes are either ordered by their
+    median rank across batches or by the number of batches where they
+    are among the top `ngenes`. The per batch moments are computed in
+    one pass over the data, and the batches (and normalizations) can
+    be processed in parallel with `nworkers`. Per batch ranks are
+    stored in `norm_data[...]['hvg']['batches']`.
+
     Parameters
     ----------
     obj : :class:`adobo.data.dataset`
@@ -427,6 +525,18 @@ def find_hvg(obj, method='seurat', normalization=None, ngenes=1000, fdr=0.1,
         might be fewer than specified by `ngenes` because of FDR consideration.
     use_combat : `bool`
         Use combat-adjusted data. Default: False
+    meta_cells_var : `str`
+        Meta data variable containing batches. Should be a column name
+        in :py:attr:`data.dataset.meta_cells`. Default: None
+    merge : `{'rank', 'frequency'}`
+        How to merge the rankings of the batches, by median rank (ties
+        broken by frequency) or by frequency (ties broken by median
+        rank). Only used with `meta_cells_var`. Default: 'rank'
+    nworkers : `int` or `{'auto'}`
+        Number of worker processes, used when there is more than one
+        batch or normalization. 'auto' uses all physical cores. Any
+        other value than a positive integer or 'auto' raises a
+        ValueError. Default: 1
     verbose : `bool`
         Be verbose or not.
 
@@ -449,6 +559,16 @@ def find_hvg(obj, method='seurat', normalization=None, ngenes=1000, fdr=0.1,
     if not obj.norm_data:
         raise Exception('Run normalization first before running find_hvg. See here: \
 https://oscar-franzen.github.io/adobo/adobo.html#adobo.normalize.norm')
+    if not method in ('seurat', 'brennecke', 'scran', 'chen2016', 'mm'):
+        raise Exception('Unknown HVG method specified. Valid choices are: seurat, \
+brennecke, scran, chen2016 and mm')
+    if not merge in ('rank', 'frequency'):
+        raise Exception('"merge" can be "rank" or "frequency".')
+    if isinstance(nworkers, str) and nworkers == 'auto':
+        nworkers = psutil.cpu_count(logical=False)
+    elif isinstance(nworkers, bool) or \
+            not isinstance(nworkers, (int, np.integer)) or nworkers < 1:
+        raise ValueError('"nworkers" must be a positive integer or "auto".')
     targets = {}
     norm = normalization
     if norm is None or norm == '':
@@ -457,6 +577,9 @@ https://oscar-franzen.github.io/adobo/adobo.html#adobo.normalize.norm')
         targets[norm] = obj.norm_data[norm]
     # remove previous cluster analysis, b/c this changes after running hvg
     obj.delete(('clusters', 'dr'))
+    jobs = []
+    keys = []
+    batches = {}
     for k in targets:
         item = targets[k]
         if verbose:
@@ -469,19 +592,57 @@ https://oscar-franzen.github.io/adobo/adobo.html#adobo.normalize.norm')
             data = item['data']
         data_ercc = item.get('norm_ercc', None)
         log = item['log']
-        if method == 'seurat':
-            hvg = seurat(data, ngenes)
-        elif method == 'brennecke':
-            hvg = brennecke(data_norm=data, log=log, ercc=data_ercc, fdr=fdr,
-                            ngenes=ngenes, minBiolDisp=0.5, verbose=verbose)
-        elif method == 'scran':
-            hvg = scran(data, log, ngenes, data_ercc)
-        elif method == 'chen2016':
-            hvg = chen2016(data, log, fdr, ngenes)
-        elif method == 'mm':
-            hvg = mm(data, log, fdr, ngenes)
-        else:
-            raise Exception('Unknown HVG method specified. Valid choices are: seurat, \
-brennecke, scran, chen2016 and mm')
-        obj.norm_data[k]['hvg'] = {'genes' : hvg, 'method' : method}
+        # all methods only need per gene moments
+        cache = item.setdefault('moments', {}).setdefault(
+            'combat' if use_combat else 'data', {})
+        if meta_cells_var is None:
+            if not None in cache:
+                cache[None] = gene_moments(data, log)
+            jobs.append((method, cache[None], log, ngenes, fdr, data_ercc,
+                         verbose))
+            keys.append((k, None))
+            continue
+        batch = obj.meta_cells.loc[:, meta_cells_var].reindex(data.columns)
+        if np.any(batch.isna()):
+            raise Exception('Batch is missing for some cells.')
+        batch = batch.values
+        cached = cache.get(meta_cells_var)
+        if cached is None or not np.array_equal(cached[0], batch):
+            cached = (batch, gene_moments.split(data, batch, log))
+            cache[meta_cells_var] = cached
+        if verbose:
+            print('Ranking genes within %s batches' % len(cached[1]))
+        batches[k] = (data.index, pd.Series({b: m.ncells for b, m in
+                                             cached[1].items()}))
+        for b, moments in cached[1].items():
+            ercc = data_ercc
+            if isinstance(ercc, pd.DataFrame):
+                ercc = ercc.loc[:, batch == b]
+            # full rankings are merged
+            jobs.append((method, moments, log, data.shape[0], fdr, ercc,
+                         verbose))
+            keys.append((k, b))
+    if nworkers > 1 and len(jobs) > 1:
+        if verbose:
+            print('%s worker processes will be used' % min(nworkers, len(jobs)))
+        with Pool(min(nworkers, len(jobs))) as pool:
+            results = pool.starmap(_hvg_job, jobs)
+    else:
+        results = [_hvg_job(*job) for job in jobs]
+    ranked = {}
+    for (k, b), hvg in zip(keys, results):
+        ranked.setdefault(k, {})[b] = hvg
+    for k in ranked:
+        if meta_cells_var is None:
+            obj.norm_data[k]['hvg'] = {'genes' : ranked[k][None],
+                                       'method' : method}
+            continue
+        genes, ncells = batches[k]
+        hvg, ranks, stats = _merge_hvg(ranked[k], genes, ngenes, merge)
+        obj.norm_data[k]['hvg'] = {'genes' : hvg, 'method' : method,
+                                   'batches' : {'meta_cells_var' : meta_cells_var,
+                                                'merge' : merge,
+                                                'ncells' : ncells,
+                                                'ranks' : ranks,
+                                                'stats' : stats}}
     obj.set_assay(sys._getframe().f_code.co_name, method)
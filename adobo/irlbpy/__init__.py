@@ -1 +1 @@
-from .irlb import lanczos, orthog
+from .irlb import lanczos, randomized_svd, orthog
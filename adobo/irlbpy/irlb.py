@@ -11,7 +11,7 @@ https://github.com/bwlewis/irlbpy
 Credits to the authors above.
 """
 import numpy as np
-import scipy.sparse as sparse
+import scipy.linalg
 import warnings
 
 from numpy.fft import rfft, irfft
@@ -23,14 +23,10 @@ import numpy.linalg as nla
 # Compute A.dot(x) if t is False,  A.transpose().dot(x)  otherwise.
 
 def multA(A, x, TP=False, L=None):
-    if sparse.issparse(A) :
-        # m = A.shape[0]
-        # n = A.shape[1]
-        if TP:
-            return sparse.csr_matrix(x).dot(A).transpose().todense().A[:, 0]
-        return A.dot(sparse.csr_matrix(x).transpose()).todense().A[:, 0]
+    # sparse and dense matrices both multiply numpy vectors (and
+    # matrices) directly
     if TP:
-        return x.dot(A)
+        return A.T.dot(x)
     return A.dot(x)
 
 
@@ -82,7 +78,7 @@ def orthog(Y, X):
 
 
 def invcheck(x):
-    eps2 = 2 * np.finfo(np.float).eps
+    eps2 = 2 * np.finfo(float).eps
     if(x > eps2):
         x = 1 / x
     else:
@@ -141,7 +137,6 @@ def lanczos(A, nval, tol=0.0001, maxit=50, center=None, scale=None, L=None, seed
     j = 0
     k = nu
     smax = 1
-    # sparse = sparse.issparse(A)
 
     V = np.zeros((n, m_b))
     W = np.zeros((m, m_b))
@@ -182,6 +177,11 @@ def lanczos(A, nval, tol=0.0001, maxit=50, center=None, scale=None, L=None, seed
             F = mmult(A, W[:, j], TP=True, L=L)
             mprod = mprod + 1
 
+            # apply centering
+            # R code: F <- F - ds * drop(cross(du, W[, j_w])) * dv
+            if center is not None:
+                F = F - np.sum(W[:, j]) * center
+
             # apply scaling
             if scale is not None:
                 F = F / scale
@@ -258,6 +258,214 @@ def lanczos(A, nval, tol=0.0001, maxit=50, center=None, scale=None, L=None, seed
                             })
 
 
+def _block_orth(X, Q=None):
+    """Orthonormalizes the columns of X against the columns of Q (block
+    Gram-Schmidt) and against each other (QR), twice, so that columns
+    of X that are almost in the span of Q stay orthogonal to Q."""
+    for _ in range(2):
+        if Q is not None and Q.shape[1] > 0:
+            X = X - Q.dot(Q.T.dot(X))
+        X = nla.qr(X)[0]
+    return X
+
+
+def _products(A, center=None, scale=None):
+    """Matrix-matrix products with (A - 1 center') diag(1 / scale) and
+    its transpose, without forming the centered and scaled matrix."""
+    def matmat(X):
+        if scale is not None:
+            X = X / scale[:, None]
+        Y = A.dot(X)
+        if center is not None:
+            Y = Y - center.dot(X)[None, :]
+        return Y
+
+    def rmatmat(Y):
+        Z = A.T.dot(Y)
+        if center is not None:
+            Z = Z - np.outer(center, Y.sum(axis=0))
+        if scale is not None:
+            Z = Z / scale[:, None]
+        return Z
+    return matmat, rmatmat
+
+
+def block_lanczos(A, nval, block_size=10, tol=0.0001, maxit=1000,
+                  center=None, scale=None, seed=None, v0=None,
+                  max_basis=None):
+    """Estimate a few of the largest singular values and corresponding
+    singular vectors of a matrix with a thick-restarted block Krylov
+    method.
+
+    The right Krylov space span{V0, (A'A)V0, (A'A)^2 V0, ...} is grown
+    one block of vectors at a time, so every step is a matrix-matrix
+    product (BLAS-3) instead of a matrix-vector product. The singular
+    triplets are extracted from the space by Rayleigh-Ritz after every
+    block and the iteration stops when the residuals of the first nval
+    triplets are below tol times the largest singular value, as in
+    lanczos(). The basis is preallocated with max_basis columns; when
+    it is full, the space is restarted with the leading Ritz vectors,
+    so memory does not grow with the number of blocks.
+
+    Keyword arguments:
+    block_size -- Number of vectors per block. Small blocks (about 10)
+                  need the fewest products in total; larger blocks
+                  need fewer steps.
+    tol   -- An estimation tolerance. Smaller means more accurate estimates.
+    maxit -- Maximum number of blocks.
+    center -- Column means subtracted implicitly (vector of length k).
+    scale -- Column scaling factors applied implicitly (vector of length k).
+    seed -- Seed of the random starting block.
+    v0 -- Starting vectors (k * b matrix, b <= block_size), for example
+          right singular vectors of a previous, similar problem.
+    max_basis -- Maximum number of basis vectors, at least nval + 2 *
+                 block_size. Default: nval + 4 * block_size.
+    Given an input matrix A of dimension j * k, returns the same result
+    object as lanczos() with U (j * nval), s (nval), V (k * nval), the
+    number of blocks (steps) and the number of matrix-vector products
+    (nmult, counting every column of a block).
+    """
+    m, n = A.shape
+    if min(m, n) < 2:
+        raise MatrixShapeException("The input matrix must be at least 2x2.")
+    b = min(block_size, min(m, n))
+    if max_basis is None:
+        max_basis = nval + 4 * b
+    p = min(max(max_basis, nval + 2 * b), min(m, n))
+    # Ritz vectors kept at a restart
+    nkeep = min(nval + b, p - b)
+    matmat, rmatmat = _products(A, center, scale)
+    rng = np.random.RandomState(seed)
+    V0 = rng.randn(n, b)
+    if v0 is not None:
+        v0 = np.asarray(v0).reshape(n, -1)[:, 0:b]
+        V0[:, 0:v0.shape[1]] = v0
+    Vb = _block_orth(V0)
+    # orthonormal basis V, W = AV and Z = A'AV, the first q columns
+    # are in use
+    V = np.zeros((n, p))
+    W = np.zeros((m, p))
+    Z = np.zeros((n, p))
+    # Gram matrix W'W = V'(A'A)V
+    G = np.zeros((p, p))
+    q = 0
+    mprod = 0
+    it = 0
+    conv = False
+    while it < maxit:
+        if q + Vb.shape[1] > p:
+            # thick restart with the leading Ritz vectors
+            V[:, 0:nkeep] = V[:, 0:q].dot(Y[:, 0:nkeep])
+            W[:, 0:nkeep] = W[:, 0:q].dot(Y[:, 0:nkeep])
+            Z[:, 0:nkeep] = Z[:, 0:q].dot(Y[:, 0:nkeep])
+            G[:, :] = 0
+            G[range(nkeep), range(nkeep)] = ev[0:nkeep]
+            q = nkeep
+            Vb = _block_orth(Vb, V[:, 0:q])
+        nb = Vb.shape[1]
+        Wb = matmat(Vb)
+        Zb = rmatmat(Wb)
+        mprod = mprod + 2 * nb
+        # W'Wb = V'A'A Vb = V'Zb
+        G[0:q, q:q + nb] = V[:, 0:q].T.dot(Zb)
+        G[q:q + nb, 0:q] = G[0:q, q:q + nb].T
+        G[q:q + nb, q:q + nb] = Vb.T.dot(Zb)
+        V[:, q:q + nb] = Vb
+        W[:, q:q + nb] = Wb
+        Z[:, q:q + nb] = Zb
+        q = q + nb
+        # Rayleigh-Ritz: singular values of A restricted to span(V)
+        ev, Y = nla.eigh(G[0:q, 0:q])
+        ev, Y = ev[::-1], Y[:, ::-1]
+        k = min(nval, q)
+        S = np.sqrt(np.maximum(ev[0:k], 0))
+        # residuals A'A v - s^2 v of the leading Ritz vectors
+        ncand = min(q, nval + b)
+        Res = Z[:, 0:q].dot(Y[:, 0:ncand]) - V[:, 0:q].dot(Y[:, 0:ncand]) * \
+            ev[0:ncand]
+        # residuals of A'u - s v, u = W y / s
+        with np.errstate(invalid='ignore', divide='ignore'):
+            R = np.nan_to_num(np.linalg.norm(Res, axis=0) /
+                              np.sqrt(np.maximum(ev[0:ncand], 0)))
+        it = it + 1
+        conv = np.all(R[0:k] < tol * S[0])
+        if conv or q == min(m, n):
+            break
+        # the next block extends the space with the residuals,
+        # starting with those of the unconverged triplets
+        order = np.argsort(R < tol * S[0], kind='stable')
+        # the basis spans the whole space when it is full and cannot
+        # be restarted
+        nb = b if p < min(m, n) else min(b, p - q)
+        Vb = _block_orth(Res[:, order[0:nb]], V[:, 0:q])
+    if not conv and it == maxit:
+        warnings.warn("block_lanczos did not converge in %s blocks" % maxit)
+    Y = Y[:, 0:k]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        U = np.nan_to_num(W[:, 0:q].dot(Y) / S)
+    return LanczosResult(**{'U': U,
+                            's': S,
+                            'V': V[:, 0:q].dot(Y),
+                            'steps': it,
+                            'nmult': mprod
+                            })
+
+
+def randomized_svd(A, nval, oversamples=10, n_iter=7, center=None,
+                   scale=None, seed=None):
+    """Estimate a few of the largest singular values and corresponding
+    singular vectors of a matrix with a randomized range finder
+    (Halko et al, 2011).
+
+    The range of A is approximated by an orthonormal basis Q of
+    A * Omega, where Omega is a random k * (nval + oversamples) matrix,
+    refined by n_iter power iterations with re-orthonormalization. The
+    singular values and vectors are taken from the SVD of the small
+    matrix Q'A. The computations are done in the floating point type
+    of A (single precision for float32 input).
+
+    Keyword arguments:
+    oversamples -- Number of random vectors in addition to nval.
+    n_iter -- Number of power iterations.
+    center -- Column means subtracted implicitly (vector of length k).
+    scale -- Column scaling factors applied implicitly (vector of length k).
+    seed -- Seed of the random matrix Omega.
+    Given an input matrix A of dimension j * k, returns the same result
+    object as lanczos() with U (j * nval), s (nval), V (k * nval), the
+    number of power iterations (steps) and the number of matrix-vector
+    products (nmult).
+    """
+    m, n = A.shape
+    if min(m, n) < 2:
+        raise MatrixShapeException("The input matrix must be at least 2x2.")
+    nval = min(nval, min(m, n))
+    b = min(nval + oversamples, min(m, n))
+    dtype = A.dtype if A.dtype in (np.float32, np.float64) else np.float64
+    if center is not None:
+        center = center.astype(dtype)
+    if scale is not None:
+        scale = scale.astype(dtype)
+    matmat, rmatmat = _products(A, center, scale)
+
+    def orth(X):
+        return scipy.linalg.qr(X, mode='economic', overwrite_a=True,
+                               check_finite=False)[0]
+
+    rng = np.random.RandomState(seed)
+    Q = orth(matmat(rng.randn(n, b).astype(dtype)))
+    for _ in range(n_iter):
+        Q = orth(matmat(orth(rmatmat(Q))))
+    # Q'A, computed as (A'Q)'
+    Ub, S, Vt = scipy.linalg.svd(rmatmat(Q).T, full_matrices=False,
+                                 check_finite=False)
+    return LanczosResult(**{'U': Q.dot(Ub[:, 0:nval]),
+                            's': S[0:nval],
+                            'V': Vt[0:nval].T,
+                            'steps': n_iter,
+                            'nmult': 2 * b * (n_iter + 1)
+                            })
+
+
 class LanczosResult():
 
     def __init__(self, **kwargs):
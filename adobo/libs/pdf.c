@@ -317,18 +317,23 @@ double dpois_raw(double x, double lambda)
     return exp(-stirlerr(x)-bd0(x,lambda))/sqrt(M_2PI*x);
 }
 
+double dgamma1(double x, double shape, double scale)
+{
+    double pr;
+    if (shape < 1) {
+        pr = dpois_raw(shape, x/scale);
+        pr = pr*shape/x;
+    } else {
+        pr = dpois_raw(shape-1, x/scale);
+        pr = pr/scale;
+    }
+    return pr;
+}
+
 double dgamma(double *x, int len, double shape, double scale, double *out)
 {
     for (int i=0; i<len; i++) {
-        double pr;
-        if (shape < 1) {
-            pr = dpois_raw(shape, x[i]/scale);
-            pr = pr*shape/x[i];
-        } else {
-            pr = dpois_raw(shape-1, x[i]/scale);
-            pr = pr/scale;
-        }
-        out[i] = pr;
+        out[i] = dgamma1(x[i], shape, scale);
     }
     
     return 1.0;
@@ -365,12 +370,57 @@ double dgamma(double *x, int len, double shape, double scale, double *out)
  *	Compute the density of the normal distribution.
  */
 
+double dnorm1(double x, double mu, double sigma)
+{
+    double z = (x - mu) / sigma;
+    z = fabs(z);
+    return M_1_SQRT_2PI * exp(-0.5 * z * z) / sigma;
+}
+
 double dnorm(double *x, int len, double mu, double sigma, double *out)
 {
     for (int i=0; i<len; i++) {
-        double z = (x[i] - mu) / sigma;
-        z = fabs(z);
-        z = M_1_SQRT_2PI * exp(-0.5 * z * z) / sigma;
-        out[i] = z;
+        out[i] = dnorm1(x[i], mu, sigma);
+    }
+    return 1.0;
+}
+
+/* Fused kernels for the gamma-normal mixture used in imputation.
+
+   x is a row-major nrow x ncol matrix (genes x cells) and pars is a
+   row-major nrow x 5 matrix holding the mixture parameters of every
+   row: (mixing rate, gamma shape, gamma rate, normal mean, normal
+   sd). */
+
+/* Posterior probability that an element belongs to the gamma
+   component, written to the nrow x ncol matrix out. */
+void mix_weight(double *x, int nrow, int ncol, double *pars, double *out)
+{
+    for (int i=0; i<nrow; i++) {
+        double *p = pars + (size_t)i*5;
+        double scale = 1/p[2];
+        for (int j=0; j<ncol; j++) {
+            size_t k = (size_t)i*ncol+j;
+            double pz1 = p[0]*dgamma1(x[k], p[1], scale);
+            double pz2 = (1-p[0])*dnorm1(x[k], p[3], p[4]);
+            out[k] = (pz1 == 0) ? 0 : pz1/(pz1+pz2);
+        }
+    }
+}
+
+/* log10-likelihood of every row under the mixture, written to the
+   vector out of length nrow. */
+void mix_loglik(double *x, int nrow, int ncol, double *pars, double *out)
+{
+    for (int i=0; i<nrow; i++) {
+        double *p = pars + (size_t)i*5;
+        double scale = 1/p[2];
+        double ll = 0;
+        for (int j=0; j<ncol; j++) {
+            size_t k = (size_t)i*ncol+j;
+            ll += log10(p[0]*dgamma1(x[k], p[1], scale)*2 +
+                        (1-p[0])*dnorm1(x[k], p[3], p[4]));
+        }
+        out[i] = ll;
     }
 }
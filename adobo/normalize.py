@@ -15,40 +15,91 @@ from multiprocessing import Pool
 import psutil
 import numpy as np
 import pandas as pd
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, diags
 from sklearn.neighbors import KernelDensity
-import statsmodels.api as sm
 from statsmodels.nonparametric.kernel_regression import KernelReg
-import patsy
-from tqdm import tqdm
 
-from ._stats import bw_nrd, row_geometric_mean, theta_ml, is_outlier
+from ._stats import (bw_nrd, theta_ml, poisson_irls,
+                     ksmooth, is_outlier, row_geometric_mean)
+from ._sparse import is_sparse_frame, to_csr, to_frame, dense_blocks
+from ._genes import read_gene_lengths, match_gene_lengths
+from .data import lazy_norm
+from ._log import warning
 
 
-def _vsn_model_pars(X, g, data_step1):
-    y = X.loc[g, :]
-    mod = sm.GLM(y, sm.add_constant(data_step1['log_umi']),
-                 family=sm.families.Poisson())
-    res = mod.fit()
-    s = res.summary()
-    mu = res.fittedvalues
-    theta = theta_ml(y, mu)
-    coef = res.params
-    return{'gene': g,
-           'theta': theta,
-           'log_umi': coef['log_umi'],
-           'const': coef['const']}
+def _count_summary(data, gmean_eps=None, with_mat=False, mat=None):
+    """Per cell and per gene summaries of read counts shared between
+    normalization methods
 
+    Parameters
+    ----------
+    data : :class:`pandas.DataFrame`
+        A pandas data frame object containing raw read counts
+        (rows=genes, columns=cells).
+    gmean_eps : `float`
+        If not None, also computes the geometric mean of every gene
+        with this constant added to avoid log(0). Default: None
+    with_mat : `bool`
+        Also keep the read counts of a dense data frame as a CSR
+        matrix. Sparse data frames are always converted. Default: False
+    mat : :class:`scipy.sparse.csr_matrix`
+        The read counts of `data` as a CSR matrix, used instead of
+        converting `data`. Default: None
 
-def vsn(data, min_cells=5, gmean_eps=1, ngenes=2000, nworkers='auto',
-        verbose=False):
+    Returns
+    -------
+    `dict`
+        The read counts as a CSR matrix ('mat', only for sparse input,
+        if `with_mat` or if `mat` is given), library sizes ('counts') and detected genes
+        ('genes') per cell, number of cells expressing every gene
+        ('cells') and optionally the gene geometric means ('gmean').
+    """
+    if mat is not None or is_sparse_frame(data) or with_mat:
+        if mat is None:
+            mat = to_csr(data, dtype=np.float64)
+        mat.eliminate_zeros()
+        summary = {'mat': mat,
+                   'counts': np.asarray(mat.sum(axis=0)).ravel(),
+                   'genes': np.bincount(mat.indices, minlength=mat.shape[1]),
+                   'cells': np.diff(mat.indptr)}
+    else:
+        # computed from the frame, no copy of the read counts is made
+        mat = data.values
+        summary = {'counts': mat.sum(axis=0, dtype=np.float64),
+                   'genes': np.count_nonzero(mat, axis=0),
+                   'cells': np.count_nonzero(mat, axis=1)}
+    summary['counts'] = pd.Series(summary['counts'], index=data.columns)
+    summary['genes'] = pd.Series(summary['genes'], index=data.columns)
+    summary['cells'] = pd.Series(summary['cells'], index=data.index)
+    summary['gmean_eps'] = gmean_eps
+    if gmean_eps is not None:
+        summary['gmean'] = pd.Series(row_geometric_mean(mat, gmean_eps),
+                                     index=data.index)
+    return summary
+
+
+def _count_rows(data, mat, rows):
+    """Read counts of the genes at positions `rows` as a dense array,
+    taken from the CSR matrix `mat` if not None."""
+    if mat is None:
+        return data.iloc[rows].to_numpy(dtype=np.float64)
+    return mat[rows].toarray()
+
+
+def vsn(data, min_cells=5, gmean_eps=1, ngenes=2000, nworkers=None,
+        smoother='ksmooth', block_size=1000, residuals=None, nhvg=3000,
+        summary=None, verbose=False):
     """Performs variance stabilizing normalization based on a negative
     binomial regression model with regularized parameters
 
     Notes
     -----
     Use only with UMI counts. Adopts a subset of the functionality of
-    `vst` in the R package `sctransform`.
+    `vst` in the R package `sctransform`. The Poisson regression and
+    theta estimation are performed for all genes at once. Pearson
+    residuals and corrected counts are computed in blocks of genes,
+    so that only a few blocks of dense intermediates are held in
+    memory at any time.
 
     Parameters
     ----------
@@ -64,10 +115,31 @@ def vsn(data, min_cells=5, gmean_eps=1, ngenes=2000, nworkers='auto',
         Number of genes to use when estimating parameters. Default:
         2000
     nworkers : `int` or `{'auto'}`
-        If a string, then the only accepted value is 'auto', and the
-        number of worker processes will be the total number of
-        detected physical cores. If an integer then it specifies the
-        number of worker processes. Default: 'auto'
+        Deprecated and ignored; the regression is fitted for all genes
+        at once in a single process. Default: None
+    smoother : `{'ksmooth', 'kernelreg'}`
+        Kernel regression used to regularize the model parameters
+        against the gene geometric means. 'ksmooth' is a binned
+        Nadaraya-Watson smoother with a fixed bandwidth, as in
+        `sctransform`; it runs in linear time. 'kernelreg' uses
+        `statsmodels` KernelReg with a bandwidth chosen by AIC, which is
+        much slower for many genes. Default: 'ksmooth'
+    block_size : `int`
+        Number of genes to process at a time when computing residuals
+        and corrected counts. Default: 1000
+    residuals : `{None, 'all', 'hvg'}`
+        Also return Pearson residuals. If 'all', residuals are
+        returned for all genes. If 'hvg', only residuals of the `nhvg`
+        genes with the highest residual variance are kept, which
+        bounds memory by `nhvg` genes regardless of the total number
+        of genes. Default: None
+    nhvg : `int`
+        Number of genes to keep residuals for when
+        residuals='hvg'. Default: 3000
+    summary : `dict`
+        Read count summaries of `data` computed by
+        :func:`adobo.normalize.norm`, to avoid computing them again
+        when several normalizations are made. Default: None
     verbose : `bool`
         Be verbose or not. Default: False
 
@@ -86,15 +158,18 @@ def vsn(data, min_cells=5, gmean_eps=1, ngenes=2000, nworkers='auto',
     -------
     :class:`pandas.DataFrame`
         A data matrix with adjusted counts.
+    :class:`pandas.DataFrame`
+        Pearson residuals (rows=genes, columns=cells), only returned
+        if `residuals` is not None. With residuals='hvg', genes are
+        ordered by decreasing residual variance.
     """
+    if not smoother in ('ksmooth', 'kernelreg'):
+        raise Exception('smoother must be \'ksmooth\' or \'kernelreg\'.')
+    if not residuals in (None, 'all', 'hvg'):
+        raise Exception('residuals must be None, \'all\' or \'hvg\'.')
+    if nworkers is not None:
+        warning('"nworkers" is deprecated and has no effect in vsn().')
     start_time = time.time()
-    if type(nworkers) == str:
-        if nworkers == 'auto':
-            nworkers = psutil.cpu_count(logical=False)
-        else:
-            raise Exception('Invalid value for parameter "nworkers".')
-    if verbose:
-        print('%s worker processes will be used' % nworkers)
     bw_adjust = 3  # Kernel bandwidth adjustment factor
     # numericals functions
     log10 = np.log10
@@ -103,61 +178,48 @@ def vsn(data, min_cells=5, gmean_eps=1, ngenes=2000, nworkers='auto',
     mean = np.mean
     sqrt = np.sqrt
     # data summary
-    cell_attr = pd.DataFrame({'counts': data.sum(axis=0),
-                              'genes': (data > 0).sum(axis=0)})
+    if summary is None or summary.get('gmean_eps') != gmean_eps:
+        summary = _count_summary(data, gmean_eps)
+    mat = summary.get('mat')
+    cell_attr = pd.DataFrame({'counts': summary['counts'],
+                              'genes': summary['genes']})
     cell_attr['log_umi'] = log10(cell_attr.counts)
     cell_attr['log_gene'] = log10(cell_attr.genes)
     cell_attr['umi_per_gene'] = cell_attr.counts/cell_attr.genes
     cell_attr['log_umi_per_gene'] = log10(cell_attr.umi_per_gene)
 
-    genes_cell_count = (data > 0).sum(axis=1)
-    genes = genes_cell_count[genes_cell_count >= min_cells].index
-    X = data[data.index.isin(genes)]
-    genes_log_gmean = log10(row_geometric_mean(X, gmean_eps))
+    genes_cell_count = summary['cells']
+    keep = (genes_cell_count >= min_cells).values
+    genes_log_gmean = log10(summary['gmean'][keep])
 
-    cells_step1 = X.columns
-    genes_step1 = X.index
+    genes_step1 = data.index[keep]
     genes_log_gmean_step1 = genes_log_gmean
     data_step1 = cell_attr
 
     if ngenes < len(genes_step1):
         bw = bw_nrd(genes_log_gmean_step1)
         kde = KernelDensity(bandwidth=bw, kernel='gaussian')
-        ret = kde.fit(genes_log_gmean_step1[:, None])
+        ret = kde.fit(genes_log_gmean_step1.values[:, None])
         # TODO: score_samples is slower than density() in R
-        weights = 1/exp_(kde.score_samples(genes_log_gmean_step1[:, None]))
-        genes_step1 = np.random.choice(X.index, ngenes, replace=False,
+        weights = 1/exp_(kde.score_samples(genes_log_gmean_step1.values[:, None]))
+        genes_step1 = np.random.choice(genes_step1, ngenes, replace=False,
                                        p=weights/sum(weights))
-        X = X.loc[X.index.isin(genes_step1), X.columns.isin(cells_step1)]
-        X = X.reindex(genes_step1)
-        genes_log_gmean_step1 = log10(row_geometric_mean(X, gmean_eps))
-
-    pool = Pool(nworkers)
-    model_pars = []
-    pbar = tqdm(total=len(genes_step1))
-
-    def _update_results(y):
-        model_pars.append(y)
-        pbar.update()
-
-    for g in genes_step1:
-        args = (X, g, data_step1)
-        x = pool.apply_async(_vsn_model_pars, args=args,
-                             callback=_update_results)
-        # print(x.get())
-
-    pool.close()
-    pool.join()
-
-    model_pars = pd.DataFrame(model_pars)
-    model_pars.index = model_pars['gene']
-    model_pars = model_pars.drop('gene', axis=1)
+        genes_log_gmean_step1 = genes_log_gmean[genes_step1]
+
+    # one Poisson regression per gene on log_umi, fitted jointly
+    design = np.column_stack((np.ones(data.shape[1]),
+                              data_step1['log_umi'].values))
+    y_step1 = _count_rows(data, mat, data.index.get_indexer(genes_step1))
+    coef, mu = poisson_irls(y_step1, design)
+    model_pars = pd.DataFrame({'theta': theta_ml(y_step1, mu),
+                               'log_umi': coef[:, 1],
+                               'const': coef[:, 0]},
+                              index=genes_step1)
+    del y_step1, mu
     model_pars.theta = log10(model_pars.theta)
 
     # remove outliers
-    outliers = model_pars.apply(
-        lambda x: is_outlier(x, genes_log_gmean_step1), axis=0)
-    outliers = outliers.any(axis=1)
+    outliers = is_outlier(model_pars, genes_log_gmean_step1).any(axis=1)
     model_pars = model_pars[np.logical_not(outliers.values)]
 
     genes_step1 = model_pars.index.values
@@ -167,54 +229,78 @@ def vsn(data, min_cells=5, gmean_eps=1, ngenes=2000, nworkers='auto',
     x_points = np.maximum(genes_log_gmean, min(genes_log_gmean_step1))
     x_points = np.minimum(x_points, max(genes_log_gmean_step1))
 
-    model_pars_fit = model_pars.apply(
-        lambda x: KernelReg(x,
-                            genes_log_gmean_step1,
-                            bw='aic',
-                            var_type='c').fit(x_points)[0], axis=0)
-
+    if smoother == 'ksmooth':
+        bw = bw_nrd(genes_log_gmean_step1)*bw_adjust
+        model_pars_fit = pd.DataFrame(ksmooth(genes_log_gmean_step1,
+                                              model_pars.values,
+                                              x_points, bw),
+                                      columns=model_pars.columns)
+    else:
+        model_pars_fit = model_pars.apply(
+            lambda x: KernelReg(x,
+                                genes_log_gmean_step1,
+                                bw='aic',
+                                var_type='c').fit(x_points)[0], axis=0)
     model_pars_fit.index = x_points.index
     model_pars.theta = 10**model_pars.theta
     model_pars_fit.theta = 10**model_pars_fit.theta
     model_pars_final = model_pars_fit
 
-    regressor_data_final = pd.DataFrame({'const': [1]*len(cell_attr['log_umi']),
-                                         'log_umi': cell_attr['log_umi']})
-
-    coefs = model_pars_final.loc[:, ('const', 'log_umi')]
-    mu = exp_(np.dot(coefs, regressor_data_final.transpose()))
-    y = data[data.index.isin(model_pars_final.index)]
-
-    # pearson residuals
-    mu2 = pd.DataFrame(mu**2)
-    t = (y-mu)
-    variance = mu+mu2.div(model_pars_final.loc[:, 'theta'].values, axis=0)
-    n = sqrt(variance)
-
-    n.index = t.index
-    n.columns = t.columns
-    pr = t/n
-
-    coefs = model_pars_final.loc[:, ('const', 'log_umi')]
-    theta = model_pars_final.loc[:, ('theta')]
-    med = np.median(cell_attr['log_umi'])
-
-    # correct counts
-    regressor_data = pd.DataFrame({'const': [1]*len(cell_attr['log_umi']),
-                                   'log_umi': [med]*len(cell_attr['log_umi'])})
-    mu = exp_(np.dot(coefs, regressor_data.transpose()))
-    variance = mu+pd.DataFrame(mu**2).div(theta.values, axis=0)
-    variance.index = pr.index
-    variance.columns = pr.columns
-    corrected_data = mu + pr * sqrt(variance)
-    y = abs(round(corrected_data))
+    genes_final = model_pars_final.index
+    const = model_pars_final['const'].values
+    slope = model_pars_final['log_umi'].values
+    theta = model_pars_final['theta'].values
+    log_umi = cell_attr['log_umi'].values
+    med = np.median(log_umi)
+    # expected counts and their standard deviations at the median
+    # sequencing depth, used to correct the counts
+    mu_med = exp_(const+slope*med)
+    sd_med = sqrt(mu_med+mu_med**2/theta)
+
+    rows = data.index.get_indexer(genes_final)
+    corrected = np.empty((len(rows), data.shape[1]), dtype=np.float64)
+    if residuals == 'all':
+        pr_out = np.empty(corrected.shape, dtype=np.float64)
+    # running top list of genes by residual variance
+    top_idx = np.empty(0, dtype=int)
+    top_var = np.empty(0)
+    top_pr = np.empty((0, data.shape[1]))
+
+    for start in range(0, len(rows), block_size):
+        end = min(start+block_size, len(rows))
+        y = _count_rows(data, mat, rows[start:end])
+        mu = exp_(const[start:end, None]+slope[start:end, None]*log_umi)
+        # pearson residuals
+        pr = (y-mu)/sqrt(mu+mu**2/theta[start:end, None])
+        del y, mu
+        corrected[start:end] = np.abs(np.round(
+            mu_med[start:end, None]+pr*sd_med[start:end, None]))
+        if residuals == 'all':
+            pr_out[start:end] = pr
+        elif residuals == 'hvg':
+            top_idx = np.concatenate((top_idx, np.arange(start, end)))
+            top_var = np.concatenate((top_var, np.var(pr, axis=1, ddof=1)))
+            top_pr = np.vstack((top_pr, pr))
+            if len(top_idx) > nhvg:
+                keep = np.argpartition(-top_var, nhvg)[:nhvg]
+                top_idx, top_var, top_pr = top_idx[keep], top_var[keep], top_pr[keep]
+
+    y = pd.DataFrame(corrected, index=genes_final, columns=data.columns)
+    if residuals == 'all':
+        pr_out = pd.DataFrame(pr_out, index=genes_final, columns=data.columns)
+    elif residuals == 'hvg':
+        o = np.argsort(-top_var, kind='stable')
+        pr_out = pd.DataFrame(top_pr[o], index=genes_final[top_idx[o]],
+                              columns=data.columns)
     end_time = time.time()
     if verbose:
         print('Analysis took %.2f minutes' % ((end_time-start_time)/60))
-    return y
+    if residuals is None:
+        return y
+    return y, pr_out
 
 
-def clr(data, axis='genes'):
+def clr(data, axis='genes', summary=None):
     """Performs centered log ratio normalization similar to Seurat
 
     Parameters
@@ -224,6 +310,9 @@ def clr(data, axis='genes'):
         (rows=genes, columns=cells).
     axis : {'genes', 'cells'}
         Normalize over genes or cells. Default: 'genes'
+    summary : `dict`
+        Read count summaries of `data` computed by
+        :func:`adobo.normalize.norm`. Default: None
 
     References
     ----------
@@ -248,12 +337,27 @@ def clr(data, axis='genes'):
     else:
         raise Exception('Unknown axis specified.')
 
+    if is_sparse_frame(data):
+        # zeros map to zero, so only the non-zero values are transformed
+        if summary is None:
+            mat = to_csr(data, dtype=np.float64)
+        else:
+            mat = summary['mat'].copy()
+        if axis == 1:
+            idx = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
+        else:
+            idx = mat.indices
+        denom = np.exp(np.bincount(idx, np.log1p(mat.data),
+                                   data.shape[1-axis])/data.shape[axis])
+        mat.data = np.log1p(mat.data/denom[idx])
+        return to_frame(mat, data.index, data.columns)
+
     r = data.apply(lambda x: np.log1p(
         x/np.exp(sum(np.log1p(x[x > 0]))/len(x))), axis=axis)
     return r
 
 
-def standard(data, scaling_factor=10000):
+def standard(data, scaling_factor=10000, summary=None):
     """Performs a standard normalization by scaling with the total
     read depth per cell and then multiplying with a scaling factor.
 
@@ -265,6 +369,9 @@ def standard(data, scaling_factor=10000):
     scaling_factor : `int`
         Scaling factor used to multiply the scaled counts
         with. Default: 10000
+    summary : `dict`
+        Read count summaries of `data` computed by
+        :func:`adobo.normalize.norm`. Default: None
 
     References
     ----------
@@ -282,18 +389,61 @@ def standard(data, scaling_factor=10000):
     :class:`pandas.DataFrame`
         A normalized data matrix with same dimensions as before.
     """
-    col_sums = data.sum(axis=0).values
+    if is_sparse_frame(data):
+        # scale the non-zero values by the factor of their column
+        if summary is None:
+            mat = to_csr(data, dtype=np.float64)
+            col_sums = np.asarray(mat.sum(axis=0)).ravel()
+        else:
+            mat = summary['mat'].copy()
+            col_sums = summary['counts'].values
+        with np.errstate(divide='ignore'):
+            factors = scaling_factor/col_sums
+        mat.data *= factors[mat.indices]
+        return to_frame(mat, data.index, data.columns)
+    if summary is None:
+        col_sums = data.sum(axis=0).values
+    else:
+        col_sums = summary['counts'].values
     data_norm = (data / col_sums) * scaling_factor
     return data_norm
 
 
-def rpkm(data, gene_lengths):
+def _length_scaled(data, gene_lengths, species):
+    """Read counts of the genes with known length and their lengths in
+    kilobases, used by :func:`rpkm` and :func:`tpm`."""
+    if isinstance(gene_lengths, str):
+        gene_lengths, positional = read_gene_lengths(gene_lengths)
+        if positional:
+            gene_lengths.index = data.index
+    lengths = match_gene_lengths(gene_lengths, data.index, species).values
+    keep = np.logical_and(np.logical_not(np.isnan(lengths)), lengths > 0)
+    sparse = is_sparse_frame(data)
+    if sparse:
+        counts = to_csr(data, dtype=np.float64)[keep]
+    else:
+        counts = data.to_numpy(dtype=np.float64)[keep]
+    return counts, lengths[keep]/1000, data.index[keep], sparse
+
+
+def _diag_scale(counts, row_factors, col_factors, index, columns, sparse):
+    """ Scales rows and columns, diag(row_factors)*counts*diag(col_factors). """
+    if sparse:
+        mat = diags(row_factors).dot(counts).dot(diags(col_factors))
+        return to_frame(mat.tocsr(), index, columns)
+    return pd.DataFrame(counts*row_factors[:, None]*col_factors[None, :],
+                        index=index, columns=columns)
+
+
+def rpkm(data, gene_lengths, species=None):
     """Normalize expression values as RPKM
 
     Notes
     -----
     This method should be used if you need to adjust for gene length,
-    such as in a SMART-Seq2 protocol.
+    such as in a SMART-Seq2 protocol. Genes without a known length are
+    removed. Computed as two diagonal scalings of the read counts, so
+    sparse input stays sparse.
 
     Parameters
     ----------
@@ -303,13 +453,19 @@ def rpkm(data, gene_lengths):
     gene_lengths : :class:`pandas.Series` or `str`
         Should contain the gene lengths in base pairs and gene names
         set as index. The names must match the gene names used in
-        `data`. Normally gene lengths should be the combined length of
+        `data`, either directly or through Ensembl gene
+        identifiers. Normally gene lengths should be the combined length of
         exons for every gene. If gene_lengths is a `str` then it is
         taken as a file path and loads it; first column is gene names
         and second column is the length, field separator is one space;
         an alternative format is a single column of combined exon
         lengths where the total number of rows matches the number of
-        rows in the raw read counts matrix and with the same order.
+        rows in the raw read counts matrix and with the same
+        order. Files are only read again if they have changed.
+    species : `{'human', 'mouse'}`
+        If set, gene symbols are translated to Ensembl gene
+        identifiers with the bundled annotation when matching gene
+        lengths. Default: None
 
     References
     ----------
@@ -321,53 +477,104 @@ def rpkm(data, gene_lengths):
     :class:`pandas.DataFrame`
         A normalized data matrix with same dimensions as before.
     """
-    mat = data
-    if type(gene_lengths) == str:
-        gene_lengths = pd.read_csv(
-            gene_lengths, header=None, sep=' ', squeeze=True)
-        if type(gene_lengths) != pd.core.series.Series:
-            gene_lengths = pd.Series(
-                gene_lengths[1].values, index=gene_lengths[0])
-        else:
-            gene_lengths.index = mat.index
-            # remove NaN
-            keep = np.logical_not(gene_lengths.isna())
-            gene_lengths = gene_lengths[keep]
-            mat = mat[keep]
-
-    # take the intersection
-    mat = mat[mat.index.isin(gene_lengths.index)]
-    gene_lengths = gene_lengths[gene_lengths.index.isin(mat.index)]
-    gene_lengths = gene_lengths.reindex(mat.index)
-    # gene length in kilobases
-    kb = gene_lengths/1000
-
-    def _per_cell(x):
-        s = sum(x)/10**6
-        rpm = x/s
-        rpkm = rpm/kb
-        return rpkm
-
-    ret = pd.DataFrame([_per_cell(i[1])
-                        for i in mat.transpose().iterrows()]).transpose()
-    ret.columns = mat.columns
+    counts, kb, index, sparse = _length_scaled(data, gene_lengths, species)
+    # reads per million mapped reads, per cell
+    per_million = np.asarray(counts.sum(axis=0)).ravel()/10**6
+    return _diag_scale(counts, 1/kb, 1/per_million, index, data.columns,
+                       sparse)
+
+
+def tpm(data, gene_lengths, species=None):
+    """Normalize expression values as TPM (transcripts per million)
+
+    Notes
+    -----
+    Read counts are divided by gene length and then scaled so that
+    every cell sums to one million. Genes without a known length are
+    removed.
+
+    Parameters
+    ----------
+    obj : :class:`pandas.DataFrame`
+        A pandas data frame object containing raw read counts
+        (rows=genes, columns=cells).
+    gene_lengths : :class:`pandas.Series` or `str`
+        Gene lengths in base pairs, see :func:`rpkm`.
+    species : `{'human', 'mouse'}`
+        Species for translating gene symbols, see
+        :func:`rpkm`. Default: None
+
+    References
+    ----------
+    .. [1] Conesa et al. (2016) Genome Biology
+           https://genomebiology.biomedcentral.com/articles/10.1186/s13059-016-0881-8
+
+    Returns
+    -------
+    :class:`pandas.DataFrame`
+        A normalized data matrix with same dimensions as before.
+    """
+    counts, kb, index, sparse = _length_scaled(data, gene_lengths, species)
+    # per cell sum of reads per kilobase
+    rate_sums = counts.T.dot(1/kb)
+    return _diag_scale(counts, 1/kb, 10**6/rate_sums, index, data.columns,
+                       sparse)
+
+
+def _fqn_sort(block):
+    """ Column-wise sort order and sorted values of a dense block. """
+    order = np.argsort(block, axis=0, kind='stable')
+    return order, np.take_along_axis(block, order, axis=0)
+
+
+def _fqn_assign(order, sorted_values, cs):
+    """Assigns the reference distribution to a sorted block, tied
+    values receive the mean of the reference over their ranks."""
+    n = sorted_values.shape[0]
+    pos = np.arange(n)[:, None]
+    new = np.ones(sorted_values.shape, dtype=bool)
+    new[1:] = sorted_values[1:] != sorted_values[:-1]
+    # first and last rank of the tie group of every position
+    lo = np.maximum.accumulate(np.where(new, pos, 0), axis=0)
+    last = np.ones(sorted_values.shape, dtype=bool)
+    last[:-1] = new[1:]
+    hi = np.minimum.accumulate(np.where(last, pos, n-1)[::-1], axis=0)[::-1]
+    values = (cs[hi+1]-cs[lo])/(hi-lo+1)
+    ret = np.empty(values.shape)
+    np.put_along_axis(ret, order, values, axis=0)
     return ret
 
 
-def fqn(data):
+def fqn(data, block_size=None, out=None):
     """Performs full quantile normalization (FQN)
 
     Notes
     -----
     FQN has been shown to perform well on single cell data and was a
-    popular normalization scheme for microarray data. The present
-    function does not handle ties well.
+    popular normalization scheme for microarray data. Tied values
+    within a cell are assigned the average of the reference
+    distribution over their ranks.
+
+    For matrices that do not fit in memory, set `block_size` to
+    process a limited number of cells at a time. The data are then
+    passed over twice: the first pass accumulates the reference
+    distribution and the second pass writes the normalized values
+    into `out`, which can be a :class:`numpy.memmap`.
 
     Parameters
     ----------
-    data : :class:`pandas.DataFrame`
+    data : :class:`pandas.DataFrame` or :class:`numpy.ndarray`
         A pandas data frame object containing raw read counts
-        (rows=genes, columns=cells).
+        (rows=genes, columns=cells). Can also be a two dimensional
+        array, such as a :class:`numpy.memmap`.
+    block_size : `int`
+        Number of cells to process at a time. If None, all cells are
+        processed at once. Default: None
+    out : :class:`numpy.ndarray`
+        An array with the same shape as `data` to write normalized
+        values into, such as a :class:`numpy.memmap`. If None, the
+        result is returned as a new data frame (or array if `data` is
+        an array). Default: None
 
     References
     ----------
@@ -385,46 +592,69 @@ def fqn(data):
     Returns
     -------
     :class:`pandas.DataFrame`
-        A normalized data matrix with same dimensions as before.
+        A normalized data matrix with same dimensions as before (or
+        `out` if it was given).
     """
-    ncells = data.shape[1]
-    O = []  # to hold the ordered indices for each cell
-    S = []  # to hold the sorted values for each cell
-    m = data.to_numpy()
-    for cc in np.arange(0, ncells):
-        values = m[:, cc]
-        ix = values.argsort()
-        x = values[ix]
-        O.append(ix)
-        S.append(list(x))
-    S = csr_matrix(np.array(S).transpose())
-    # calc average distribution per gene
-    avg = np.array(S.mean(axis=1).flatten())[0]
-    L = []
-    for cc in np.arange(0, ncells):
-        loc = O[cc]
-        L.append(list(pd.Series(avg, index=loc).sort_index().values))
-    df = pd.DataFrame(L, index=data.columns)
-    df.columns = data.index
-    df = df.transpose()
-    return df
+    ngenes, ncells = data.shape
+    if is_sparse_frame(data):
+        mat = to_csr(data, dtype=np.float64).tocsc()
+        get_block = lambda a, b: mat[:, a:b].toarray()
+    elif isinstance(data, pd.DataFrame):
+        get_block = lambda a, b: data.iloc[:, a:b].to_numpy(dtype=np.float64)
+    else:
+        get_block = lambda a, b: np.asarray(data[:, a:b], dtype=np.float64)
+    if block_size is None:
+        block_size = ncells
+    starts = range(0, ncells, block_size)
+    # average distribution across cells
+    sorted_sum = np.zeros(ngenes)
+    for start in starts:
+        order, sorted_values = _fqn_sort(get_block(start, start+block_size))
+        sorted_sum += sorted_values.sum(axis=1)
+    cs = np.concatenate(([0], np.cumsum(sorted_sum/ncells)))
+    ret = np.empty((ngenes, ncells)) if out is None else out
+    for start in starts:
+        if block_size < ncells:
+            order, sorted_values = _fqn_sort(get_block(start, start+block_size))
+        ret[:, start:start+block_size] = _fqn_assign(order, sorted_values, cs)
+    if out is None and isinstance(data, pd.DataFrame):
+        return pd.DataFrame(ret, index=data.index, columns=data.columns)
+    return ret
 
 
-def clean_matrix(data, obj, remove_low_qual=True, remove_mito=True,
-                 meta=False):
+def _keep_masks(data, obj, remove_low_qual=True, remove_mito=True):
+    """Boolean masks of the genes (rows) and cells (columns) of `data`
+    kept by :func:`clean_matrix`."""
+    keep_genes = np.ones(data.shape[0], dtype=bool)
+    keep_cells = np.ones(data.shape[1], dtype=bool)
     if remove_low_qual:
         # Remove low quality cells
         remove = obj.meta_cells.status[obj.meta_cells.status != 'OK']
-        data = data.drop(remove.index, axis=1, errors='ignore')
+        keep_cells &= np.logical_not(data.columns.isin(remove.index))
         # Remove uninformative genes (e.g. lowly expressed)
         v = np.logical_and(obj.meta_genes.status != 'OK',
                            obj.meta_genes.ERCC != True)
         remove = obj.meta_genes.status[v]
-        data = data.drop(remove.index, axis=0, errors='ignore')
+        keep_genes &= np.logical_not(data.index.isin(remove.index))
     # Remove mitochondrial genes
     if remove_mito:
         remove = obj.meta_genes[obj.meta_genes.mitochondrial == True]
-        data = data.drop(remove.index, axis=0, errors='ignore')
+        keep_genes &= np.logical_not(data.index.isin(remove.index))
+    return keep_genes, keep_cells
+
+
+def clean_matrix(data, obj, remove_low_qual=True, remove_mito=True,
+                 meta=False):
+    keep_genes, keep_cells = _keep_masks(data, obj, remove_low_qual,
+                                         remove_mito)
+    if not (keep_genes.all() and keep_cells.all()):
+        if is_sparse_frame(data):
+            # slicing a CSR matrix avoids a column by column take
+            mat = to_csr(data)[keep_genes][:, keep_cells]
+            data = to_frame(mat, data.index[keep_genes],
+                            data.columns[keep_cells])
+        else:
+            data = data.loc[keep_genes, keep_cells]
     if meta:
         md = obj.meta_cells.copy()
         md = md.loc[md.index.isin(data.columns), :]
@@ -433,11 +663,48 @@ def clean_matrix(data, obj, remove_low_qual=True, remove_mito=True,
     return data
 
 
+def _norm_method(data, method, summary, args):
+    """Computes one normalization (including the log transformation)
+    for :func:`norm`. Must be outside of norm() for Pool to work."""
+    if args['lazy']:
+        with np.errstate(divide='ignore'):
+            size_factors = args['scaling_factor']/summary['counts'].values
+        return lazy_norm(summary['mat'], size_factors, data.index,
+                         data.columns, args['log'], args['log_func'],
+                         args['small_const'], args['sparse'])
+    if method == 'standard':
+        norm = standard(data, args['scaling_factor'], summary)
+    elif method == 'rpkm':
+        norm = rpkm(data, args['gene_lengths'], args['species'])
+    elif method == 'tpm':
+        norm = tpm(data, args['gene_lengths'], args['species'])
+    elif method == 'fqn':
+        norm = fqn(data)
+    elif method == 'clr':
+        norm = clr(data, args['axis'], summary)
+    elif method == 'vsn':
+        norm = vsn(data, ngenes=args['ngenes'], summary=summary,
+                   verbose=args['verbose'])
+    if args['log']:
+        log_func = args['log_func']
+        small_const = args['small_const']
+        if is_sparse_frame(norm) and log_func(small_const) == 0:
+            # log_func(0+small_const) is zero, transform non-zero values only
+            mat = to_csr(norm, dtype=np.float64)
+            mat.data = log_func(mat.data+small_const)
+            norm = to_frame(mat, norm.index, norm.columns)
+        else:
+            if is_sparse_frame(norm):
+                norm = norm.sparse.to_dense()
+            norm = log_func(norm+small_const)
+    return norm
+
+
 def norm(obj, method='standard', name=None, use_imputed=False,
          log=True, log_func=np.log2, small_const=1,
          remove_low_qual=True, remove_mito=True, gene_lengths=None,
-         scaling_factor=10000, axis='genes', ngenes=2000,
-         nworkers='auto', retx=False, verbose=False):
+         species=None, scaling_factor=10000, axis='genes', ngenes=2000,
+         nworkers='auto', lazy=False, retx=False, verbose=False):
     """Normalizes gene expression data
 
     Notes
@@ -445,27 +712,35 @@ def norm(obj, method='standard', name=None, use_imputed=False,
     A wrapper function around the individual normalization functions,
     which can also be called directly.
 
+    Several methods can be given as a list. The read count matrix is
+    then filtered once, and library sizes, detection counts and gene
+    geometric means are computed once and shared between the methods.
+
     Parameters
     ----------
     obj : :class:`adobo.data.dataset`
           A dataset class object.
-    method : `{'standard', 'rpkm', 'fqn', 'clr', 'vsn'}`
+    method : `{'standard', 'rpkm', 'tpm', 'fqn', 'clr', 'vsn'}` or `list`
         Specifies the method to use. `standard` refers to the simplest
         normalization strategy involving scaling genes by total number
-        of reads per cell. `rpkm` performs RPKM normalization and
-        requires the `gene_lengths` parameter to be set.  `fqn`
+        of reads per cell. `rpkm` and `tpm` perform RPKM and TPM
+        normalization and require the `gene_lengths` parameter to be set.  `fqn`
         performs a full-quantile normalization. `clr` performs
         centered log ratio normalization. `vsn` performs a variance
-        stabilizing normalization.  Default: standard
-    name : `str`
+        stabilizing normalization. A list of methods can be
+        given. Default: standard
+    name : `str` or `list`
         A choosen name for the normalization. It is used for storing
         and retrieving this normalization for plotting later. If
         `None` or an empty string, then it is set to the value of
-        `method`.
+        `method`. If `method` is a list, then a list of the same
+        length.
     use_imputed : `bool`
         Use imputed data. If set to True, then
-        :func:`adobo.preproc.impute` must have been run
-        previously. Default: False
+        :func:`adobo.preproc.impute` must have been run previously.
+        The imputed values are merged into the raw read counts as a
+        sparse matrix, which is passed on to the normalization
+        methods. Default: False
     log : `bool`
         Perform log transformation. Default: True
     log_func : `numpy.func`
@@ -489,8 +764,12 @@ def norm(obj, method='standard', name=None, use_imputed=False,
         for every gene. If gene_lengths is a `str` then it is taken as
         a filename and loaded; first column is gene names and second
         column is the length, field separator is one space.
-        `gene_lengths` needs to be set _only_ if
-        method='rpkm'. Default: None
+        `gene_lengths` needs to be set _only_ if method='rpkm' or
+        method='tpm'. Default: None
+    species : `{'human', 'mouse'}`
+        For method='rpkm' and method='tpm'. If set, gene symbols are
+        translated to Ensembl gene identifiers with the bundled
+        annotation when matching `gene_lengths`. Default: None
     scaling_factor : `int`
         Scaling factor used to multiply the scaled counts with. Only
         used for `method="depth"`. Default: 10000
@@ -501,12 +780,23 @@ def norm(obj, method='standard', name=None, use_imputed=False,
         For method='vsn', number of genes to use when estimating
         parameters. Default: 2000
     nworkers : `int` or `{'auto'}`
-        For method='vsn'. If a string, then the only accepted value is
-        'auto', and the number of worker processes will be the total
-        number of detected physical cores.  If an integer then it
-        specifies the number of worker processes. Default: 'auto'
+        Number of worker processes used to compute the normalizations
+        in parallel when `method` is a list. If 'auto', the number of
+        detected physical cores. `log_func` must be picklable (e.g. a
+        numpy function) when more than one worker is used.
+        Default: 'auto'
+    lazy : `bool`
+        Only for method='standard'. Store a
+        :class:`adobo.data.lazy_norm` holding the read counts and size
+        factors instead of the normalized matrix; normalized values are
+        then computed on demand. Supported by
+        :func:`adobo.hvg.find_hvg`, :func:`adobo.dr.pca`, the functions
+        in :mod:`adobo.de` and :func:`adobo.plotting.genes_violin`;
+        other functions need a materialized matrix, which can be
+        obtained with `to_frame()`. Default: False
     retx : `bool`
-        Return the normalized data as well. Default: False
+        Return the normalized data as well. If `method` is a list, a
+        `dict` keyed by normalization name is returned. Default: False
     verbose : `bool`
         Be verbose or not. Default: False
 
@@ -520,68 +810,154 @@ def norm(obj, method='standard', name=None, use_imputed=False,
     >>> import adobo as ad
     >>> exp = ad.IO.load_from_file('pbmc8k.mat.gz', bundled=True)
     >>> ad.normalize.norm(exp)
+    >>> # several normalizations sharing the same preprocessing
+    >>> ad.normalize.norm(exp, method=['standard', 'clr', 'vsn'])
 
     Returns
     -------
     Nothing. Modifies the passed object.
     """
+    methods = [method] if isinstance(method, str) else list(method)
     if name is None or name == '':
-        name = method
-    if method == 'rpkm' and gene_lengths == None:
+        names = methods
+    elif isinstance(name, str):
+        names = [name]
+    else:
+        names = list(name)
+    if len(names) != len(methods):
+        raise Exception('`name` must have one entry per method.')
+    for m in methods:
+        if not m in ('standard', 'rpkm', 'tpm', 'fqn', 'clr', 'vsn'):
+            raise Exception('Unknown normalization method.')
+    if lazy and np.any([m != 'standard' for m in methods]):
+        raise Exception('lazy=True is only supported for method=\'standard\'.')
+    if np.any(np.isin(methods, ('rpkm', 'tpm'))) and gene_lengths is None:
         raise Exception(
-            'The `gene_lengths` parameter needs to be set when method is RPKM.')
+            'The `gene_lengths` parameter needs to be set when method is RPKM or TPM.')
+    if type(nworkers) == str:
+        if nworkers == 'auto':
+            nworkers = psutil.cpu_count(logical=False)
+        else:
+            raise Exception('Invalid value for parameter "nworkers".')
+    mat = None
     if use_imputed:
         if obj.imp_count_data.shape[0] == 0:
             raise Exception(
                 'No imputed data found. Run adobo.preproc.impute() first.')
-        else:
-            data = obj.imp_count_data
+        # the imputed entries are merged into the raw counts as a CSR
+        # matrix, never densified, and the methods work from it
+        keep_genes, keep_cells = _keep_masks(obj.count_data, obj,
+                                             remove_low_qual, remove_mito)
+        mat = obj.imp_count_data.merge_csr(obj.count_data)
+        mat = mat[keep_genes][:, keep_cells]
+        data = to_frame(mat, obj.count_data.index[keep_genes],
+                        obj.count_data.columns[keep_cells])
     else:
-        data = obj.count_data
-    data = clean_matrix(data, obj)
-    if method == 'standard':
-        norm = standard(data, scaling_factor)
-        norm_method = 'standard'
-    elif method == 'rpkm':
-        norm = rpkm(data, gene_lengths)
-        norm_method = 'rpkm'
-    elif method == 'fqn':
-        norm = fqn(data)
-        norm_method = 'fqn'
-    elif method == 'clr':
-        norm = clr(data, axis)
-        norm_method = 'clr'
-    elif method == 'vsn':
-        norm = vsn(data, ngenes=ngenes, nworkers=nworkers, verbose=verbose)
-        norm_method = 'vsn'
+        data = clean_matrix(obj.count_data, obj, remove_low_qual,
+                            remove_mito)
+    summary = None
+    if lazy or np.any(np.isin(methods, ('standard', 'clr', 'vsn'))):
+        # library sizes, detection counts and geometric means are
+        # computed once and shared between the methods
+        summary = _count_summary(data, 1 if 'vsn' in methods else None,
+                                 with_mat=lazy, mat=mat)
+    del mat
+    args = {'scaling_factor': scaling_factor, 'gene_lengths': gene_lengths,
+            'species': species, 'axis': axis, 'ngenes': ngenes, 'log': log,
+            'log_func': log_func, 'small_const': small_const, 'lazy': lazy,
+            'sparse': obj.sparse, 'verbose': verbose}
+    jobs = [(data, m, summary, args) for m in methods]
+    if nworkers > 1 and len(methods) > 1:
+        if verbose:
+            print('%s worker processes will be used' % min(nworkers, len(methods)))
+        with Pool(min(nworkers, len(methods))) as pool:
+            results = pool.starmap(_norm_method, jobs)
     else:
-        raise Exception('Unknown normalization method.')
-    if log:
-        norm = log_func(norm+small_const)
-    ne = None
-    if np.any(obj.meta_genes.ERCC):
-        # Save normalized ERCC
-        ne = norm[obj.meta_genes.ERCC]
-        # Remove ERCC so that they are not included in downstream analyses
-        norm = norm[np.logical_not(obj.meta_genes.ERCC)]
-    if obj.sparse:
-        norm = norm.astype(pd.SparseDtype("float64", 0))
-    obj.norm_data[name] = {'data': norm,
-                           'method': method,
-                           'log': log,
-                           'norm_ercc': ne,
-                           'dr': {},
-                           'clusters': {},
-                           'slingshot': {},
-                           'de': {},
-                           'combat': {}}
-    obj.set_assay(sys._getframe().f_code.co_name, norm_method)
+        results = [_norm_method(*job) for job in jobs]
+    ret = {}
+    for name_, method_, norm in zip(names, methods, results):
+        ne = None
+        if np.any(obj.meta_genes.ERCC):
+            if lazy:
+                ercc = obj.meta_genes.ERCC.reindex(norm.index,
+                                                   fill_value=False).values
+                ne = norm.rows(ercc)
+                norm = norm.subset(np.logical_not(ercc))
+            else:
+                # Save normalized ERCC
+                ne = norm[obj.meta_genes.ERCC]
+                # Remove ERCC so that they are not included in downstream analyses
+                norm = norm[np.logical_not(obj.meta_genes.ERCC)]
+        if obj.sparse and not lazy and not is_sparse_frame(norm):
+            norm = norm.astype(pd.SparseDtype("float64", 0))
+        elif not obj.sparse and not lazy and is_sparse_frame(norm):
+            # imputed counts are always merged into a sparse matrix
+            norm = norm.sparse.to_dense()
+        obj.norm_data[name_] = {'data': norm,
+                                'method': method_,
+                                'log': log,
+                                'norm_ercc': ne,
+                                'dr': {},
+                                'clusters': {},
+                                'slingshot': {},
+                                'de': {},
+                                'combat': {},
+                                'moments': {}}
+        obj.set_assay(sys._getframe().f_code.co_name, method_)
+        ret[name_] = norm
     if retx:
-        return norm
+        if isinstance(method, str):
+            return ret[names[0]]
+        return ret
+
+
+def _combat_it_sol(g_hat, d_hat, sum_z, sum_z2, n, g_bar, t2, a, b,
+                   conv=0.0001):
+    """Iterative solution of the parametric empirical Bayes estimates
+    of one batch (it.sol in sva), from the per gene sums of the
+    standardized data and of its squares."""
+    g_old = g_hat
+    d_old = d_hat
+    change = 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        while change > conv:
+            g_new = (t2*n*g_hat+d_old*g_bar)/(t2*n+d_old)
+            sum2 = sum_z2-2*g_new*sum_z+n*g_new**2
+            d_new = (0.5*sum2+b)/(n/2+a-1)
+            change = np.nanmax(np.concatenate((np.abs(g_new-g_old)/g_old,
+                                               np.abs(d_new-d_old)/d_old)))
+            g_old = g_new
+            d_old = d_new
+    return g_new, d_new
+
+
+def _combat_int_eprior(g_hat, d_hat, sum_z, sum_z2, n, block_size=1000):
+    """Non-parametric empirical Bayes estimates of one batch (int.eprior
+    in sva). Every gene gets the average of the estimates of all other
+    genes, weighted by the likelihood of its data under them. The
+    weights are computed on the log scale in blocks of genes."""
+    g_star = np.full(len(g_hat), np.nan)
+    d_star = np.full(len(g_hat), np.nan)
+    valid = np.nonzero(np.logical_and(np.isfinite(g_hat),
+                                      np.isfinite(d_hat) & (d_hat > 0)))[0]
+    g = g_hat[valid]
+    d = d_hat[valid]
+    for start in range(0, len(valid), block_size):
+        rows = valid[start:start+block_size]
+        k = len(rows)
+        sum2 = sum_z2[rows, None]-2*np.outer(sum_z[rows], g)+n*g**2
+        loglh = -n/2*np.log(2*np.pi*d)-sum2/(2*d)
+        # leave the gene itself out
+        loglh[np.arange(k), start+np.arange(k)] = -np.inf
+        w = np.exp(loglh-loglh.max(axis=1)[:, None])
+        g_star[rows] = np.dot(w, g)/w.sum(axis=1)
+        d_star[rows] = np.dot(w, d)/w.sum(axis=1)
+    return g_star, d_star
 
 
 def ComBat(obj, normalization=None, meta_cells_var=None,
-           mean_only=True, par_prior=True, verbose=False):
+           mean_only=True, par_prior=True, block_size=1000, out=None,
+           verbose=False):
     """Adjust for batch effects in datasets where the batch covariate
     is known
 
@@ -593,6 +969,12 @@ def ComBat(obj, normalization=None, meta_cells_var=None,
     parameters. This implementation follows the ComBat function in the
     R package SVA.
 
+    The model is estimated from per gene and batch sums of the
+    expression values and of their squares, so the data are never
+    standardized as a whole. The adjustment is applied in blocks of
+    `block_size` genes; with `out` set to a
+    :class:`numpy.memmap`, memory use is bounded by the block size.
+
     Commands should run in this order:
     >>> ad.normalize.norm(exp)
     >>> exp.add_meta_data(axis='cells', key='batch', data=batch_vector)
@@ -612,11 +994,20 @@ def ComBat(obj, normalization=None, meta_cells_var=None,
         Meta data variable. Should be a column name in
         :py:attr:`data.dataset.meta_cells`.
     mean_only : `bool`
-        Mean only version of ComBat. Default: True
+        Mean only version of ComBat. If False, both location and scale
+        of every batch are adjusted. Default: True
     par_prior : `bool`
         True indicates parametric adjustments will be used, False
         indicates non-parametric adjustments will be used. Default:
         True
+    block_size : `int`
+        Number of genes to process at a time. Default: 1000
+    out : :class:`numpy.ndarray`
+        An array with the same shape as the normalized data to write
+        the adjusted values into, such as a :class:`numpy.memmap`. If
+        None, a new single precision array is allocated. The adjusted
+        data are stored dense, also for sparse data sets, since batch
+        correction removes the zeros. Default: None
     verbose : `bool`
         Be verbose or not. Default: False
 
@@ -634,86 +1025,99 @@ def ComBat(obj, normalization=None, meta_cells_var=None,
     """
     if not meta_cells_var:
         raise Exception('"meta_cells_var" cannot be empty.')
-    if not mean_only:
-        raise NotImplementedError('mean_only=False is not implemented.')
-    if not par_prior:
-        raise NotImplementedError('par_prior=False is not implemented.')
     if normalization == None or normalization == '':
         norm = list(obj.norm_data.keys())[-1]
     else:
         norm = normalization
     X = obj.norm_data[norm]['data']
-    batch = obj.meta_cells.loc[:, meta_cells_var]
-    batch = list(batch[batch.index.isin(X.columns)])
-    # full design matrix
-    dm = patsy.dmatrix('~ 0 + batch', pd.DataFrame({'batch': batch}))
+    batch = obj.meta_cells.loc[:, meta_cells_var].reindex(X.columns)
+    if np.any(batch.isna()):
+        raise Exception('Batch is missing for some cells.')
+    batch = pd.Categorical(batch.values)
+    codes = batch.codes
+    nbatch = len(batch.categories)
     if verbose:
-        print('Found %s batches' % dm.shape[1])
-    nbatch = dm.shape[1]
-    mm = np.dot(np.asarray(dm).T, X.to_numpy().T)
-    i = np.dot(np.asarray(dm).T, np.asarray(dm))
-    B_hat = np.linalg.solve(i, mm)
-    nbatches = np.asarray(dm).sum(axis=0)
-    grand_mean = np.dot(nbatches/np.sum(nbatches), B_hat)
-    var_pooled = np.dot((X-np.dot(dm, B_hat).T)**2,
-                        [1/np.sum(nbatches)]*int(np.sum(nbatches)))
-    stand_mean = np.dot(np.matrix(grand_mean).T,
-                        np.matrix([1]*int(np.sum(nbatches))))
-    tmp = np.array(dm)
-    tmp[:, :] = 0
-    stand_mean = stand_mean + np.dot(tmp, B_hat).T
-    sdata = (X - stand_mean)/np.dot(np.matrix(np.sqrt(var_pooled)).T,
-                                    np.matrix([1]*int(np.sum(nbatches))))
-    gamma_hat = np.linalg.solve(np.dot(np.array(dm).T, np.array(dm)),
-                                np.dot(np.array(dm).T, sdata.T))
+        print('Found %s batches' % nbatch)
+    n_b = np.bincount(codes, minlength=nbatch).astype(float)
+    ncells = int(n_b.sum())
+    if not mean_only and np.any(n_b < 2):
+        raise Exception('mean_only must be True when a batch has only one \
+cell.')
+    # batch indicator matrix (cells x batches)
+    ind = csr_matrix((np.ones(ncells), (np.arange(ncells), codes)),
+                     shape=(ncells, nbatch))
+
+    # sufficient statistics: per gene and batch sums of x and x^2
+    if is_sparse_frame(X):
+        mat = to_csr(X, dtype=np.float64)
+        S1 = ind.T.dot(mat.T).T.toarray()
+        S2 = ind.T.dot(mat.multiply(mat).T).T.toarray()
+        del mat
+    else:
+        S1 = np.empty((X.shape[0], nbatch))
+        S2 = np.empty((X.shape[0], nbatch))
+        for start, end, block in dense_blocks(X, block_size):
+            S1[start:end] = ind.T.dot(block.T).T
+            S2[start:end] = ind.T.dot((block**2).T).T
+
+    grand_mean = S1.sum(axis=1)/ncells
+    var_pooled = (S2.sum(axis=1)-(S1**2/n_b).sum(axis=1))/ncells
+    sd = np.sqrt(np.maximum(var_pooled, 0))
+    # genes without variance are not adjusted
+    const = sd == 0
+    sd[const] = np.nan
+    # sums of the standardized data and its squares, batches x genes
+    sum_z = ((S1-n_b*grand_mean[:, None])/sd[:, None]).T
+    sum_z2 = ((S2-2*grand_mean[:, None]*S1+n_b*grand_mean[:, None]**2) /
+              var_pooled[:, None]).T
+    del S1, S2
+    gamma_hat = sum_z/n_b[:, None]
     if mean_only:
-        delta_hat = np.ones(shape=(dm.shape[1], X.shape[0]))
+        delta_hat = np.ones(gamma_hat.shape)
     else:
-        raise NotImplementedError('mean_only=False is not implemented.')
-    gamma_bar = np.nanmean(gamma_hat, axis=1)
-    t2 = np.nanvar(gamma_hat, axis=1)
-
-    def aprior(x):
-        m = np.mean(x)
-        s2 = np.var(x)
-        return (2 * s2 + m**2)/s2
+        delta_hat = (sum_z2-n_b[:, None]*gamma_hat**2)/(n_b[:, None]-1)
 
-    def bprior(x):
-        m = np.mean(x)
-        s2 = np.var(x)
-        return (2 * s2 + m**3)/s2
-
-    a_prior = np.apply_along_axis(aprior, 1, delta_hat)
-    b_prior = np.apply_along_axis(bprior, 1, delta_hat)
-
-    def postmean(g_hat, g_bar, n, d_star, t2):
-        return (t2 * n * g_hat + d_star * g_bar)/(t2 * n + d_star)
-
-    gamma_star = []
-    delta_star = []
+    gamma_bar = np.nanmean(gamma_hat, axis=1)
+    t2 = np.nanvar(gamma_hat, axis=1, ddof=1)
+    m = np.nanmean(delta_hat, axis=1)
+    s2 = np.nanvar(delta_hat, axis=1, ddof=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a_prior = (2*s2+m**2)/s2
+        b_prior = (m*s2+m**3)/s2
 
+    if verbose:
+        print('Finding %sparametric adjustments' % ('' if par_prior else 'non-'))
+    gamma_star = np.empty(gamma_hat.shape)
+    delta_star = np.ones(gamma_hat.shape)
     for i in np.arange(0, nbatch):
-        gamma_star.append(postmean(gamma_hat[i, :], gamma_bar[i], 1, 1, t2[i]))
-        delta_star.append([1]*X.shape[0])
-
-    gamma_star = np.asarray(gamma_star)
-    delta_star = np.asarray(delta_star)
-
-    bayesdata = sdata
-    # iterate all cells per batch
-    res = []
-    for i in np.arange(0, np.asarray(dm).shape[1]):
-        X_batch = bayesdata.iloc[:, np.asarray(dm)[:, i] == 1]
-        X_batch_dm = np.asarray(dm)[np.asarray(dm)[:, i] == 1, :]
-        lp = np.dot(np.matrix(np.sqrt(delta_star[i, ])).T,
-                    np.matrix([1]*X_batch.shape[1]))
-        r = (X_batch - np.dot(X_batch_dm, gamma_star).T)/lp
-        res.append(r)
-    res = pd.concat(res, axis=1)
-    res = res.reindex(X.columns, axis=1)
-    bd = res*np.dot(np.matrix(np.sqrt(var_pooled)).T,
-                    np.matrix([1]*X.shape[1]))+stand_mean
+        if par_prior and mean_only:
+            gamma_star[i] = (t2[i]*gamma_hat[i]+gamma_bar[i])/(t2[i]+1)
+        elif par_prior:
+            gamma_star[i], delta_star[i] = _combat_it_sol(
+                gamma_hat[i], delta_hat[i], sum_z[i], sum_z2[i], n_b[i],
+                gamma_bar[i], t2[i], a_prior[i], b_prior[i])
+        else:
+            gamma_star[i], d = _combat_int_eprior(
+                gamma_hat[i], delta_hat[i], sum_z[i], sum_z2[i], n_b[i],
+                block_size)
+            if not mean_only:
+                delta_star[i] = d
+
+    # adjust the data, block by block
+    if out is None:
+        out = np.empty(X.shape, dtype=np.float32)
+    for start, end, block in dense_blocks(X, block_size):
+        gm = grand_mean[start:end, None]
+        s = sd[start:end, None]
+        z = (block-gm)/s
+        z -= gamma_star[:, start:end].T[:, codes]
+        z /= np.sqrt(delta_star[:, start:end].T[:, codes])
+        adjusted = z*s+gm
+        c = const[start:end]
+        adjusted[c] = block[c]
+        out[start:end] = adjusted
+    bd = pd.DataFrame(out, index=X.index, columns=X.columns, copy=False)
     obj.set_assay(sys._getframe().f_code.co_name)
-    if obj.sparse:
-        bd = bd.astype(pd.SparseDtype("float64", 0))
     obj.norm_data[norm]['combat'] = bd
+    # cached gene moments of the previous ComBat data are stale
+    obj.norm_data[norm].get('moments', {}).pop('combat', None)
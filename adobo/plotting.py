@@ -25,6 +25,7 @@ import adobo
 from .dr import svd, irlb
 from ._constants import CLUSTER_COLORS_DEFAULT, YLW_CURRY
 from ._colors import unique_colors
+from .data import lazy_norm
 
 
 def _mpl_finish(filename, block=False, **args):
@@ -362,7 +363,7 @@ def cell_viz(obj, reduction=None, normalization=(), clustering=(),
     ----------
     obj : :class:`adobo.data.dataset`
           A data class object
-    reduction : `{'tsne', 'umap', 'pca', 'force_graph'}`
+    reduction : `{'tsne', 'umap', 'pca', 'harmony', 'force_graph'}`
         The dimensional reduction to use. Default is to use the last
         one generated.
     normalization : `tuple`
@@ -508,7 +509,7 @@ def cell_viz(obj, reduction=None, normalization=(), clustering=(),
             raise Exception(q)
         if not reduction:
             reduction = list(item['dr'].keys())[-1]
-        if reduction == 'pca':
+        if reduction in ('pca', 'harmony'):
             red_key = 'comp'
         elif reduction == 'force_graph':
             red_key = 'coords'
@@ -916,7 +917,13 @@ def genes_violin(obj, normalization='', clust_alg=None, cluster=None,
         cl = cl.values
     else:
         cl = np.array([0]*X.shape[1])
-    ret = X.groupby(cl, axis=1).aggregate(rank_func)
+    lazy = isinstance(X, lazy_norm)
+    if lazy:
+        # rank genes block by block instead of computing the full matrix
+        ret = pd.concat([b.groupby(cl, axis=1).aggregate(rank_func)
+                         for b in X.iter_rows(sparse=False)])
+    else:
+        ret = X.groupby(cl, axis=1).aggregate(rank_func)
     if cluster != None:
         if np.any([i > ret.shape[1] for i in cluster]):
             raise Exception('Wrong cell cluster index specified.')
@@ -926,8 +933,12 @@ def genes_violin(obj, normalization='', clust_alg=None, cluster=None,
         for i, d in ret.iteritems():
             d = d.sort_values(ascending=False)
             d = d.head(top)
-            X_ss = X[X.index.isin(d.index)]
-            X_ss = X_ss.loc[:, cl == i]
+            if lazy:
+                X_ss = X.block(rows=X.index.isin(d.index), cols=cl == i,
+                               sparse=False)
+            else:
+                X_ss = X[X.index.isin(d.index)]
+                X_ss = X_ss.loc[:, cl == i]
             if violin:
                 p = sns.violinplot(ax=aa[idx], data=X_ss.transpose(),
                                    linewidth=linewidth, order=d.index,
@@ -944,7 +955,10 @@ def genes_violin(obj, normalization='', clust_alg=None, cluster=None,
             idx += 1
     else:
         if np.sum(X.index.str.match(gene)) == 1:
-            X_ss = X[X.index.str.match(gene)].values[0]
+            if lazy:
+                X_ss = X.rows(X.index.str.match(gene), sparse=False).values[0]
+            else:
+                X_ss = X[X.index.str.match(gene)].values[0]
             g = X.index[X.index.str.match(gene)][0]
             print(g)
         else:
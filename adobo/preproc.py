@@ -16,6 +16,7 @@ import time
 import warnings
 from multiprocessing import Pool
 
+import joblib
 import psutil
 import numpy.ctypeslib as npct
 import numpy as np
@@ -23,13 +24,14 @@ import pandas as pd
 from sklearn.covariance import MinCovDet
 from sklearn.preprocessing import scale as sklearn_scale
 from sklearn.linear_model import ElasticNet
-from scipy.optimize import root
-from scipy.special import digamma
+from scipy.special import digamma, polygamma
 from scipy.stats import median_absolute_deviation as mad
 
 import adobo.IO
+from .data import imputed_counts, lazy_norm
 from .clustering import knn, snn, leiden
-from .hvg import seurat
+from .hvg import _seurat
+from ._sparse import to_csr
 from .dr import irlb
 from ._log import warning
 
@@ -43,6 +45,35 @@ def _warn(*args, **kwargs):
 warnings.warn = _warn
 
 
+def _load_pdf():
+    """Loads the normal and gamma probability density functions
+    implemented in C (adobo/libs/pdf.c), which are a lot faster than
+    scipy.stats. Returns None if the extension cannot be found."""
+    ext = None
+    for p in sys.path:
+        pp = glob.glob('%s/pdf.*.so' % p)
+        if len(pp) == 1:
+            ext = ctypes.cdll.LoadLibrary(pp[0])
+            break
+    if ext is None:
+        return None
+    vec = npct.ndpointer(dtype=np.double, ndim=1, flags='C_CONTIGUOUS')
+    mat = npct.ndpointer(dtype=np.double, ndim=2, flags='C_CONTIGUOUS')
+    ext.dgamma.argtypes = [vec, ctypes.c_int, ctypes.c_double,
+                           ctypes.c_double, vec]
+    ext.dnorm.argtypes = [vec, ctypes.c_int, ctypes.c_double,
+                          ctypes.c_double, vec]
+    ext.mix_weight.argtypes = [mat, ctypes.c_int, ctypes.c_int, mat, mat]
+    ext.mix_weight.restype = None
+    ext.mix_loglik.argtypes = [mat, ctypes.c_int, ctypes.c_int, mat, vec]
+    ext.mix_loglik.restype = None
+    return ext
+
+
+# loaded once, when the module is imported
+_pdf = _load_pdf()
+
+
 def reset_filters(obj):
     """Resets cell and gene filters
 
@@ -338,6 +369,89 @@ verbose=False):
     return low_quality_cells
 
 
+def _mix_weight(x, pars):
+    """Posterior probability of the gamma component of the
+    gamma-normal mixture for every element of `x` (genes as rows);
+    `pars` holds one row of mixture parameters per gene."""
+    x = np.ascontiguousarray(x, dtype=np.double)
+    pars = np.ascontiguousarray(pars, dtype=np.double)
+    out = np.empty(x.shape)
+    _pdf.mix_weight(x, x.shape[0], x.shape[1], pars, out)
+    return out
+
+
+def _mix_loglik(x, pars):
+    """log10-likelihood of every row of `x` under its mixture."""
+    x = np.ascontiguousarray(x, dtype=np.double)
+    pars = np.ascontiguousarray(pars, dtype=np.double)
+    out = np.empty(x.shape[0])
+    _pdf.mix_loglik(x, x.shape[0], x.shape[1], pars, out)
+    return out
+
+
+def _update_gmm_pars(x, wt, maxit=50, tol=1e-10):
+    """Updates the gamma shape and rate of every row. The root of
+    log(a)-digamma(a)=v is found with Newton's method for all rows at
+    once."""
+    tp_s = np.sum(wt, axis=1)
+    tp_t = np.sum(wt * x, axis=1)
+    tp_u = np.sum(wt * np.log(x), axis=1)
+    tp_v = -tp_u / tp_s - np.log(tp_s / tp_t)
+    alpha = np.full(len(tp_v), 20.0)
+    pos = tp_v > 0
+    v = tp_v[pos]
+    alpha0 = (3 - v + np.sqrt((v - 3)**2 + 24 * v)) / 12 / v
+    solve = alpha0 < 20
+    alpha0[np.logical_not(solve)] = 20
+    v = v[solve]
+    a = 0.9*alpha0[solve]
+    for _ in range(maxit):
+        step = (np.log(a) - digamma(a) - v)/(1/a - polygamma(1, a))
+        a = np.maximum(a - step, a/10)
+        if np.all(np.abs(step) < tol*a):
+            break
+    alpha0[solve] = a
+    alpha[pos] = alpha0
+    beta = tp_s / tp_t * alpha
+    return alpha, beta
+
+
+def _para_est(X):
+    """Estimates the gamma-normal mixture parameters of every row of
+    `X` with the EM algorithm. All rows are iterated together and a
+    row drops out once its likelihood has converged."""
+    point = np.log10(1.01)
+    nrow, ncol = X.shape
+    params = np.zeros((nrow, 5))
+    params[:, 1] = 0.5
+    params[:, 2] = 1
+    params[:, 0] = np.sum(X == point, axis=1)/ncol
+    params[params[:, 0] == 0, 0] = 0.01
+    X_rm = np.where(X > point, X, np.nan)
+    params[:, 3] = np.nanmean(X_rm, axis=1)
+    params[:, 4] = np.nanstd(X_rm, axis=1)
+    loglik_old = np.zeros(nrow)
+    iter_ = np.zeros(nrow, dtype=int)
+    active = np.arange(nrow)
+    while len(active) > 0:
+        x = X[active]
+        pars = params[active]
+        wt0 = _mix_weight(x, pars)
+        wt1 = 1-wt0
+        pars[:, 0] = np.sum(wt0, axis=1)/ncol
+        pars[:, 3] = np.sum(wt1*x, axis=1)/np.sum(wt1, axis=1)
+        pars[:, 4] = np.sqrt(np.sum(wt1*(x-pars[:, 3][:, None])**2, axis=1) /
+                             np.sum(wt1, axis=1))
+        pars[:, 1], pars[:, 2] = _update_gmm_pars(x, wt0)
+        loglik = _mix_loglik(x, pars)
+        eps = (loglik - loglik_old[active])**2
+        params[active] = pars
+        loglik_old[active] = loglik
+        iter_[active] += 1
+        active = active[np.logical_and(eps > 0.5, iter_[active] <= 100)]
+    return params
+
+
 def _imputation_worker(cellids, subcount, droprate, cc, Ic, Jc, drop_thre, verbose,
                        batch):
     """A helper function for impute(...)'s multiprocessing. Don't use
@@ -346,12 +460,11 @@ def _imputation_worker(cellids, subcount, droprate, cc, Ic, Jc, drop_thre, verbo
     usage."""
     res = []
     idx = 1
+    maxobs = subcount.max(axis=1).values
     for cellid in cellids:
         if verbose:
             v = (idx, len(cellids), batch, cc)
             print('imputing cell %s/%s (batch %s) in cluster %s' % v)
-        yobs = subcount.iloc[:, cellid]
-        yimpute = [0]*Ic
         nbs = set(np.arange(0, Jc))-set([cellid])
         # dropouts
         geneid_drop = droprate[:, cellid] > drop_thre
@@ -370,19 +483,30 @@ def _imputation_worker(cellids, subcount, droprate, cc, Ic, Jc, drop_thre, verbo
                           l1_ratio=0, fit_intercept=False)
         ret = regr.fit(X=xx, y=yy.values)
         ynew = regr.predict(ximpute)
-        yimpute = np.array(yimpute).astype(float)
-        yimpute[geneid_drop] = ynew
-        yimpute[geneid_obs] = yobs[geneid_obs]
-        maxobs = [max(k) for g, k in subcount.iterrows()]
-        maxobs = np.array(maxobs)
-        yimpute[yimpute > maxobs] = maxobs[yimpute > maxobs]
-        res.append(list(yimpute))
+        # observed values are kept as they are, so only the dropouts
+        # are returned
+        ynew = np.minimum(ynew, maxobs[geneid_drop])
+        res.append([np.nonzero(geneid_drop)[0], ynew])
         idx += 1
     return [cellids, res]
 
 
+def _checkpoint_file(checkpoint_dir, cc):
+    """Internal helper returning the checkpoint filename of a cluster."""
+    return os.path.join(checkpoint_dir, 'cluster_%s.joblib' % cc)
+
+
+def _checkpoint_dump(value, filename):
+    """Writes a checkpoint atomically, so that a crash while writing
+    never leaves a truncated file that looks like a finished
+    cluster."""
+    tmp = filename + '.tmp'
+    joblib.dump(value, filename=tmp)
+    os.replace(tmp, filename)
+
+
 def impute(obj, filtered=True, res=0.5, drop_thre=0.5,
-           nworkers='auto', verbose=True):
+           nworkers='auto', checkpoint_dir=None, verbose=True):
     """Impute dropouts using the method described in Li (2018) Nature
     Communications
 
@@ -414,6 +538,13 @@ def impute(obj, filtered=True, res=0.5, drop_thre=0.5,
         number of worker processes will be the total number of
         detected physical cores. If an integer then it specifies the
         number of worker processes. Default: 'auto'
+    checkpoint_dir : `str`
+        A directory where the cell clusters and the imputed block and
+        model parameters of every finished cluster are stored. If
+        imputation is restarted with the same directory, finished
+        clusters are skipped and their stored blocks are used
+        instead. Set to None to keep everything in memory. Default:
+        None
     verbose : `bool`
         Be verbose or not. Default: True
 
@@ -440,144 +571,90 @@ def impute(obj, filtered=True, res=0.5, drop_thre=0.5,
 number of physical cores on this machine (n=%s).' % ncores)
     if verbose:
         print('%s worker processes will be used' % nworkers)
-    # contains normal and gamma probability density functions implemented in C (a bit
-    # faster than using scipy.stats)
+    if _pdf is None:
+        raise Exception('The compiled density functions (pdf extension) could \
+not be found. Please reinstall adobo.')
     time_start = time.time()
-    for p in sys.path:
-        pp = glob.glob('%s/pdf.*.so' % p)
-        if len(pp) == 1:
-            ext = ctypes.cdll.LoadLibrary(pp[0])
-    ext.dgamma.argtypes = [npct.ndpointer(dtype=np.double, ndim=1, flags='CONTIGUOUS'),
-                           ctypes.c_int,
-                           ctypes.c_double,
-                           ctypes.c_double,
-                           npct.ndpointer(dtype=np.double, ndim=1, flags='CONTIGUOUS')]
-    ext.dnorm.argtypes = [npct.ndpointer(dtype=np.double, ndim=1, flags='CONTIGUOUS'),
-                          ctypes.c_int,
-                          ctypes.c_double,
-                          ctypes.c_double,
-                          npct.ndpointer(dtype=np.double, ndim=1, flags='CONTIGUOUS')]
-    # normalize
-    raw = obj.count_data.copy()
+    raw = obj.count_data
+    keep_genes = np.ones(raw.shape[0], dtype=bool)
+    keep_cells = np.ones(raw.shape[1], dtype=bool)
     if filtered:
         # Remove low quality cells
         remove = obj.meta_cells.status[obj.meta_cells.status != 'OK']
-        raw = raw.drop(remove.index, axis=1)
+        keep_cells = np.logical_not(raw.columns.isin(remove.index))
         # Remove uninformative genes (e.g. lowly expressed and ERCC)
         remove = obj.meta_genes.status[obj.meta_genes.status != 'OK']
-        raw = raw.drop(remove.index, axis=0)
+        keep_genes = np.logical_not(raw.index.isin(remove.index))
         if verbose:
-            print('Running on the quality filtered data (dimensions %sx%s)' % raw.shape)
-    col_sums = np.array([np.sum(i[1]) for i in raw.transpose().iterrows()])
-    raw = raw*(10**6/col_sums)
-    lnorm = np.log10(raw+1.01)
-    lnorm_imp = lnorm
-    # estimate subpopulations
-    hvg = seurat(lnorm, ngenes=1000)  # get hvg
-    lnorm_hvg = lnorm[lnorm.index.isin(hvg)]
-    d_scaled = sklearn_scale(lnorm_hvg.transpose(),  # cells as rows and genes as columns
-                             # over genes, i.e. features (columns)
-                             axis=0,
-                             with_mean=True,         # subtracting the column means
-                             with_std=True)          # scale the data to unit variance
-    d_scaled = pd.DataFrame(d_scaled.transpose(), index=lnorm_hvg.index)
-    comp, _ = irlb(d_scaled)
-    # estimating subpopulations
-    nn_idx = knn(comp)
-    snn_graph = snn(nn_idx)
-    cl = np.array(leiden(snn_graph, res))
+            v = (np.sum(keep_genes), np.sum(keep_cells))
+            print('Running on the quality filtered data (dimensions %sx%s)' % v)
+    counts = to_csr(raw, dtype=np.float64)[keep_genes][:, keep_cells]
+    col_sums = pd.Series(np.asarray(counts.sum(axis=0)).ravel(),
+                         index=raw.columns[keep_cells])
+    # log10 of counts per million, computed for one cluster of cells at
+    # a time; the counts are only stored as a sparse matrix
+    with np.errstate(divide='ignore'):
+        lnorm = lazy_norm(counts, 10**6/col_sums.values,
+                          raw.index[keep_genes], raw.columns[keep_cells],
+                          log_func=np.log10, small_const=1.01, sparse=False)
+    del counts
+    # positions in the raw read count matrix
+    gene_pos = pd.Series(np.arange(obj.count_data.shape[0]),
+                         index=obj.count_data.index)
+    cell_pos = pd.Series(np.arange(obj.count_data.shape[1]),
+                         index=obj.count_data.columns)
+    empty = {'rows': np.array([], dtype=np.int64),
+             'cols': np.array([], dtype=np.int64),
+             'values': np.array([])}
+    imp_entries = []
+    cl = None
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        fn_clusters = os.path.join(checkpoint_dir, 'clusters.joblib')
+        if os.path.exists(fn_clusters):
+            cells, cl = joblib.load(fn_clusters)
+            if not np.array_equal(cells, lnorm.columns.values):
+                raise Exception('The checkpoint directory "%s" was created \
+from different data.' % checkpoint_dir)
+            if verbose:
+                print('resuming from checkpoint directory %s' % checkpoint_dir)
+    if cl is None:
+        # estimate subpopulations
+        hvg = _seurat(lnorm.mean(), lnorm.var(), ngenes=1000)  # get hvg
+        lnorm_hvg = lnorm.rows(lnorm.index.isin(hvg))
+        d_scaled = sklearn_scale(lnorm_hvg.transpose(),  # cells as rows and genes as columns
+                                 # over genes, i.e. features (columns)
+                                 axis=0,
+                                 with_mean=True,         # subtracting the column means
+                                 with_std=True)          # scale the data to unit variance
+        d_scaled = pd.DataFrame(d_scaled.transpose(), index=lnorm_hvg.index)
+        comp, _ = irlb(d_scaled)
+        # estimating subpopulations
+        nn_idx = knn(comp)
+        snn_graph = snn(nn_idx)
+        cl = np.array(leiden(snn_graph, res))
+        if checkpoint_dir:
+            _checkpoint_dump((lnorm.columns.values, cl), fn_clusters)
     nclust = len(np.unique(cl))
     if verbose:
         print('going to work on %s clusters' % nclust)
 
-    def weight(x, params):
-        inp = x
-        g_out = np.zeros(len(inp))
-        n_out = np.zeros(len(inp))
-        # takes scale as input (rate=1/scale)
-        ext.dgamma(np.array(inp), len(inp), params[1], 1/params[2], g_out)
-        # SLOW (scipy.stats): dgamma.pdf(x, a=params[1], scale=1, loc=0)
-        pz1 = params[0] * g_out
-        ext.dnorm(np.array(inp), len(inp), params[3], params[4], n_out)
-        # SLOW (scipy.stats): norm.pdf(x, params[3], params[4])
-        pz2 = (1-params[0])*n_out
-        pz = pz1/(pz1+pz2)
-        pz[pz1 == 0] = 0
-        return np.array([pz, 1-pz])
-
-    def update_gmm_pars(x, wt):
-        tp_s = np.sum(wt)
-        tp_t = np.sum(wt * x)
-        tp_u = np.sum(wt * np.log(x))
-        tp_v = -tp_u / tp_s - np.log(tp_s / tp_t)
-        if tp_v <= 0:
-            alpha = 20
-        else:
-            alpha0 = (3 - tp_v + np.sqrt((tp_v - 3)
-                                         ** 2 + 24 * tp_v)) / 12 / tp_v
-            if alpha0 >= 20:
-                alpha = 20
-            else:
-                alpha = root(lambda x: np.log(x) -
-                             digamma(x) - tp_v, 0.9*alpha0).x[0]
-        beta = tp_s / tp_t * alpha
-        return alpha, beta
-
-    def dmix(x, pars):
-        inp = x
-        g_out = np.zeros(len(inp))
-        n_out = np.zeros(len(inp))
-        ext.dgamma(np.array(inp), len(inp), pars[1], 1/pars[2], g_out)
-        #dg = dgamma(a=pars[1], scale=1/pars[2], loc=0)
-        # dg.pdf(x)
-        #dn = norm(pars[3], pars[4])
-        # dn.pdf(x)
-        ext.dnorm(np.array(inp), len(inp), pars[3], pars[4], n_out)
-        return pars[0]*g_out*2+(1-pars[0])*n_out
-
-    def para_est(x):
-        params = [0, 0.5, 1, 0, 0]
-        params[0] = np.sum(x == np.log10(1.01))/len(x)
-        if params[0] == 0:
-            params[0] = 0.01
-        x_rm = x[x > np.log10(1.01)]
-        params[3] = np.mean(x_rm)
-        params[4] = np.std(x_rm)
-        eps, iter_, loglik_old = 10, 0, 0
-        while eps > 0.5:
-            wt = weight(x, params)
-            params[0] = np.sum(wt[0])/len(wt[0])
-            params[3] = np.sum(wt[1]*x)/np.sum(wt[1])
-            params[4] = np.sqrt(np.sum(wt[1]*(x-params[3])**2)/np.sum(wt[1]))
-            params[1:3] = update_gmm_pars(x, wt[0])
-            loglik = np.sum(np.log10(dmix(x, params)))
-            eps = (loglik - loglik_old)**2
-            loglik_old = loglik
-            iter_ = iter_ + 1
-            if iter_ > 100:
-                break
-        return params
-
-    def get_par(mat, verbose):
+    def get_par(mat, verbose, block_size=1000):
         null_genes = np.abs(mat.sum(axis=1)-np.log10(1.01)
                             * mat.shape[1]) < 1e-10
-        null_genes = null_genes[null_genes].index
-        paramlist = []
-        i = 0
-        for g, k in mat.iterrows():
+        X = mat.to_numpy()
+        paramlist = np.full((mat.shape[0], 5), np.nan)
+        keep = np.nonzero(np.logical_not(null_genes.values))[0]
+        for i in np.arange(0, len(keep), block_size):
             if verbose:
-                if (i % 100) == 0:
-                    v = ('{:,}'.format(i), '{:,}'.format(mat.shape[0]))
-                    s = 'estimating model parameters. finished with %s/%s genes' % v
-                    print(s, end='\r')
-            if g in null_genes:
-                paramlist.append([np.nan]*5)
-            else:
-                paramlist.append(para_est(k.values))
-            i += 1
+                v = ('{:,}'.format(i), '{:,}'.format(mat.shape[0]))
+                s = 'estimating model parameters. finished with %s/%s genes' % v
+                print(s, end='\r')
+            rows = keep[i:i+block_size]
+            paramlist[rows] = _para_est(X[rows])
         if verbose:
             print('\nmodel parameter estimation has finished')
-        return np.array(paramlist)
+        return paramlist
 
     def find_va_genes(mat, parlist):
         point = np.log10(1.01)
@@ -593,9 +670,17 @@ number of physical cores on this machine (n=%s).' % ncores)
         # return valid_genes[np.logical_not(np.logical_or(sgene1,sgene3))].index
 
     for cc in np.arange(0, nclust):
+        if checkpoint_dir:
+            fn_cc = _checkpoint_file(checkpoint_dir, cc)
+            if os.path.exists(fn_cc):
+                if verbose:
+                    print('cluster %s was found in the checkpoint, skipping' % cc)
+                continue
         if verbose:
             print('estimating dropout probability for cluster %s' % cc)
-        lnorm_cc = lnorm.iloc[:, cl == cc]
+        # genes without counts in the cluster are never valid
+        detected = lnorm.counts[:, cl == cc].getnnz(axis=1) > 0
+        lnorm_cc = lnorm.block(rows=detected, cols=cl == cc)
         # estimate model parameters
         parlist = get_par(lnorm_cc, verbose)
         if verbose:
@@ -608,17 +693,13 @@ number of physical cores on this machine (n=%s).' % ncores)
         Ic = subcount.shape[0]
         Jc = subcount.shape[1]
         if Jc == 1:
+            if checkpoint_dir:
+                _checkpoint_dump(dict(empty, parlist=parlist), fn_cc)
             continue
         parlist = parlist[valid_genes]
-        idx = 0
-        droprate = []
-        for g, k in subcount.iterrows():
-            wt = weight(k, parlist[idx])[0]
-            idx += 1
-            droprate.append(wt)
-        droprate = np.array(droprate)
+        droprate = _mix_weight(subcount.to_numpy(), parlist)
         mu = parlist[:, 3]
-        mucheck = subcount.apply(lambda x: x > mu, axis=0)
+        mucheck = subcount.to_numpy() > mu[:, None]
         droprate[np.logical_and(mucheck, droprate > drop_thre)] = 0
         # dropouts
         if verbose:
@@ -648,36 +729,49 @@ number of physical cores on this machine (n=%s).' % ncores)
         pool.close()
         pool.join()
         if len(imputed) == 0:
+            if checkpoint_dir:
+                _checkpoint_dump(dict(empty, parlist=parlist), fn_cc)
             continue
-        # sorting b/c cells are not returned from subprocesses in the
-        # original order
-        cellids = []
-        d = []
+        # collect the imputed entries; the reverse normalisation is
+        # only needed for these
+        genes_cc = gene_pos[subcount.index].values
+        cells_cc = cell_pos[subcount.columns].values
+        scale_cc = col_sums[subcount.columns].values/10**6
+        rows, cols, values = [], [], []
         for item in imputed:
-            cellids.append(item[0])
-            d.append(item[1])
-        cellids = np.concatenate(cellids)
-        imputed = np.concatenate(d)
+            for cellid, (geneid_drop, ynew) in zip(item[0], item[1]):
+                rows.append(genes_cc[geneid_drop])
+                cols.append(np.repeat(cells_cc[cellid], len(geneid_drop)))
+                values.append(np.round((10**ynew-1.01)*scale_cc[cellid], 2))
+        block = {'rows': np.concatenate(rows),
+                 'cols': np.concatenate(cols),
+                 'values': np.concatenate(values)}
         time_e = time.time()
         if verbose:
             v = (cc, (time_e - time_s)/60)
             print('imputation for cluster %s finished in %.2f minutes' % v)
-        imputed = imputed.transpose()
-        imputed = pd.DataFrame(imputed)
-        imputed.columns = cellids
-        imputed.index = valid_genes[valid_genes].index
-        imputed = imputed.sort_index(axis=1)
-        lnorm_imp.loc[valid_genes, lnorm_cc.columns] = imputed.to_numpy()
-    # reverse normalisation
-    lnorm_imp = 10**lnorm_imp - 1.01
-    lnorm_imp = lnorm_imp*(col_sums/10**6)
-    lnorm_imp = round(lnorm_imp, 2)
-    obj.imp_count_data = lnorm_imp
+        if checkpoint_dir:
+            _checkpoint_dump(dict(block, parlist=parlist), fn_cc)
+        else:
+            imp_entries.append(block)
+    if checkpoint_dir:
+        # stream the stored blocks back in, one cluster at a time
+        for cc in np.arange(0, nclust):
+            block = joblib.load(_checkpoint_file(checkpoint_dir, cc))
+            del block['parlist']
+            imp_entries.append(block)
+    imp_entries.append(empty)
+    obj.imp_count_data = imputed_counts(
+        obj.count_data.index, obj.count_data.columns,
+        np.concatenate([b['rows'] for b in imp_entries]),
+        np.concatenate([b['cols'] for b in imp_entries]),
+        np.concatenate([b['values'] for b in imp_entries]))
     time_end = time.time()
     if verbose:
         t = (time_end - time_start)/60
-        print('imputation finished in %.2f minutes. imputed data are present \
-in the "imp_count_data" attribute.' % t)
+        v = (t, '{:,}'.format(obj.imp_count_data.nimputed))
+        print('imputation finished in %.2f minutes. %s imputed entries are \
+present in the "imp_count_data" attribute.' % v)
     obj.set_assay(sys._getframe().f_code.co_name)
 
 
@@ -0,0 +1,117 @@
+# adobo.
+#
+# Description: An analysis framework for scRNA-seq data.
+#  How to use: https://oscar-franzen.github.io/adobo/
+#     Contact: Oscar Franzen <p.oscar.franzen@gmail.com>
+"""
+Summary
+-------
+Iterations per second of the truncated SVD solvers in adobo.irlbpy.
+
+The input is the scaled, highly variable gene matrix of the bundled
+pbmc8k data (cells as rows). Three solvers are compared: lanczos()
+with the previous matrix-vector product (wrapping every vector in a
+sparse matrix and densifying the result), lanczos() with direct
+products and block_lanczos(). If the bundled data is not installed,
+use --synthetic.
+
+Run from the repository root:
+
+    python benchmarks/bench_irlb.py [--ncomp 50] [--synthetic]
+"""
+import argparse
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+
+import adobo as ad
+from adobo import irlbpy
+from adobo.irlbpy import irlb
+from adobo._sparse import to_csr
+
+
+def _multA_csr(A, x, TP=False, L=None):
+    """ Previous matrix-vector product of irlbpy.multA. """
+    if sparse.issparse(A):
+        if TP:
+            return sparse.csr_matrix(x).dot(A).transpose().todense().A[:, 0]
+        return A.dot(sparse.csr_matrix(x).transpose()).todense().A[:, 0]
+    if TP:
+        return x.dot(A)
+    return A.dot(x)
+
+
+def pbmc8k(ngenes):
+    obj = ad.IO.load_from_file('pbmc8k.mat.gz', bundled=True)
+    ad.preproc.simple_filter(obj)
+    ad.normalize.norm(obj, method='standard')
+    ad.hvg.find_hvg(obj, ngenes=ngenes)
+    item = obj.norm_data['standard']
+    return item['data'].loc[item['hvg']['genes'], :]
+
+
+def synthetic(genes, cells, density, seed):
+    mat = sparse.random(genes, cells, density=density, format='csr',
+                        random_state=seed)
+    mat.data = np.log2(np.ceil(mat.data*10)+1)
+    return mat
+
+
+def _run(solver, inp, ncomp, center, sd, seed):
+    stime = time.time()
+    if solver == 'block_lanczos':
+        res = irlb.block_lanczos(inp, ncomp, center=center, scale=sd,
+                                 seed=seed)
+    else:
+        res = irlbpy.lanczos(inp, ncomp, maxit=1000, center=center,
+                             scale=sd, seed=seed)
+    return res, time.time()-stime
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--ncomp', type=int, default=50)
+    parser.add_argument('--ngenes', type=int, default=2000)
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--cells', type=int, default=8000)
+    parser.add_argument('--density', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    if args.synthetic:
+        data = synthetic(args.ngenes, args.cells, args.density, args.seed)
+    else:
+        data = pbmc8k(args.ngenes)
+    inp = to_csr(data, dtype=np.float64).T.tocsr()
+    center = np.asarray(inp.mean(axis=0)).ravel()
+    sq = np.asarray(inp.multiply(inp).mean(axis=0)).ravel()
+    sd = np.sqrt(np.maximum(sq-center**2, 0))
+    sd[sd == 0] = 1
+    print('%s cells x %s genes, %s components' % (inp.shape[0], inp.shape[1],
+                                                 args.ncomp))
+    print('%-30s %8s %8s %8s %10s %10s' % ('solver', 'time (s)', 'steps',
+                                           'products', 'steps/s',
+                                           'products/s'))
+    ref = None
+    for name, solver in (('lanczos (csr product)', 'lanczos'),
+                         ('lanczos', 'lanczos'),
+                         ('block_lanczos', 'block_lanczos')):
+        if name == 'lanczos (csr product)':
+            irlb.multA, multA = _multA_csr, irlb.multA
+        try:
+            res, el = _run(solver, inp, args.ncomp, center, sd, args.seed)
+        finally:
+            if name == 'lanczos (csr product)':
+                irlb.multA = multA
+        if ref is None:
+            ref = res.s
+        print('%-30s %8.2f %8d %8d %10.1f %10.1f' % (name, el, res.steps,
+                                                     res.nmult,
+                                                     res.steps/el,
+                                                     res.nmult/el))
+        print('%-30s max relative singular value difference %.2e' %
+              ('', np.max(np.abs(res.s-ref))/ref[0]))
+
+
+if __name__ == '__main__':
+    main()
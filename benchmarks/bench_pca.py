@@ -0,0 +1,148 @@
+# adobo.
+#
+# Description: An analysis framework for scRNA-seq data.
+#  How to use: https://oscar-franzen.github.io/adobo/
+#     Contact: Oscar Franzen <p.oscar.franzen@gmail.com>
+"""
+Summary
+-------
+Accuracy and timings of the randomized PCA (adobo.dr.randomized).
+
+The accuracy of the randomized and irlb methods is measured against
+the full SVD (adobo.dr.svd) on a small synthetic data set with cluster
+structure. Timings of the randomized range finder are measured on
+sparse synthetic data sets of increasing size (cells x genes, single
+precision, implicit centering and scaling).
+
+The singular values and vectors of the 9 components with signal must
+match svd (relative singular value error below 1e-3, |cos| above
+0.9999), otherwise the script exits with an error. With --check only
+the accuracy is tested.
+
+Run from the repository root:
+
+    python benchmarks/bench_pca.py [--cells 10000 100000 1000000] [--irlb]
+    python benchmarks/bench_pca.py --check
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+from adobo import dr, irlbpy
+
+
+def synthetic(cells, genes, density, nclust, seed, block_size=50000):
+    """ Sparse cells x genes matrix of log counts with clusters. """
+    rng = np.random.RandomState(seed)
+    blocks = []
+    markers = max(1, genes//(4*nclust))
+    for start in range(0, cells, block_size):
+        n = min(block_size, cells-start)
+        mat = sparse.random(n, genes, density=density, format='csr',
+                            dtype=np.float32, random_state=rng)
+        mat.data = np.log2(np.ceil(mat.data*10)+1)
+        # every cluster expresses its own set of marker genes
+        cl = rng.randint(nclust, size=n)
+        rows = np.repeat(np.arange(n), markers)
+        cols = (cl[:, None]*markers+np.arange(markers)).ravel()
+        keep = rng.rand(len(rows)) < 0.5
+        sig = sparse.csr_matrix((np.log2(rng.poisson(5, keep.sum())+1.0),
+                                 (rows[keep], cols[keep])), shape=(n, genes),
+                                dtype=np.float32)
+        blocks.append((mat+sig).tocsr())
+    return sparse.vstack(blocks, format='csr')
+
+
+def _center_scale(mat):
+    center = np.asarray(mat.mean(axis=0, dtype=np.float64)).ravel()
+    sq = np.asarray(mat.multiply(mat).mean(axis=0, dtype=np.float64)).ravel()
+    sd = np.sqrt(np.maximum(sq-center**2, 0))
+    sd[sd == 0] = 1
+    return center, sd
+
+
+# tolerances of the accuracy check, for the components with signal
+MAX_S_ERR = 1e-3
+MIN_COS = 0.9999
+
+
+def accuracy(cells, genes, density, ncomp, seed):
+    """ Compares randomized and irlb with svd, returns the failures. """
+    mat = synthetic(cells, genes, density, 10, seed)
+    data = pd.DataFrame(mat.T.toarray(), index=range(genes),
+                        columns=range(cells))
+    ref, ref_contr = dr.svd(data, ncomp=ncomp)
+    ref_s = np.linalg.norm(ref.values, axis=0)
+    print('accuracy against svd, %s cells x %s genes, %s components' %
+          (cells, genes, ncomp))
+    # 10 clusters give 9 components with signal
+    print('%-25s %10s %14s %14s %14s' % ('method', 'time (s)',
+                                         'max rel. s err', 's err 1-9',
+                                         'min |cos| 1-9'))
+    failed = []
+    for name, fun in (('randomized', dr.randomized), ('irlb', dr.irlb)):
+        stime = time.time()
+        comp, contr = fun(data, ncomp=ncomp, seed=seed)
+        el = time.time()-stime
+        s = np.linalg.norm(comp.values, axis=0)
+        err = np.abs(s-ref_s)/ref_s
+        cos = np.abs(np.sum(contr.values[:, 0:9]*ref_contr.values[:, 0:9],
+                            axis=0))
+        print('%-25s %10.2f %14.2e %14.2e %14.6f' % (name, el, err.max(),
+                                                     err[0:9].max(),
+                                                     cos.min()))
+        if not (err[0:9].max() < MAX_S_ERR and cos.min() > MIN_COS):
+            failed.append(name)
+    return failed
+
+
+def timings(cells, genes, density, ncomp, seed, with_irlb):
+    print('\ntimings, %s genes, density %s, %s components' % (genes, density,
+                                                             ncomp))
+    print('%-10s %-25s %10s' % ('cells', 'method', 'time (s)'))
+    for n in cells:
+        mat = synthetic(n, genes, density, 10, seed)
+        center, sd = _center_scale(mat)
+        stime = time.time()
+        irlbpy.randomized_svd(mat, ncomp, center=center, scale=sd, seed=seed)
+        print('%-10s %-25s %10.2f' % (n, 'randomized (float32)',
+                                      time.time()-stime))
+        if with_irlb:
+            mat = mat.astype(np.float64)
+            stime = time.time()
+            irlbpy.lanczos(mat, ncomp, maxit=1000, center=center, scale=sd,
+                           seed=seed)
+            print('%-10s %-25s %10.2f' % (n, 'irlb (float64)',
+                                          time.time()-stime))
+        del mat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--cells', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--genes', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--ncomp', type=int, default=75)
+    parser.add_argument('--accuracy-cells', type=int, default=5000)
+    parser.add_argument('--irlb', action='store_true',
+                        help='also time irlb')
+    parser.add_argument('--check', action='store_true',
+                        help='only test the accuracy')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    failed = accuracy(args.accuracy_cells, args.genes, args.density,
+                      args.ncomp, args.seed)
+    if failed:
+        sys.exit('accuracy check failed: %s' % ', '.join(failed))
+    if not args.check:
+        timings(args.cells, args.genes, args.density, args.ncomp, args.seed,
+                args.irlb)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# adobo.
+#
+# Description: An analysis framework for scRNA-seq data.
+#  How to use: https://oscar-franzen.github.io/adobo/
+#     Contact: Oscar Franzen <p.oscar.franzen@gmail.com>
+"""
+Summary
+-------
+Micro-benchmarks of the helper functions in adobo._stats.
+
+Run from the repository root:
+
+    python benchmarks/bench_stats.py [--genes 20000] [--cells 5000]
+"""
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import random as sparse_random
+
+from adobo._stats import row_geometric_mean, is_outlier
+
+
+def _timeit(stmt, repeat=3):
+    """ Best wall time of `repeat` runs, in seconds. """
+    return min(timeit.repeat(stmt, repeat=repeat, number=1))
+
+
+def bench_row_geometric_mean(genes, cells, density, seed):
+    mat = sparse_random(genes, cells, density=density, format='csr',
+                        random_state=seed)
+    mat.data = np.ceil(mat.data*10)
+    sparse = pd.DataFrame.sparse.from_spmatrix(mat)
+    dense = pd.DataFrame(mat.toarray())
+    return {'row_geometric_mean (csr)':
+            _timeit(lambda: row_geometric_mean(mat)),
+            'row_geometric_mean (sparse frame)':
+            _timeit(lambda: row_geometric_mean(sparse)),
+            'row_geometric_mean (dense frame)':
+            _timeit(lambda: row_geometric_mean(dense))}
+
+
+def bench_is_outlier(genes, seed):
+    rng = np.random.RandomState(seed)
+    x = pd.Series(rng.normal(size=genes))
+    pars = pd.DataFrame({'theta': rng.normal(size=genes),
+                         'log_umi': x+rng.standard_cauchy(genes),
+                         'const': -x+rng.normal(size=genes)})
+    return {'is_outlier (3 parameters)': _timeit(lambda: is_outlier(pars, x))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--genes', type=int, default=20000)
+    parser.add_argument('--cells', type=int, default=5000)
+    parser.add_argument('--density', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    res = {}
+    res.update(bench_row_geometric_mean(args.genes, args.cells,
+                                        args.density, args.seed))
+    res.update(bench_is_outlier(args.genes, args.seed))
+    print('%s genes x %s cells, density %s' % (args.genes, args.cells,
+                                               args.density))
+    for name, t in res.items():
+        print('%-40s %8.4f s' % (name, t))
+
+
+if __name__ == '__main__':
+    main()
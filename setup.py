@@ -32,7 +32,8 @@ setup(
         'patsy >= 0.5.1',
         'mplcursors >= 0.3',
         'python-louvain >= 0.13', # louvain (module is called community)
-        'tqdm >= 4.37.0' # progress bar
+        'tqdm >= 4.37.0', # progress bar
+        'joblib >= 0.14.0' # imputation checkpoints
     ],
     ext_modules=[Extension('pdf', sources = ['adobo/libs/pdf.c'],
                            extra_compile_args=['-fPIC','-lm'])]